@@ -32,16 +32,26 @@ def download_parser(parser=None):
         help="Workset path[s]")
     parser.add_argument("-f", "--force", action='store_true', 
         help="Remove folder if exists")
+    parser.add_argument("-r", "--resume", action='store_true',
+        help="Resume an interrupted download into the existing output folder, skipping completed volumes")
     parser.add_argument("-o", "--output", help="Output directory",
         default='/media/secure_volume/workset/')
     parser.add_argument("-hf", "--remove-headers-footers", action='store_true',
         help="Remove headers and footers from individual pages and save in a separate csv file for inspection")
     parser.add_argument("-hfc", "--remove-headers-footers-and-concat", action='store_true',
         help="Remove headers and footers from individual pages and save in a separate csv file for inspection then concatenate pages")
+    parser.add_argument("--hf-read-from-zip", action='store_true',
+                        help="Let the header/footer removal workers read the pages of their volumes from the "
+                             "downloaded ZIP file, instead of receiving the text of the pages")
     parser.add_argument("-w", "--window-size", required=False, type=int, metavar="N", default=6,
                         help="How many pages ahead does the header/footer extractor algorithm look to find potential "
                              "matching headers/footers (higher value gives potentially more accurate results on lower "
                              "quality OCR volumes at the expense of runtime)")
+    parser.add_argument("--hf-candidates", choices=['window', 'lsh'], default='window',
+                        help="Compare every line at the top and bottom of a page with those of the pages within the "
+                             "window (default), or only with the similar-looking ones found by locality-sensitive "
+                             "hashing, which makes large windows affordable (with lsh, a window size of 0 looks at "
+                             "the whole volume)")
     parser.add_argument("-msr", "--min-similarity-ratio", required=False, type=float, metavar="N", default=0.7,
                         help="The minimum string similarity ratio required for the Levenshtein distance fuzzy-matching "
                              "algorithm to declare that two headers are considered 'the same' (the higher the value, up "
@@ -49,10 +59,56 @@ def download_parser(parser=None):
                              "fuzziness to account for OCR errors)")
     parser.add_argument("-s", "--skip-removed-hf", action='store_true',
                         help="Skip creating a saved report of the removed headers and footers for each page for inspection")
+    parser.add_argument("--hf-report", choices=['volume', 'workset'], default='volume',
+                        help="Save the report of the removed headers and footers as a removed_hf.csv file per volume "
+                             "(default), or as a single removed_hf.csv for the whole workset, keyed by volume and page")
     parser.add_argument("--parallelism", required=False, type=int, metavar="N", default=os.cpu_count(),
                         help="The max number of concurrent tasks to start when downloading or removing headers/footers")
     parser.add_argument("--batch-size", required=False, type=int, metavar="N", default=250,
                         help="The max number of volumes to download at a time from DataAPI")
+    parser.add_argument("--adaptive-batch-size", action='store_true',
+                        help="Grow or shrink each batch based on the response size and time of the previous batches, "
+                             "starting from --batch-size")
+    parser.add_argument("--min-batch-size", required=False, type=int, metavar="N", default=10,
+                        help="The min number of volumes in a batch when --adaptive-batch-size is set")
+    parser.add_argument("--max-batch-size", required=False, type=int, metavar="N", default=1000,
+                        help="The max number of volumes in a batch when --adaptive-batch-size is set")
+    parser.add_argument("--target-batch-size", required=False, type=int, metavar="MB", default=256,
+                        help="The response size (in MB) each batch should aim for when --adaptive-batch-size is set")
+    parser.add_argument("--concurrency", required=False, type=int, metavar="N", default=1,
+                        help="The max number of batches to download from DataAPI at the same time")
+    parser.add_argument("--max-pending-size", required=False, type=int, metavar="MB",
+                        help="Do not start downloading more batches while the downloaded batches waiting to be "
+                             "extracted add up to this size (in MB)")
+    parser.add_argument("--use-asyncio", action='store_true',
+                        help="Send the concurrent DataAPI requests from a single asyncio event loop")
+    parser.add_argument("--stream-extract", action='store_true',
+                        help="Extract each DataAPI response while it is being downloaded instead of once it is "
+                             "complete")
+    parser.add_argument("--bundle", choices=['workset', 'volume'], default=None,
+                        help="Save the volumes into compressed archives instead of one file per page: a single "
+                             "workset.zip, or one ZIP file per volume")
+    parser.add_argument("--extract-workers", required=False, type=int, metavar="N", default=1,
+                        help="Number of threads extracting the volumes of each batch (without header/footer "
+                             "removal)")
+    parser.add_argument("--cache", action='store_true',
+                        help="Keep downloaded volumes in a local cache and only request the volumes which are not "
+                             "cached from DataAPI")
+    parser.add_argument("--cache-dir", required=False, metavar="DIR", default=os.path.expanduser('~/.htrc-cache'),
+                        help="The directory of the volume cache")
+    parser.add_argument("--cache-size", required=False, type=int, metavar="MB", default=10240,
+                        help="The max size (in MB) of the volume cache; the least recently used volumes are evicted "
+                             "beyond it")
+    parser.add_argument("--max-attempts", required=False, type=int, metavar="N", default=3,
+                        help="How many times to try downloading a batch before splitting it up to isolate the volumes "
+                             "which cannot be downloaded")
+    parser.add_argument("--buffer-size", required=False, type=int, metavar="MB", default=1,
+                        help="The size (in MB) of the buffer used to read responses from DataAPI")
+    parser.add_argument("--timeout", required=False, type=float, metavar="SECONDS", default=300,
+                        help="How long to wait for DataAPI to respond before retrying a request (0 waits forever)")
+    parser.add_argument("--prefetch", required=False, type=int, metavar="N", default=1,
+                        help="How many batches to download ahead while the current batch is being extracted or "
+                             "having its headers/footers removed (0 disables prefetching)")
     parser.add_argument("-c", "--concat", action='store_true',
         help="Concatenate a volume's pages in to a single file")
     parser.add_argument("-m", "--mets", action='store_true',
@@ -68,6 +124,37 @@ def download_parser(parser=None):
     return parser
 
 
+def clean_parser(parser=None):
+    if parser is None:
+        parser = ArgumentParser()
+    parser.add_argument("input", help="Directory of volumes downloaded without removing headers and footers")
+    parser.add_argument("-o", "--output", required=True,
+        help="Output directory, which may hold the volumes of a previous clean run to update")
+    parser.add_argument("-f", "--force", action='store_true',
+        help="Clean all volumes again, even those which are up to date")
+    parser.add_argument("-c", "--concat", action='store_true',
+        help="Concatenate a volume's pages in to a single file")
+    parser.add_argument("-w", "--window-size", required=False, type=int, metavar="N", default=6,
+                        help="How many pages ahead does the header/footer extractor algorithm look to find potential "
+                             "matching headers/footers")
+    parser.add_argument("--hf-candidates", choices=['window', 'lsh'], default='window',
+                        help="Compare every line at the top and bottom of a page with those of the pages within the "
+                             "window (default), or only with the similar-looking ones found by locality-sensitive "
+                             "hashing, which makes large windows affordable (with lsh, a window size of 0 looks at "
+                             "the whole volume)")
+    parser.add_argument("-msr", "--min-similarity-ratio", required=False, type=float, metavar="N", default=0.7,
+                        help="The minimum string similarity ratio required for the Levenshtein distance fuzzy-matching "
+                             "algorithm to declare that two headers are considered 'the same'")
+    parser.add_argument("-s", "--skip-removed-hf", action='store_true',
+                        help="Skip creating a saved report of the removed headers and footers for each page for inspection")
+    parser.add_argument("--hf-report", choices=['volume', 'workset'], default='volume',
+                        help="Save the report of the removed headers and footers as a removed_hf.csv file per volume "
+                             "(default), or as a single removed_hf.csv for the whole workset, keyed by volume and page")
+    parser.add_argument("--parallelism", required=False, type=int, metavar="N", default=os.cpu_count(),
+                        help="The max number of concurrent tasks to start when removing headers/footers")
+    return parser
+
+
 def add_workset_path(parser=None):
     if parser is None:
         parser = ArgumentParser()
@@ -98,6 +185,12 @@ def main():
         help="Download HathiTrust volumes to disk [requires auth]")
     download_parser(parser_download)
     parser_download.set_defaults(func='download')
+
+    # Header/footer removal helper
+    parser_clean = parsers.add_parser('clean',
+        help="Remove headers and footers from downloaded HathiTrust volumes")
+    clean_parser(parser_clean)
+    parser_clean.set_defaults(func='clean')
     
     
     # Run helper
@@ -144,8 +237,20 @@ def main():
             htrc.tools.mallet.main(args.path, args.k, args.iter)
         # if args.run == 'topicexplorer':
         #     htrc.tools.topicexplorer.main(args.path, args.k, args.iter)
+    elif args.func == 'clean':
+        if not os.path.isdir(args.input):
+            print("Folder {} does not exist.".format(args.input))
+            sys.exit(1)
+        try:
+            htrc.volumes.clean(args)
+        except ValueError as e:
+            print(e)
+            sys.exit(1)
     elif args.func == 'download':
-        if os.path.exists(args.output):
+        if args.resume and args.force:
+            print("Cannot set both resume and force")
+            sys.exit(1)
+        if os.path.exists(args.output) and not args.resume:
             if args.force or bool_prompt('Folder {} exists. Delete?'.format(args.output), default=False):
                 shutil.rmtree(args.output)
                 os.makedirs(args.output)
@@ -0,0 +1,271 @@
+# cython: language_level=3, boundscheck=False, wraparound=False, cdivision=True
+"""
+`htrc.hf_utils._speedups`
+
+Contains compiled versions of the functions of `htrc.hf_utils.pure` which
+dominate the run time of the header/footer detection. Each of them returns
+exactly what its pure-Python counterpart returns.
+"""
+from libc.stdint cimport uint64_t
+from libc.stdlib cimport free, malloc
+
+cdef extern from "Python.h":
+    int PyUnicode_4BYTE_KIND
+    object PyUnicode_FromKindAndData(int kind, const void *buffer, Py_ssize_t size)
+
+
+cdef Py_UCS4 *_to_ucs4(str s) except NULL:
+    cdef Py_ssize_t i
+    cdef Py_UCS4 *chars = <Py_UCS4 *> malloc((len(s) + 1) * sizeof(Py_UCS4))
+    if chars is NULL:
+        raise MemoryError()
+    for i in range(len(s)):
+        chars[i] = s[i]
+
+    return chars
+
+
+cpdef str clean_text(str s):
+    # a letter is a character matched by \w but not by [\d_], i.e. alphanumeric but not a decimal digit
+    cdef Py_ssize_t length = 0
+    cdef bint separate = False
+    cdef Py_UCS4 c
+    cdef Py_UCS4 *chars = <Py_UCS4 *> malloc((len(s) + 1) * sizeof(Py_UCS4))
+    if chars is NULL:
+        raise MemoryError()
+
+    try:
+        for c in s:
+            if c.isalnum() and not c.isdecimal():
+                # runs of other characters between letters become a single whitespace
+                if separate and length:
+                    chars[length] = u' '
+                    length += 1
+                separate = False
+                chars[length] = c
+                length += 1
+            else:
+                separate = True
+
+        return PyUnicode_FromKindAndData(PyUnicode_4BYTE_KIND, chars, length).lower()
+    finally:
+        free(chars)
+
+
+cpdef long levenshtein(str s, str t, long insert_cost=1, long delete_cost=1, long replace_cost=1) except -1:
+    if s == t:
+        return 0
+
+    cdef Py_ssize_t len0 = len(s), len1 = len(t), i, j
+    if not len0:
+        return len1
+    if not len1:
+        return len0
+
+    cdef Py_UCS4 *s_chars = _to_ucs4(s)
+    cdef Py_UCS4 *t_chars = NULL
+    cdef long *v0 = NULL
+    cdef long *v1 = NULL
+    cdef long *swap
+    cdef long cost_insert, cost_delete, cost_replace
+
+    try:
+        t_chars = _to_ucs4(t)
+        v0 = <long *> malloc((len0 + 1) * sizeof(long))
+        v1 = <long *> malloc((len0 + 1) * sizeof(long))
+        if v0 is NULL or v1 is NULL:
+            raise MemoryError()
+
+        for i in range(len0 + 1):
+            v0[i] = i
+
+        for j in range(len1):
+            v1[0] = j + 1
+            for i in range(len0):
+                cost_insert = v0[i + 1] + insert_cost
+                cost_delete = v1[i] + delete_cost
+                cost_replace = v0[i] + (0 if s_chars[i] == t_chars[j] else replace_cost)
+                v1[i + 1] = min(cost_insert, cost_delete, cost_replace)
+            swap = v0
+            v0 = v1
+            v1 = swap
+
+        return v0[len0]
+    finally:
+        free(s_chars)
+        free(t_chars)
+        free(v0)
+        free(v1)
+
+
+cdef long _myers_within(const Py_UCS4 *s, Py_ssize_t len0, const Py_UCS4 *t, Py_ssize_t len1, long max_distance):
+    # bit-parallel distance for a pattern `s` of at most 64 letters, see `htrc.hf_utils.pure.levenshtein_within`
+    cdef uint64_t ascii_peq[128]
+    cdef Py_UCS4 other_chars[64]
+    cdef uint64_t other_peq[64]
+    cdef Py_ssize_t num_other = 0, i, j, k
+    cdef uint64_t mask = (<uint64_t> -1) if len0 == 64 else ((<uint64_t> 1) << len0) - 1
+    cdef uint64_t last = (<uint64_t> 1) << (len0 - 1)
+    cdef uint64_t pv = mask, mv = 0, eq, xv, xh, ph, mh
+    cdef long distance = len0
+    cdef Py_UCS4 c
+
+    for i in range(128):
+        ascii_peq[i] = 0
+    for i in range(len0):
+        c = s[i]
+        if c < 128:
+            ascii_peq[c] |= (<uint64_t> 1) << i
+        else:
+            for k in range(num_other):
+                if other_chars[k] == c:
+                    break
+            else:
+                k = num_other
+                other_chars[k] = c
+                other_peq[k] = 0
+                num_other += 1
+            other_peq[k] |= (<uint64_t> 1) << i
+
+    for j in range(len1):
+        c = t[j]
+        eq = 0
+        if c < 128:
+            eq = ascii_peq[c]
+        else:
+            for k in range(num_other):
+                if other_chars[k] == c:
+                    eq = other_peq[k]
+                    break
+
+        xv = eq | mv
+        xh = (((eq & pv) + pv) ^ pv) | eq
+        ph = mv | (~(xh | pv) & mask)
+        mh = pv & xh
+
+        if ph & last:
+            distance += 1
+        elif mh & last:
+            distance -= 1
+
+        if distance - (len1 - j - 1) > max_distance:
+            return max_distance + 1
+
+        ph = ((ph << 1) | 1) & mask
+        mh = (mh << 1) & mask
+        pv = mh | (~(xv | ph) & mask)
+        mv = ph & xv
+
+    return distance if distance <= max_distance else max_distance + 1
+
+
+cdef long _dp_within(const Py_UCS4 *s, Py_ssize_t len0, const Py_UCS4 *t, Py_ssize_t len1,
+                     long max_distance) except -2:
+    # the minimum of a row of the distance matrix never decreases in the following rows
+    cdef long *v0 = <long *> malloc((len0 + 1) * sizeof(long))
+    cdef long *v1 = <long *> malloc((len0 + 1) * sizeof(long))
+    cdef long *swap
+    cdef long row_min
+    cdef Py_ssize_t i, j
+
+    try:
+        if v0 is NULL or v1 is NULL:
+            raise MemoryError()
+
+        for i in range(len0 + 1):
+            v0[i] = i
+
+        for j in range(len1):
+            v1[0] = row_min = j + 1
+            for i in range(len0):
+                v1[i + 1] = min(v0[i + 1] + 1, v1[i] + 1, v0[i] + (0 if s[i] == t[j] else 1))
+                if v1[i + 1] < row_min:
+                    row_min = v1[i + 1]
+            if row_min > max_distance:
+                return max_distance + 1
+            swap = v0
+            v0 = v1
+            v1 = swap
+
+        return v0[len0] if v0[len0] <= max_distance else max_distance + 1
+    finally:
+        free(v0)
+        free(v1)
+
+
+cpdef long levenshtein_within(str s, str t, long max_distance) except -2:
+    if s == t:
+        return 0
+
+    cdef Py_ssize_t len0 = len(s), len1 = len(t)
+
+    if abs(len0 - len1) > max_distance:
+        return max_distance + 1
+
+    if not len0 or not len1:
+        return max(len0, len1)
+
+    if len0 > len1:
+        # the distance is symmetric, and the shorter string is the pattern
+        s, t = t, s
+        len0, len1 = len1, len0
+
+    cdef Py_UCS4 *s_chars = _to_ucs4(s)
+    cdef Py_UCS4 *t_chars = NULL
+    try:
+        t_chars = _to_ucs4(t)
+        if len0 <= 64:
+            return _myers_within(s_chars, len0, t_chars, len1, max_distance)
+        return _dp_within(s_chars, len0, t_chars, len1, max_distance)
+    finally:
+        free(s_chars)
+        free(t_chars)
+
+
+cdef inline Py_ssize_t _find(Py_ssize_t *parents, Py_ssize_t x):
+    while parents[x] != x:
+        parents[x] = parents[parents[x]]
+        x = parents[x]
+
+    return x
+
+
+cpdef list union_find_clusters(Py_ssize_t num_items, pairs):
+    cdef Py_ssize_t *parents = <Py_ssize_t *> malloc((num_items + 1) * sizeof(Py_ssize_t))
+    cdef Py_ssize_t *sizes = <Py_ssize_t *> malloc((num_items + 1) * sizeof(Py_ssize_t))
+    cdef Py_ssize_t x, x1, x2, root1, root2
+    cdef dict clusters = {}
+
+    try:
+        if parents is NULL or sizes is NULL:
+            raise MemoryError()
+
+        for x in range(num_items):
+            parents[x] = x
+            sizes[x] = 1
+
+        for pair in pairs:
+            x1, x2 = pair
+            if not (0 <= x1 < num_items and 0 <= x2 < num_items):
+                raise IndexError("array index out of range")
+            root1 = _find(parents, x1)
+            root2 = _find(parents, x2)
+            if root1 != root2:
+                if sizes[root1] < sizes[root2]:
+                    root1, root2 = root2, root1
+                parents[root2] = root1
+                sizes[root1] += sizes[root2]
+
+        for x in range(num_items):
+            root1 = _find(parents, x)
+            if sizes[root1] > 1:
+                cluster = clusters.get(root1)
+                if cluster is None:
+                    clusters[root1] = [x]
+                else:
+                    cluster.append(x)
+
+        return list(clusters.values())
+    finally:
+        free(parents)
+        free(sizes)
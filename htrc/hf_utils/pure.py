@@ -0,0 +1,347 @@
+"""
+`htrc.hf_utils.pure`
+
+Contains the pure-Python implementations of the functions of `htrc.hf_utils`,
+which are used when the compiled extension `htrc.hf_utils._speedups` is not
+available.
+"""
+from array import array
+import random
+import re
+from typing import TypeVar, Dict, List, Iterable, Iterator, Tuple, Callable
+import zlib
+
+T = TypeVar('T')
+
+
+def clean_text(s: str) -> str:
+    # replace all characters which aren't letters with whitespaces ([\W\d_] is equivalent of \P{L} which is unsupported)
+    s = re.sub(r'[\W\d_]+', " ", s, flags=re.UNICODE)
+    # replace multiple sequential whitespaces with single whitespace
+    s = re.sub(r'\s{2,}', " ", s, flags=re.UNICODE)
+    # trim whitespaces at the beginning and end
+    s = s.strip()
+    # lowercase
+    s = s.lower()
+
+    return s
+
+
+def levenshtein(s: str, t: str, insert_cost: int = 1, delete_cost: int = 1, replace_cost: int = 1) -> int:
+    """ From Wikipedia article; Iterative with two matrix rows. """
+    # degenerate cases
+    if s == t:
+        return 0
+
+    len0 = len(s)
+    len1 = len(t)
+
+    if not len0:
+        return len1
+
+    if not len1:
+        return len0
+
+    # the array of distances
+    v0 = [0] * (len0 + 1)
+    v1 = [0] * (len0 + 1)
+
+    # initial cost of skipping prefix in s
+    for i in range(len(v0)):
+        v0[i] = i
+
+    # dynamically compute the array of distances
+
+    # transformation cost for each letter in t
+    for j in range(len1):
+        # initial cost of skipping prefix in t
+        v1[0] = j + 1
+
+        # transformation cost for each letter in s
+        for i in range(len0):
+            # matching current letters in both strings
+            match = 0 if s[i] == t[j] else 1
+
+            # computing cost for each transformation
+            cost_insert = v0[i + 1] + insert_cost
+            cost_delete = v1[i] + delete_cost
+            cost_replace = v0[i] + match * replace_cost
+
+            # keep minimum cost
+            v1[i + 1] = min(cost_insert, cost_delete, cost_replace)
+
+        # swap cost arrays
+        v0, v1 = v1, v0
+
+    # the distance is the cost for transforming all letters in both strings
+    return v0[len0]
+
+
+def max_edit_distance(len0: int, len1: int, min_similarity_ratio: float) -> int:
+    """
+    Returns the largest edit distance between strings of lengths `len0` and
+    `len1` (not both empty) for which their similarity ratio,
+    `1 - distance / max(len0, len1)`, still reaches `min_similarity_ratio`, or
+    -1 if no distance does.
+    """
+    max_len = max(len0, len1)
+    max_distance = min(max(int((1 - min_similarity_ratio) * max_len), -1), max_len)
+    # the ratio is compared exactly as `1 - float(distance) / max_len >= min_similarity_ratio` would be
+    while max_distance < max_len and 1 - float(max_distance + 1) / max_len >= min_similarity_ratio:
+        max_distance += 1
+    while max_distance >= 0 and not 1 - float(max_distance) / max_len >= min_similarity_ratio:
+        max_distance -= 1
+
+    return max_distance
+
+
+def levenshtein_within(s: str, t: str, max_distance: int) -> int:
+    """
+    Returns the Levenshtein distance between `s` and `t` if it is at most
+    `max_distance`, or `max_distance + 1` otherwise.
+
+    Pairs whose lengths differ by more than `max_distance` are rejected right
+    away. Otherwise the bit-parallel algorithm of Myers (as formulated by
+    Hyyrö) computes a column of the distance matrix per letter of `t`, and
+    stops as soon as the letters left in `t` can no longer bring the distance
+    back within `max_distance`.
+    """
+    if s == t:
+        return 0
+
+    len0 = len(s)
+    len1 = len(t)
+
+    if abs(len0 - len1) > max_distance:
+        return max_distance + 1
+
+    if not len0 or not len1:
+        return max(len0, len1)
+
+    # bit i of peq[c] is set if s[i] == c
+    peq = {}
+    for i, c in enumerate(s):
+        peq[c] = peq.get(c, 0) | (1 << i)
+
+    mask = (1 << len0) - 1
+    last = 1 << (len0 - 1)
+    # vertical deltas of the current column: +1 (pv), -1 (mv) or 0
+    pv = mask
+    mv = 0
+    distance = len0
+
+    for j, c in enumerate(t):
+        eq = peq.get(c, 0)
+        xv = eq | mv
+        xh = (((eq & pv) + pv) ^ pv) | eq
+        ph = mv | (~(xh | pv) & mask)
+        mh = pv & xh
+
+        if ph & last:
+            distance += 1
+        elif mh & last:
+            distance -= 1
+
+        # the distance can decrease by at most 1 per letter left in `t`
+        if distance - (len1 - j - 1) > max_distance:
+            return max_distance + 1
+
+        ph = ((ph << 1) | 1) & mask
+        mh = (mh << 1) & mask
+        pv = mh | (~(xv | ph) & mask)
+        mv = ph & xv
+
+    return distance if distance <= max_distance else max_distance + 1
+
+
+def union_find_clusters(num_items: int, pairs: Iterable[Tuple[int, int]]) -> List[List[int]]:
+    """
+    Returns the clusters of the items `0` to `num_items - 1` connected by
+    `pairs` (i.e. the connected components of the graph whose edges are
+    `pairs`), leaving out the items which are not connected to any other.
+
+    The components are found with a union-find over arrays of parents and sizes,
+    with path halving and union by size. Each cluster lists its items in
+    increasing order, and the clusters are ordered by their first item.
+    """
+    parents = array('l', range(num_items))
+    sizes = array('l', [1]) * num_items
+
+    def find(x: int) -> int:
+        while parents[x] != x:
+            parents[x] = parents[parents[x]]
+            x = parents[x]
+
+        return x
+
+    for x1, x2 in pairs:
+        root1, root2 = find(x1), find(x2)
+        if root1 != root2:
+            if sizes[root1] < sizes[root2]:
+                root1, root2 = root2, root1
+            parents[root2] = root1
+            sizes[root1] += sizes[root2]
+
+    clusters = {}
+    for x in range(num_items):
+        root = find(x)
+        if sizes[root] > 1:
+            clusters.setdefault(root, []).append(x)
+
+    return list(clusters.values())
+
+
+# letter histograms are packed into the 16-bit fields of an int: one for each of 'a' to 'z', one for whitespace, and
+# five shared by all other letters (which can only overestimate the letters two strings have in common)
+_NUM_FIELDS = 32
+_FIELD_BITS = 16
+_GUARD_BITS = sum(1 << (_FIELD_BITS * i + _FIELD_BITS - 1) for i in range(_NUM_FIELDS))
+_FIELD_ONES = {c: 1 << (_FIELD_BITS * i) for i, c in enumerate('abcdefghijklmnopqrstuvwxyz ')}
+
+
+def letter_histogram(s: str) -> int:
+    """
+    Returns the histogram of the letters of `s` packed into an int, from which
+    `common_letters` counts the letters two strings have in common, or -1 if `s`
+    is too long for the counts to fit.
+    """
+    if len(s) >= 1 << (_FIELD_BITS - 1):
+        return -1
+
+    histogram = 0
+    for c in s:
+        one = _FIELD_ONES.get(c)
+        histogram += one if one is not None else 1 << (_FIELD_BITS * (27 + ord(c) % 5))
+
+    return histogram
+
+
+def common_letters(histogram0: int, histogram1: int) -> int:
+    """
+    Returns (an upper bound of) the number of letters two strings have in
+    common, counting repeated letters as often as they occur in both, from their
+    `letter_histogram`.
+    """
+    # the guard bit of a field is set where the count of `histogram0` is at least that of `histogram1`
+    at_least = ((histogram0 | _GUARD_BITS) - histogram1) & _GUARD_BITS
+    at_least -= at_least >> (_FIELD_BITS - 1)
+    minimum = (histogram1 & at_least) | (histogram0 & ~at_least)
+
+    # the sum of the fields, which is less than 2 ** 15
+    return minimum % ((1 << _FIELD_BITS) - 1)
+
+
+def min_common_letters(len0: int, len1: int, max_distance: int) -> int:
+    """
+    Returns the least number of letters that strings of lengths `len0` and
+    `len1` have in common if their edit distance is at most `max_distance`: each
+    edit operation changes at most one of the letters of the longer string.
+    """
+    return max(len0, len1) - max_distance
+
+
+# the hash functions of MinHash signatures are of the form (a * x + b) mod _MINHASH_PRIME
+_MINHASH_PRIME = (1 << 61) - 1
+
+
+def _minhash_functions(num_hashes: int, seed: int = 0) -> List[Tuple[int, int]]:
+    rng = random.Random(seed)
+    return [(rng.randrange(1, _MINHASH_PRIME), rng.randrange(_MINHASH_PRIME)) for _ in range(num_hashes)]
+
+
+def minhash_signature(s: str, hash_functions: List[Tuple[int, int]], q: int = 2,
+                      shingle_hashes: Dict[str, Tuple[int, ...]] = None) -> Tuple[int, ...]:
+    """
+    Returns the MinHash signature of the set of q-grams of `s`: two strings
+    have the same value at each position of their signatures with a
+    probability equal to the Jaccard similarity of their sets of q-grams.
+
+    The hashes of each q-gram are memoized in `shingle_hashes`, if given, which
+    pays off when signing many strings over a small alphabet.
+    """
+    if shingle_hashes is None:
+        shingle_hashes = {}
+
+    hashes = []
+    for shingle in {s[i:i + q] for i in range(max(len(s) - q + 1, 1))}:
+        shingle_hash = shingle_hashes.get(shingle)
+        if shingle_hash is None:
+            x = zlib.crc32(shingle.encode('utf-8'))
+            shingle_hash = shingle_hashes[shingle] = tuple((a * x + b) % _MINHASH_PRIME for a, b in hash_functions)
+        hashes.append(shingle_hash)
+
+    return tuple(map(min, zip(*hashes)))
+
+
+def lsh_candidate_pairs(texts: List[str], positions: List[int] = None, max_gap: int = None, num_bands: int = 10,
+                        rows_per_band: int = 2, q: int = 2) -> Iterator[Tuple[int, int]]:
+    """
+    Yields the pairs `(i, j)`, with `i < j`, of indexes of `texts` which are
+    likely similar: those whose MinHash signatures are the same in all
+    `rows_per_band` rows of at least one of `num_bands` bands. Each pair is
+    yielded once.
+
+    If `positions` is given (in increasing order, e.g. the page of each text),
+    only pairs whose positions differ and are less than `max_gap` apart (if
+    set) are yielded.
+    """
+    hash_functions = _minhash_functions(num_bands * rows_per_band)
+    shingle_hashes = {}
+    buckets = {}
+    for index, text in enumerate(texts):
+        signature = minhash_signature(text, hash_functions, q, shingle_hashes)
+        for band in range(num_bands):
+            key = (band,) + signature[band * rows_per_band:(band + 1) * rows_per_band]
+            buckets.setdefault(key, []).append(index)
+
+    seen = set()
+    for bucket in buckets.values():
+        for n, i in enumerate(bucket):
+            for j in bucket[n + 1:]:
+                if positions is not None:
+                    if max_gap is not None and positions[j] - positions[i] >= max_gap:
+                        # the indexes of a bucket are in increasing order, and so are their positions
+                        break
+                    if positions[j] == positions[i]:
+                        continue
+                if (i, j) not in seen:
+                    seen.add((i, j))
+                    yield i, j
+
+
+def pairwise_combine_within_distance(xs: List[T], n: int) -> List[Tuple[T, T]]:
+    result = []
+    for i, x in enumerate(xs):
+        following = xs[i + 1:i + n] if n > 0 else xs[i + 1:][:n - 1]
+        result.extend((x, v) for v in following)
+
+    return result
+
+
+def group_consecutive_when(xs: List[T], pred: Callable[[T, T], bool]) -> Iterator[List[T]]:
+    result = []
+    _prev, _next = None, None
+
+    while len(xs) > 1:
+        _prev, _next = xs[0], xs[1]
+        result.append(_prev)
+        if not pred(_prev, _next):
+            yield result
+            result = []
+        xs = xs[1:]
+
+    if len(xs) == 1:
+        _prev, _next = _next, xs[0]
+
+    if _prev is not None and _next is not None and pred(_prev, _next):
+        result.extend([_prev, _next])
+    elif _next is not None:
+        result.append(_next)
+
+    yield result
+
+
+def flatten(xss: List[tuple]) -> Iterator[T]:
+    for xs in xss:
+        for x in xs:
+            yield x
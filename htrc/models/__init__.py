@@ -1,6 +1,17 @@
 import os
 from abc import ABC, abstractmethod
-from typing import List
+from io import BytesIO, TextIOWrapper
+from typing import List, Union
+
+
+def decode_lines(data: Union[bytes, memoryview]) -> List[str]:
+    """
+    Returns the lines of the UTF-8 encoded text of a page, without their trailing
+    whitespace. Lines are split at universal newlines, as when reading a text file,
+    but not at the other line boundaries of `str.splitlines` (e.g. form feeds).
+    """
+    with TextIOWrapper(BytesIO(data), encoding='utf-8') as text:
+        return [line.rstrip() for line in text.readlines()]
 
 
 class Page(ABC):
@@ -66,3 +77,14 @@ class HtrcPage(Page):
     @property
     def text_lines(self) -> List[str]:
         return self._lines
+
+
+class HtrcStructuredPage(HtrcPage, PageStructure):
+    """
+    A page whose header and footer lines have been identified, e.g. by
+    `htrc.runningheaders.parse_page_structure`.
+    """
+    def __init__(self, lines: List[str], num_header_lines: int = 0, num_footer_lines: int = 0) -> None:
+        HtrcPage.__init__(self, lines)
+        self.num_header_lines = num_header_lines
+        self.num_footer_lines = num_footer_lines
@@ -1,163 +1,218 @@
 import re
-from collections import defaultdict
-from typing import List, TypeVar, Set, Iterator, Optional, Tuple, Dict
+from array import array
+from collections import Counter
+from typing import List, TypeVar, Iterable, Iterator, Optional, Tuple, Dict
 
 from htrc.models import Page, PageStructure
-from htrc.hf_utils import clean_text, levenshtein, pairwise_combine_within_distance, flatten, group_consecutive_when
+from htrc.hf_utils import clean_text, common_letters, letter_histogram, levenshtein_within, lsh_candidate_pairs, \
+    max_edit_distance, min_common_letters, pairwise_combine_within_distance, group_consecutive_when, \
+    union_find_clusters
 
 T = TypeVar('T', bound=Page)
 U = TypeVar('U', bound=PageStructure)
 
-
-class _Line:
-    def __init__(self, text: str, line_number: int, page: Page) -> None:
-        self.text = text
-        self.line_number = line_number
-        self.page = page
-        self.cleaned_text = clean_text(text)
-
-    def __eq__(self, o: object) -> bool:
-        if not isinstance(o, _Line):
-            raise NotImplemented
-
-        are_equal = self.page is o.page and self.line_number == o.line_number
-
-        return are_equal
-
-    def __ne__(self, o: object) -> bool:
-        return not self == o
-
-    def __hash__(self) -> int:
-        line_hash = hash(self.line_number)
-        page_hash = hash(self.page)
-        hash_value = 31 * line_hash + page_hash
-
-        return hash_value
-
-    def __str__(self) -> str:
-        return str((self.line_number, self.cleaned_text))
-
-    def similarity_ratio(self, line: '_Line') -> float:
-        ratio = 1 - float(levenshtein(self.cleaned_text, line.cleaned_text)) / max(len(self.cleaned_text),
-                                                                                   len(line.cleaned_text))
-
-        return ratio
+CANDIDATE_MODES = ('window', 'lsh')
+
+
+class _LineTable:
+    """
+    The candidate header (or footer) lines of the pages of a volume, stored by
+    column and identified by their index in the columns. The lines of a page
+    have consecutive ids, pages are in order, and the lines of page `i` are
+    those from `page_starts[i]` up to `page_starts[i + 1]`.
+    """
+    __slots__ = ('page_indexes', 'line_numbers', 'cleaned_texts', 'histograms', 'page_starts')
+
+    def __init__(self) -> None:
+        self.page_indexes = array('l')
+        self.line_numbers = array('l')
+        self.cleaned_texts = []
+        # the letter histograms are computed on first use, since only the lines of some pairs are compared
+        self.histograms = []
+        self.page_starts = array('l', [0])
+
+    def __len__(self) -> int:
+        return len(self.cleaned_texts)
+
+    def add_page(self, page_index: int, lines: Iterable[Tuple[int, str]]) -> None:
+        """
+        Adds the `(line_number, cleaned_text)` lines of the next page.
+        """
+        for line_number, cleaned_text in lines:
+            # ignore lines that are <4 characters long and/or have no alphabetic characters
+            if len(cleaned_text) < 4:
+                continue
+            self.page_indexes.append(page_index)
+            self.line_numbers.append(line_number)
+            self.cleaned_texts.append(cleaned_text)
+            self.histograms.append(None)
+        self.page_starts.append(len(self.cleaned_texts))
+
+    def page_lines(self) -> List[range]:
+        """
+        Returns the range of the ids of the lines of each page.
+        """
+        return [range(start, end) for start, end in zip(self.page_starts, self.page_starts[1:])]
+
+    def histogram(self, line_id: int) -> int:
+        histogram = self.histograms[line_id]
+        if histogram is None:
+            histogram = self.histograms[line_id] = letter_histogram(self.cleaned_texts[line_id])
+
+        return histogram
 
 
 def parse_page_structure(pages: List[T],
-                         window_size: int = 6,
+                         window_size: Optional[int] = 6,
                          min_similarity_ratio: float = 0.7,
                          min_cluster_size: int = 3,
                          max_header_lines: int = 3,
-                         max_footer_lines: int = 3) -> List[U]:
-    def _get_page_lines(p: T) -> List[_Line]:
-        return [_Line(text, line_num, p) for line_num, text in enumerate(p.text_lines)]
-
-    def _cluster_lines(lines: List[Tuple[_Line, _Line]]) -> Set[tuple]:
-        cluster_map = {}
-
-        for l1, l2 in lines:
-            c1 = cluster_map.get(l1)
-            c2 = cluster_map.get(l2)
-
-            if c1 is not None and c2 is not None and c1 is not c2:
-                smaller, larger = (c1, c2) if len(c1) < len(c2) else (c2, c1)
-                larger.extend(smaller)
-                for x in smaller:
-                    cluster_map[x] = larger
-            elif c1 is not None and c2 is None:
-                c1.append(l2)
-                cluster_map[l2] = c1
-            elif c1 is None and c2 is not None:
-                c2.append(l1)
-                cluster_map[l1] = c2
-            elif c1 is None and c2 is None:
-                c = [l1, l2]
-                cluster_map[l1] = c
-                cluster_map[l2] = c
-
-        return set(map(tuple, cluster_map.values()))
-
-    def _group_lines_by_page(lines: Iterator[_Line]) -> Dict[Page, List[_Line]]:
-        lines_grouped_by_page = defaultdict(list)
-        for line in lines:
-            lines_grouped_by_page[line.page].append(line)
-
-        return lines_grouped_by_page
-
-    def _get_last_header_line(lines: List[_Line]) -> Optional[int]:
-        if not lines:
-            return None
-
-        return max(l.line_number for l in lines)
-
-    def _get_first_footer_line(lines: List[_Line]) -> Optional[int]:
-        if not lines:
-            return None
-
-        return min(l.line_number for l in lines)
-
-    def _extract_line_numbers(line: _Line) -> Tuple[_Line, List[int]]:
-        numbers = [int(match.group(0)) for match in
-                   re.finditer(r"(?:(?<=^)|(?<=\s))\d{1,4}(?=\s|$)", line.text, flags=re.UNICODE)]
-
-        return line, numbers
-
-    def _extract_potential_page_numbers(lines: List[_Line]) -> Tuple[_Line, List[int]]:
+                         max_footer_lines: int = 3,
+                         match_stats: Optional[Dict[str, int]] = None,
+                         candidates: str = 'window',
+                         lsh_bands: int = 10,
+                         lsh_rows: int = 2) -> List[U]:
+    """
+    Identifies the header and footer lines of `pages`, by clustering the lines
+    at the top and bottom of pages within `window_size` pages of each other
+    whose similarity ratio reaches `min_similarity_ratio`.
+
+    Candidate pairs of lines go through increasingly expensive stages: pairs
+    whose lengths differ by more than the largest edit distance which reaches
+    the ratio are dropped, then pairs which do not have enough letters in common
+    for their edit distance to be within it, and only the remaining pairs have their
+    edit distance computed. If `match_stats` is given (e.g. a `Counter`), the
+    number of `pairs`, of pairs `pruned_by_length` and `pruned_by_histogram`, of
+    pairs `compared` and of `similar` pairs are added to it.
+
+    With `candidates='window'` every line is paired with every line of the
+    following pages in the window, so the number of pairs grows with the window
+    size. With `candidates='lsh'` lines are bucketed by the MinHash signatures of
+    the 2-grams of their cleaned text (see `htrc.hf_utils.lsh_candidate_pairs`),
+    and only lines sharing a bucket in one of `lsh_bands` bands of `lsh_rows`
+    rows are paired, which makes large windows affordable; a `window_size` of
+    `None` (or 0) then pairs lines across the whole volume. Similar lines are likely,
+    but not certain, to share a bucket: more bands or fewer rows per band miss
+    fewer of them, at the cost of more pairs.
+
+    Only the candidate lines are kept, in a table of the header lines and one of
+    the footer lines, and the clusters are found with a union-find over their ids.
+    """
+    if candidates not in CANDIDATE_MODES:
+        raise ValueError("Unknown candidate mode {!r}, expected one of {}".format(candidates, CANDIDATE_MODES))
+    if window_size is None and candidates != 'lsh':
+        raise ValueError("window_size can only be None with candidates='lsh'")
+
+    stats = Counter()
+
+    def _window_pairs(table: _LineTable) -> Iterator[Tuple[int, int]]:
+        for ids1, ids2 in pairwise_combine_within_distance(table.page_lines(), window_size):
+            for id1 in ids1:
+                for id2 in ids2:
+                    yield id1, id2
+
+    def _lsh_pairs(table: _LineTable) -> Iterator[Tuple[int, int]]:
+        return lsh_candidate_pairs(table.cleaned_texts, table.page_indexes, window_size or None, lsh_bands, lsh_rows)
+
+    def _similar_lines(table: _LineTable, line_pairs: Iterable[Tuple[int, int]]) -> List[Tuple[int, int]]:
+        cleaned_texts = table.cleaned_texts
+        similar_lines = []
+        for id1, id2 in line_pairs:
+            len1 = len(cleaned_texts[id1])
+            len2 = len(cleaned_texts[id2])
+            max_distance = max_edit_distance(len1, len2, min_similarity_ratio)
+            if abs(len1 - len2) > max_distance:
+                stats['pruned_by_length'] += 1
+                continue
+
+            histogram1, histogram2 = table.histogram(id1), table.histogram(id2)
+            if histogram1 >= 0 and histogram2 >= 0 and \
+                    common_letters(histogram1, histogram2) < min_common_letters(len1, len2, max_distance):
+                stats['pruned_by_histogram'] += 1
+                continue
+
+            stats['compared'] += 1
+            if levenshtein_within(cleaned_texts[id1], cleaned_texts[id2], max_distance) <= max_distance:
+                similar_lines.append((id1, id2))
+
+        return similar_lines
+
+    def _cluster_lines(table: _LineTable, similar_lines: List[Tuple[int, int]]) -> List[List[int]]:
+        return [cluster for cluster in union_find_clusters(len(table), similar_lines)
+                if len(cluster) >= min_cluster_size]
+
+    def _extract_line_numbers(text: str) -> List[int]:
+        return [int(match.group(0)) for match in
+                re.finditer(r"(?:(?<=^)|(?<=\s))\d{1,4}(?=\s|$)", text, flags=re.UNICODE)]
+
+    def _extract_potential_page_numbers(lines: List[str]) -> Tuple[int, List[int]]:
         assert len(lines) > 0
-        line, numbers = _extract_line_numbers(lines[-1])
-        if not numbers and not str.strip(line.text) and len(lines) > 1:
-            line, numbers = _extract_line_numbers(lines[-2])
-
-        return line, numbers
-
-    candidate_header_lines = []
-    candidate_footer_lines = []
-
-    pages_lines = [_get_page_lines(p) for p in pages]
-
-    for lines in pages_lines:
-        # ignore lines that are <4 characters long and/or have no alphabetic characters
-        candidate_header_lines.append([l for l in lines[:max_header_lines] if not len(l.cleaned_text) < 4])
-        candidate_footer_lines.append([l for l in lines[-max_footer_lines:] if not len(l.cleaned_text) < 4])
-
-    headers_for_comparison = pairwise_combine_within_distance(candidate_header_lines, window_size)
-    footers_for_comparison = pairwise_combine_within_distance(candidate_footer_lines, window_size)
-
-    header_line_similarities = []
-    for (lines1, lines2) in headers_for_comparison:
-        header_line_similarities.extend(
-            (l1, l2) for l1 in lines1 for l2 in lines2 if l1.similarity_ratio(l2) >= min_similarity_ratio)
-
-    footer_line_similarities = []
-    for (lines1, lines2) in footers_for_comparison:
-        footer_line_similarities.extend(
-            (l1, l2) for l1 in lines1 for l2 in lines2 if l1.similarity_ratio(l2) >= min_similarity_ratio)
-
-    header_clusters = [cluster for cluster in _cluster_lines(header_line_similarities) if
-                       len(cluster) >= min_cluster_size]
-    footer_clusters = [cluster for cluster in _cluster_lines(footer_line_similarities) if
-                       len(cluster) >= min_cluster_size]
-
-    if not footer_clusters:
-        potential_page_numbers = [_extract_potential_page_numbers(lines) for lines in pages_lines if lines]
-        potential_page_numbers = [(line, numbers[0]) for line, numbers in potential_page_numbers if len(numbers) == 1]
-        potential_clusters = map(lambda group: tuple(map(lambda t: t[0], group)),
-                                 group_consecutive_when(potential_page_numbers, lambda x, y: y[1] - x[1] == 1))
-        footer_clusters = [cluster for cluster in potential_clusters if len(cluster) >= min_cluster_size]
-
-    header_lines_grouped_by_page = _group_lines_by_page(flatten(header_clusters))
-    footer_lines_grouped_by_page = _group_lines_by_page(flatten(footer_clusters))
-
-    last_header_line_pages_map = {p: _get_last_header_line(lines) for p, lines in header_lines_grouped_by_page.items()}
-    first_footer_line_pages_map = {p: _get_first_footer_line(lines) for p, lines in
-                                   footer_lines_grouped_by_page.items()}
-
-    for page in pages:
-        last_header_line = last_header_line_pages_map.get(page)
-        first_footer_line = first_footer_line_pages_map.get(page)
-        page.__class__ = type('StructuredPage', (page.__class__, PageStructure), {})
-        page.num_header_lines = last_header_line + 1 if last_header_line is not None else 0
-        page.num_footer_lines = len(page.text_lines) - first_footer_line if first_footer_line is not None else 0
+        line_number = len(lines) - 1
+        numbers = _extract_line_numbers(lines[line_number])
+        if not numbers and not str.strip(lines[line_number]) and len(lines) > 1:
+            line_number -= 1
+            numbers = _extract_line_numbers(lines[line_number])
+
+        return line_number, numbers
+
+    pages_lines = [p.text_lines for p in pages]
+
+    header_lines = _LineTable()
+    footer_lines = _LineTable()
+
+    for page_index, lines in enumerate(pages_lines):
+        header_line_numbers = range(len(lines))[:max_header_lines]
+        footer_line_numbers = range(len(lines))[-max_footer_lines:]
+        # the lines of short pages are candidates for both, and are cleaned once
+        cleaned_texts = {line_number: clean_text(lines[line_number])
+                         for line_number in set(header_line_numbers).union(footer_line_numbers)}
+        header_lines.add_page(page_index, ((n, cleaned_texts[n]) for n in header_line_numbers))
+        footer_lines.add_page(page_index, ((n, cleaned_texts[n]) for n in footer_line_numbers))
+
+    candidate_pairs = _lsh_pairs if candidates == 'lsh' else _window_pairs
+    header_line_similarities = _similar_lines(header_lines, candidate_pairs(header_lines))
+    footer_line_similarities = _similar_lines(footer_lines, candidate_pairs(footer_lines))
+    if match_stats is not None:
+        stats['similar'] = len(header_line_similarities) + len(footer_line_similarities)
+        stats['pairs'] = stats['pruned_by_length'] + stats['pruned_by_histogram'] + stats['compared']
+        for key, count in stats.items():
+            match_stats[key] = match_stats.get(key, 0) + count
+
+    # the number of header lines and the first footer line of each page
+    num_header_lines = [0] * len(pages)
+    first_footer_lines = [None] * len(pages)
+
+    for cluster in _cluster_lines(header_lines, header_line_similarities):
+        for line_id in cluster:
+            page_index = header_lines.page_indexes[line_id]
+            num_header_lines[page_index] = max(num_header_lines[page_index], header_lines.line_numbers[line_id] + 1)
+
+    footer_clusters = _cluster_lines(footer_lines, footer_line_similarities)
+    if footer_clusters:
+        footer_clusters = [[(footer_lines.page_indexes[line_id], footer_lines.line_numbers[line_id])
+                            for line_id in cluster] for cluster in footer_clusters]
+    else:
+        potential_page_numbers = [(page_index,) + _extract_potential_page_numbers(lines)
+                                  for page_index, lines in enumerate(pages_lines) if lines]
+        potential_page_numbers = [(page_index, line_number, numbers[0])
+                                  for page_index, line_number, numbers in potential_page_numbers if len(numbers) == 1]
+        potential_clusters = group_consecutive_when(potential_page_numbers, lambda x, y: y[2] - x[2] == 1)
+        footer_clusters = [[(page_index, line_number) for page_index, line_number, _ in cluster]
+                           for cluster in potential_clusters if len(cluster) >= min_cluster_size]
+
+    for cluster in footer_clusters:
+        for page_index, line_number in cluster:
+            first_footer_line = first_footer_lines[page_index]
+            if first_footer_line is None or line_number < first_footer_line:
+                first_footer_lines[page_index] = line_number
+
+    structured_page_classes = {}
+    for page, lines, page_num_header_lines, first_footer_line in zip(pages, pages_lines, num_header_lines,
+                                                                     first_footer_lines):
+        if page.__class__ not in structured_page_classes:
+            structured_page_classes[page.__class__] = type('StructuredPage', (page.__class__, PageStructure), {})
+        page.__class__ = structured_page_classes[page.__class__]
+        page.num_header_lines = page_num_header_lines
+        page.num_footer_lines = len(lines) - first_footer_line if first_footer_line is not None else 0
 
     return pages
@@ -15,18 +15,37 @@ standard_library.install_aliases()
 
 
 #from builtins import input
-from htrc.models import HtrcPage
+from htrc.models import HtrcPage, HtrcStructuredPage, decode_lines
 
 import http.client
-from io import BytesIO, TextIOWrapper
+from htrc.volumes.client import DataApiClient, DataApiError
+from htrc.volumes.batching import AdaptiveBatcher, FetchedBatch, RetryPolicy, fetch_bisecting
+from htrc.volumes.bundle import BUNDLE_FILENAME, BUNDLE_MODES, BundleWriter, WorksetBundle, is_bundle
+from htrc.volumes.cache import VolumeCache, volume_dir
+from htrc.volumes.manifest import CleanManifest, source_signature, volume_pages
+from htrc.volumes.hfreport import HF_REPORT_MODES, WorksetReport, removed_hf_rows, volume_report
+from htrc.volumes.journal import DownloadJournal
+from htrc.volumes.options import DEFAULT_BUFFER_SIZE, DEFAULT_SPOOL_MAX_SIZE, BatchOptions, OutputOptions, \
+    TransferOptions
+from htrc.volumes.reader import REPORT_FILENAMES, MappedPage, WorksetReader
+from htrc.volumes.zipindex import ZipIndex, read_member
+from htrc.volumes.zipstream import StreamedBatch, ZipStreamError, check_member_name, extract_stream, \
+    iter_zip_members
+import htrc.volumes.aio
+from io import BytesIO
+import errno
 import json
 import os.path
 import progressbar
 
 #import re
 import socket
-import ssl
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import shutil
+import threading
+from tempfile import NamedTemporaryFile, SpooledTemporaryFile, mkdtemp
 #import sys
+import time
 #from time import sleep
 #from urllib.request import urlopen
 #from urllib.error import HTTPError
@@ -35,9 +54,10 @@ from urllib.parse import urlencode
 from urllib.parse import urlencode
 from zipfile import ZipFile  # used to decompress requested zip archives.
 from tqdm import tqdm
-from htrc.runningheaders import parse_page_structure
+from htrc.runningheaders import CANDIDATE_MODES, parse_page_structure
 from functools import partial
-import pandas as pd
+from collections import OrderedDict
+from contextlib import ExitStack, closing
 #from htrc.lib.cli import bool_prompt
 from htrc.util import split_items
 import htrc.config
@@ -49,7 +69,88 @@ from logging import NullHandler
 logging.getLogger(__name__).addHandler(NullHandler())
 
 
-def get_volumes(data_api_config: htrc.config.HtrcDataApiConfig, volume_ids, concat=False, mets=False, buffer_size=128):
+# Minimum number of seconds between two progress bar refreshes during a transfer
+DEFAULT_PROGRESS_INTERVAL = 0.5
+
+
+def _transfer(response, out, buffer_size=DEFAULT_BUFFER_SIZE, progress_interval=DEFAULT_PROGRESS_INTERVAL):
+    """
+    Copies the body of `response` to the file-like `out`, reading into a single
+    preallocated buffer, and returns the number of bytes transferred.
+
+    The progress bar is refreshed at most every `progress_interval` seconds rather
+    than on every chunk, and the average throughput is logged once done.
+    """
+    buffer = memoryview(bytearray(buffer_size))
+    bytes_downloaded = 0
+    bar = progressbar.ProgressBar(max_value=progressbar.UnknownLength,
+                                  widgets=[progressbar.AnimatedMarker(), '    ',
+                                           progressbar.DataSize(),
+                                           ' (', progressbar.FileTransferSpeed(), ')'])
+
+    start = last_update = time.monotonic()
+    while True:
+        num_read = response.readinto(buffer)
+        if not num_read:
+            break
+        out.write(buffer[:num_read])
+        bytes_downloaded += num_read
+
+        now = time.monotonic()
+        if now - last_update >= progress_interval:
+            bar.update(bytes_downloaded)
+            last_update = now
+
+    bar.update(bytes_downloaded)
+    bar.finish()
+
+    elapsed = time.monotonic() - start
+    logging.info("Transferred {:,} bytes in {:.2f}s ({:,.0f} bytes/sec)".format(
+        bytes_downloaded, elapsed, bytes_downloaded / elapsed if elapsed else 0))
+
+    return bytes_downloaded
+
+
+def _read_response(response, buffer_size, spool_max_size=None, named_spool=False):
+    """
+    Reads the body of a Data API response, either into memory (returned as bytes)
+    or, if `spool_max_size` is set, into a rewound `SpooledTemporaryFile`, or if
+    `named_spool` is True, into a rewound `NamedTemporaryFile`.
+    """
+    if named_spool:
+        data = NamedTemporaryFile(prefix='htrc-batch-', suffix='.zip')
+    elif spool_max_size is None:
+        data = BytesIO()
+    else:
+        data = SpooledTemporaryFile(max_size=spool_max_size)
+
+    try:
+        _transfer(response, data, buffer_size)
+    except BaseException:
+        data.close()
+        raise
+
+    if spool_max_size is None and not named_spool:
+        return data.getvalue()
+
+    data.seek(0)
+    return data
+
+
+def _buffer_response(response, buffer_size=DEFAULT_BUFFER_SIZE):
+    """
+    Reads the body of a Data API response into a rewound `BytesIO`, which is
+    used as is rather than copied into bytes like `_read_response` does.
+    """
+    data = BytesIO()
+    _transfer(response, data, buffer_size)
+    data.seek(0)
+    return data
+
+
+def get_volumes(data_api_config: htrc.config.HtrcDataApiConfig, volume_ids, concat=False, mets=False,
+                buffer_size=DEFAULT_BUFFER_SIZE, spool_max_size=None, client=None, stream=None,
+                named_spool=False):
     """
     Returns volumes from the Data API as a raw zip stream.
 
@@ -60,12 +161,22 @@ def get_volumes(data_api_config: htrc.config.HtrcDataApiConfig, volume_ids, conc
     file per page (default).
     :host: Data API host
     :port: Data API port
+    :buffer_size: Size in bytes of the buffer the response is read into.
+    :spool_max_size: If set, stream the response into a temporary file which is
+    kept in memory up to this many bytes and rolled over to disk beyond that. The
+    open file, rewound to the start, is returned instead of bytes.
+    :client: A `DataApiClient` whose connections are reused for the request. If
+    not given, a client is created for this request only.
+    :stream: If set, a function which is called with the response while its body
+    is still being received (e.g. `htrc.volumes.zipstream.extract_stream`), and
+    whose return value is returned instead of the body.
+    :named_spool: If True, stream the response into a named temporary file on
+    disk instead, which other processes can open by its `name`. The open file,
+    rewound to the start, is returned instead of bytes.
     """
     if not volume_ids:
         raise ValueError("volume_ids is empty.")
 
-    url = data_api_config.epr + "volumes"
-
     for id in volume_ids:
         if ("." not in id
                 or " " in id):
@@ -81,57 +192,32 @@ def get_volumes(data_api_config: htrc.config.HtrcDataApiConfig, volume_ids, conc
     if mets:
         data['mets'] = 'true'
 
-    # Authorization
-    headers = {"Authorization": "Bearer " + data_api_config.token,
-               "Content-type": "application/x-www-form-urlencoded"}
-
-    # Create SSL lookup
-    # TODO: Fix SSL cert verification
-    ctx = ssl.create_default_context()
-    ctx.check_hostname = False
-    #ctx.verify_mode = ssl.CERT_NONE
+    own_client = client is None
+    if own_client:
+        client = DataApiClient(data_api_config)
 
     # Retrieve the volumes
-    httpsConnection = http.client.HTTPSConnection(
-        data_api_config.host,
-        data_api_config.port,
-        context=ctx,
-        key_file=data_api_config.key,
-        cert_file=data_api_config.cert)
-
-    httpsConnection.request("POST", url, urlencode(data), headers)
-
-    response = httpsConnection.getresponse()
-
-    if response.status is 200:
-        body = True
-        data = BytesIO()
-        bytes_downloaded = 0
-        bar = progressbar.ProgressBar(max_value=progressbar.UnknownLength,
-                                      widgets=[progressbar.AnimatedMarker(), '    ',
-                                               progressbar.DataSize(),
-                                               ' (', progressbar.FileTransferSpeed(), ')'])
-
-        while body:
-            body = response.read(buffer_size)
-            data.write(body)
-            bytes_downloaded += len(body)
-            bar.update(bytes_downloaded)
-
-        data = data.getvalue()
-    else:
-        logging.debug("Unable to get volumes")
-        logging.debug("Response Code: {}".format(response.status))
-        logging.debug("Response: {}".format(response.reason))
-        raise EnvironmentError("Unable to get volumes.")
-
-    if httpsConnection is not None:
-        httpsConnection.close()
+    try:
+        with client.post("volumes", data) as response:
+            if response.status == 200 and stream is not None:
+                data = stream(response)
+            elif response.status == 200:
+                data = _read_response(response, buffer_size, spool_max_size, named_spool)
+            else:
+                logging.debug("Unable to get volumes")
+                logging.debug("Response Code: {}".format(response.status))
+                logging.debug("Response: {}".format(response.reason))
+                raise DataApiError("Unable to get volumes.", response.status)
+    finally:
+        if own_client:
+            client.close()
 
     return data
 
 
-def get_pages(data_api_config: htrc.config.HtrcDataApiConfig, page_ids, concat=False, mets=False, buffer_size=128):
+def get_pages(data_api_config: htrc.config.HtrcDataApiConfig, page_ids, concat=False, mets=False,
+              buffer_size=DEFAULT_BUFFER_SIZE, spool_max_size=None, client=None, stream=None,
+              named_spool=False):
     """
     Returns a ZIP file containing specfic pages.
 
@@ -140,12 +226,15 @@ def get_pages(data_api_config: htrc.config.HtrcDataApiConfig, page_ids, concat=F
     :volume_ids: A list of volume_ids
     :concat: If True, return a single file per volume. If False, return a single
     file per page (default).
+    :buffer_size: See `get_volumes`.
+    :spool_max_size: See `get_volumes`.
+    :client: See `get_volumes`.
+    :stream: See `get_volumes`.
+    :named_spool: See `get_volumes`.
     """
     if not page_ids:
         raise ValueError("page_ids is empty.")
 
-    url = data_api_config.epr + "pages"
-
     for id in page_ids:
         if ("." not in id
                 or " " in id):
@@ -161,53 +250,25 @@ def get_pages(data_api_config: htrc.config.HtrcDataApiConfig, page_ids, concat=F
     elif mets:
         data['mets'] = 'true'
 
-    # Authorization
-    headers = {"Authorization": "Bearer " + data_api_config.token,
-               "Content-type": "application/x-www-form-urlencoded"}
-
-    # Create SSL lookup
-    # TODO: Fix SSL cert verification
-    ctx = ssl.create_default_context()
-    ctx.check_hostname = False
-    #ctx.verify_mode = ssl.CERT_NONE
-
-    # Retrieve the volumes
-    httpsConnection = http.client.HTTPSConnection(
-        data_api_config.host,
-        data_api_config.port,
-        context=ctx,
-        key_file=data_api_config.key,
-        cert_file=data_api_config.cert
-    )
-
-    httpsConnection.request("POST", url, urlencode(data), headers)
-
-    response = httpsConnection.getresponse()
-
-    if response.status is 200:
-        body = True
-        data = BytesIO()
-        bytes_downloaded = 0
-        bar = progressbar.ProgressBar(max_value=progressbar.UnknownLength,
-                                      widgets=[progressbar.AnimatedMarker(), '    ',
-                                               progressbar.DataSize(),
-                                               ' (', progressbar.FileTransferSpeed(), ')'])
-
-        while body:
-            body = response.read(buffer_size)
-            data.write(body)
-            bytes_downloaded += len(body)
-            bar.update(bytes_downloaded)
-
-        data = data.getvalue()
-    else:
-        logging.debug("Unable to get pages")
-        logging.debug("Response Code: ".format(response.status))
-        logging.debug("Response: ".format(response.reason))
-        raise EnvironmentError("Unable to get pages.")
-
-    if httpsConnection is not None:
-        httpsConnection.close()
+    own_client = client is None
+    if own_client:
+        client = DataApiClient(data_api_config)
+
+    # Retrieve the pages
+    try:
+        with client.post("pages", data) as response:
+            if response.status == 200 and stream is not None:
+                data = stream(response)
+            elif response.status == 200:
+                data = _read_response(response, buffer_size, spool_max_size, named_spool)
+            else:
+                logging.debug("Unable to get pages")
+                logging.debug("Response Code: {}".format(response.status))
+                logging.debug("Response: {}".format(response.reason))
+                raise DataApiError("Unable to get pages.", response.status)
+    finally:
+        if own_client:
+            client.close()
 
     return data
 
@@ -279,24 +340,235 @@ def grep_error(file_name, output_dir, pattern, txt_index):
 
 
 def _to_htrc_page(page_file, zip):
-    with TextIOWrapper(BytesIO(zip.read(page_file)), encoding='utf-8') as page:
-        return HtrcPage([line.rstrip() for line in page.readlines()])
+    return _bytes_to_htrc_page(zip.read(page_file))
+
+
+def _bytes_to_htrc_page(page_data):
+    return HtrcPage(decode_lines(page_data))
+
+
+def _extract_volume(vols_zip, vol_path, members, output_dir, buffer_size=DEFAULT_BUFFER_SIZE):
+    """
+    Extracts the `members` of a volume into a new temporary directory next to its
+    final location, and returns the path of the temporary directory.
+    """
+    vol_tmp_path = mkdtemp(prefix='.' + vol_path[:-1] + '.', suffix='.tmp', dir=output_dir)
+    try:
+        for member in members:
+            check_member_name(member)
+            if member.endswith('/'):
+                continue
+            path = os.path.join(vol_tmp_path, member[len(vol_path):])
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # zlib releases the GIL while inflating, so volumes are extracted in parallel
+            with vols_zip.open(member) as src, open(path, 'wb') as dst:
+                shutil.copyfileobj(src, dst, buffer_size)
+    except BaseException:
+        shutil.rmtree(vol_tmp_path, ignore_errors=True)
+        raise
+
+    return vol_tmp_path
+
+
+def _publish_volume(vol_tmp_path, vol_path, output_dir):
+    """
+    Moves an extracted volume into place. If its directory already exists, e.g.
+    with the pages of the same volume from an earlier batch, the extracted files
+    are moved into it one by one, replacing the files of the same name, as
+    `ZipFile.extractall` does.
+    """
+    target_path = os.path.join(output_dir, vol_path)
+    if not os.path.isdir(target_path):
+        os.replace(vol_tmp_path, target_path)
+        return
+
+    for dir_path, _, file_names in os.walk(vol_tmp_path):
+        target_dir_path = os.path.join(target_path, os.path.relpath(dir_path, vol_tmp_path))
+        os.makedirs(target_dir_path, exist_ok=True)
+        for file_name in file_names:
+            os.replace(os.path.join(dir_path, file_name), os.path.join(target_dir_path, file_name))
+    shutil.rmtree(vol_tmp_path)
+
+
+def _extract_parallel(vols_zip, zip_index, output_dir, executor, buffer_size=DEFAULT_BUFFER_SIZE):
+    """
+    Extracts the members of a Data API response listed in `zip_index` into
+    `output_dir`, one volume per task of `executor`.
+
+    Each volume is extracted into a temporary directory which is only moved to
+    the volume's directory once complete, in the order of the response, so that
+    `output_dir` never holds a partially extracted volume.
+    """
+    vols_zip.extractall(output_dir, members=zip_index.other)
+
+    vol_tmp_paths = [executor.submit(_extract_volume, vols_zip, vol_path, zip_index.volume_members(vol_path),
+                                     output_dir, buffer_size)
+                     for vol_path in zip_index.volume_paths]
+    try:
+        for vol_path, vol_tmp_path in zip(zip_index.volume_paths, vol_tmp_paths):
+            _publish_volume(vol_tmp_path.result(), vol_path, output_dir)
+    except BaseException:
+        for vol_tmp_path in vol_tmp_paths:
+            if not vol_tmp_path.cancel() and vol_tmp_path.exception() is None and \
+                    os.path.isdir(vol_tmp_path.result()):
+                shutil.rmtree(vol_tmp_path.result(), ignore_errors=True)
+        raise
+
+
+class _BoundedFeed:
+    """
+    Iterates over `items` for a `multiprocessing.Pool`, which would otherwise
+    consume them all up front, keeping at most `max_pending` of them ahead of
+    the results: each result received must be acknowledged with `release`.
+    """
+
+    def __init__(self, items, max_pending):
+        self._items = items
+        self._slots = threading.Semaphore(max_pending)
+        self._closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __iter__(self):
+        for item in self._items:
+            # the pool's task handler thread waits here, and must not be blocked once the pool is shut down
+            while not self._slots.acquire(timeout=0.1):
+                if self._closed:
+                    return
+            if self._closed:
+                return
+            yield item
+
+    def release(self):
+        self._slots.release()
+
+    def close(self):
+        self._closed = True
+
+
+def _prefetch(fetch, items, depth, concurrency=1, max_pending_bytes=None, sizeof=None):
+    """
+    Yields `(item, fetch(item))` for each of `items`, in the order in which the
+    calls to `fetch` complete.
+
+    Up to `concurrency` calls to `fetch` run at the same time in a thread pool,
+    and up to `depth` more results are retrieved ahead of the consumer, so that
+    the next results are being retrieved while the current one is processed. If
+    `max_pending_bytes` is set, no further call is started while the results
+    which have not been consumed yet add up to that many bytes, as measured by
+    `sizeof`; results still being retrieved count as the average size of those
+    seen so far. Results are file objects; any which are never handed to the
+    consumer are closed. Exceptions raised by `fetch` are re-raised in the
+    consumer.
+    """
+    if depth <= 0 and concurrency <= 1:
+        for item in items:
+            yield item, fetch(item)
+        return
+
+    items = iter(items)
+    pending = {}
+    consumed_bytes = consumed = 0
+
+    def _pending_bytes():
+        average_bytes = consumed_bytes / consumed
+        return sum(sizeof(future.result()) if future.done() and future.exception() is None else average_bytes
+                   for future in pending)
+
+    def _can_start():
+        if len(pending) >= concurrency + depth:
+            return False
+        if not pending or max_pending_bytes is None:
+            return True
+        if not consumed:
+            # nothing is known about the size of the results yet
+            return len(pending) < concurrency
+        return _pending_bytes() < max_pending_bytes
+
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='htrc-prefetch') as executor:
+        try:
+            while True:
+                while _can_start():
+                    item = next(items, _prefetch)
+                    if item is _prefetch:
+                        break
+                    pending[executor.submit(fetch, item)] = item
+
+                if not pending:
+                    break
+
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                # futures which completed together are handed out in the order they were started
+                for future in [future for future in pending if future in done]:
+                    item = pending.pop(future)
+                    result = future.result()
+                    if max_pending_bytes is not None:
+                        consumed_bytes += sizeof(result)
+                        consumed += 1
+                    yield item, result
+        finally:
+            for future in pending:
+                future.cancel()
+            for future in pending:
+                if not future.cancelled() and future.exception() is None:
+                    future.result().close()
 
 
 def download_volumes(volume_ids, output_dir, concat=False, mets=False, pages=False,
                      remove_headers_footers=False, hf_window_size=6, hf_min_similarity=0.7, skip_removed_hf=False,
-                     parallelism=multiprocessing.cpu_count(), batch_size=250, data_api_config=None):
+                     parallelism=multiprocessing.cpu_count(), batch_size=250, data_api_config=None,
+                     hf_report='volume', hf_candidates='window', transfer=None, batching=None, output=None,
+                     retry_policy=None, cache=None):
+    """
+    Downloads volumes from the Data API into `output_dir`, in batches of
+    `batch_size` volumes, optionally removing their headers and footers with a
+    pool of `parallelism` worker processes.
+
+    How responses are received, how volumes are batched and how the output is
+    saved are set by the `TransferOptions`, `BatchOptions` and `OutputOptions`
+    objects `transfer`, `batching` and `output` (see `htrc.volumes.options`).
+    Failed requests are retried according to `retry_policy`, and volumes found
+    in the `VolumeCache` `cache` are not requested again.
+    """
+    transfer = transfer or TransferOptions()
+    batching = batching or BatchOptions()
+    output = output or OutputOptions()
+
     if not 0 < parallelism <= multiprocessing.cpu_count():
         raise ValueError("Invalid parallelism level specified")
 
-    remove_hf_fun = partial(
-        _remove_headers_footers_and_save,
+    if pages and concat and mets:
+        raise ValueError("Cannot set both concat and mets with pages.")
+
+    hf_max_pending = transfer.hf_max_pending or 2 * parallelism
+
+    if transfer.stream_extract and cache is not None:
+        raise ValueError("Cannot stream the extraction with a volume cache.")
+
+    if output.bundle is not None and transfer.stream_extract and not remove_headers_footers:
+        raise ValueError("Cannot stream the extraction into a bundle without removing headers and footers.")
+
+    if hf_report not in HF_REPORT_MODES:
+        raise ValueError("Invalid header/footer report mode specified")
+
+    if hf_candidates not in CANDIDATE_MODES:
+        raise ValueError("Invalid header/footer candidate mode specified")
+
+    hf_options = dict(
         concat=concat,
         hf_min_similarity=hf_min_similarity,
         hf_window_size=hf_window_size,
         skip_removed_hf=skip_removed_hf,
-        output_dir=output_dir
+        output_dir=output_dir,
+        bundle=output.bundle is not None,
+        hf_report=hf_report,
+        hf_candidates=hf_candidates
     )
+    remove_hf_fun = partial(_remove_headers_footers_and_save, **hf_options)
 
     volume_ids = list(set(volume_ids))  # ensure unique volume ids
     num_vols = len(volume_ids)
@@ -309,60 +581,255 @@ def download_volumes(volume_ids, output_dir, concat=False, mets=False, pages=Fal
         logging.info("obtained token: %s\n" % data_api_config.token)
 
         try:
-            errors = []
-            rights = []
-
-            with tqdm(total=num_vols) as progress, multiprocessing.Pool(processes=parallelism) as pool:
-                for ids in split_items(volume_ids, batch_size):
-                    if pages:
-                        if concat and mets:
-                            raise ValueError("Cannot set both concat and mets with pages.")
-                        else:
-                            data = get_pages(data_api_config, ids, concat and not remove_headers_footers, mets)
+            # records the completed volumes of each batch, so that an interrupted download can be resumed
+            journal = DownloadJournal(output_dir, resume=output.resume)
+            errors = list(journal.errors)
+            rights = list(journal.rights)
+            failed = []
+            volume_ids = journal.remaining(volume_ids)
+
+            request_options = {'concat': concat and not remove_headers_footers, 'mets': mets, 'pages': pages}
+            if cache is not None:
+                # only the volumes which are not in the cache are requested from the Data API
+                cached_volume_ids, volume_ids = cache.partition(volume_ids, **request_options)
+                logging.info("{:,} volumes found in the cache".format(len(cached_volume_ids)))
+
+            # a single client is shared by all batches so its TLS context and connections are reused
+            client = DataApiClient(data_api_config, max_idle_connections=max(4, transfer.concurrency),
+                                   timeout=transfer.timeout)
+
+            # with adaptive batching, batch sizes follow the bytes/volume and latency observed for the previous
+            # requests
+            batches = batching.batches(volume_ids, batch_size)
+
+            # bounds the number of volumes received while streaming which are waiting for a worker
+            hf_slots = threading.Semaphore(hf_max_pending)
+
+            def submit_volume(zip_vol_path, sorted_vol_zip_page_paths, vol_page_data):
+                hf_slots.acquire()
+                vol_pages = [_bytes_to_htrc_page(page_data) for page_data in vol_page_data]
+                return pool.apply_async(remove_hf_fun, ((zip_vol_path, sorted_vol_zip_page_paths, vol_pages),),
+                                        callback=lambda _: hf_slots.release(),
+                                        error_callback=lambda _: hf_slots.release())
+
+            def discard_volumes(submitted):
+                # the volumes of a failed attempt are requested again, so their pending results are waited
+                # for (rather than racing with those of the next attempt) and their output is removed
+                for zip_vol_path, sorted_vol_zip_page_paths, result in submitted:
+                    result.wait()
+                    if output.bundle is None and result.successful():
+                        _remove_volume_output(zip_vol_path, sorted_vol_zip_page_paths, output_dir, concat)
+
+            # the header/footer removal workers open the responses by their name
+            named_spool = transfer.hf_read_from_zip and remove_headers_footers
+
+            def fetch_response(ids):
+                start = time.monotonic()
+                if transfer.stream_extract:
+                    # the response is extracted while it is received, and each volume is handed to the
+                    # header/footer removal pool as soon as all of its pages have arrived
+                    submitted = []
+
+                    def submit_attempt_volume(zip_vol_path, sorted_vol_zip_page_paths, vol_page_data):
+                        result = submit_volume(zip_vol_path, sorted_vol_zip_page_paths, vol_page_data)
+                        submitted.append((zip_vol_path, sorted_vol_zip_page_paths, result))
+                        return result
+
+                    get_batch = get_pages if pages else get_volumes
+                    extract = partial(extract_stream, output_dir=output_dir, chunk_size=transfer.buffer_size,
+                                      on_volume=submit_attempt_volume if remove_headers_footers else None)
+                    try:
+                        data = get_batch(data_api_config, ids, concat and not remove_headers_footers, mets,
+                                         buffer_size=transfer.buffer_size, client=client, stream=extract)
+                    except BaseException:
+                        discard_volumes(submitted)
+                        raise
+                elif transfer.use_asyncio:
+                    get_batch = htrc.volumes.aio.get_pages if pages else htrc.volumes.aio.get_volumes
+                    data = aio_loop.run(get_batch(data_api_config, ids, concat and not remove_headers_footers, mets,
+                                                  buffer_size=transfer.buffer_size,
+                                                  spool_max_size=transfer.spool_max_size, client=aio_client,
+                                                  named_spool=named_spool))
+                    if transfer.spool_max_size is None and not named_spool:
+                        # responses which are not spooled are handled as files all the same
+                        data = BytesIO(data)
+                else:
+                    get_batch = get_pages if pages else get_volumes
+                    # responses which are not spooled are read into a `BytesIO`, rather than returned as bytes
+                    read = partial(_buffer_response, buffer_size=transfer.buffer_size) \
+                        if transfer.spool_max_size is None and not named_spool else None
+                    data = get_batch(data_api_config, ids, concat and not remove_headers_footers, mets,
+                                     buffer_size=transfer.buffer_size, spool_max_size=transfer.spool_max_size,
+                                     client=client, stream=read, named_spool=named_spool)
+                if batching.adaptive:
+                    if transfer.stream_extract:
+                        num_bytes = data.num_bytes
                     else:
-                        data = get_volumes(data_api_config, ids, concat and not remove_headers_footers, mets)
-
-                    volumes = []
-
-                    with ZipFile(BytesIO(data)) as vols_zip:
-                        zip_list = vols_zip.namelist()
-                        if 'ERROR.err' in zip_list:
-                            errors.append(vols_zip.read('ERROR.err').decode('utf-8'))
-                            zip_list.remove('ERROR.err')
-                        if 'volume-rights.txt' in zip_list:
-                            rights_data = vols_zip.read('volume-rights.txt').decode('utf-8')
-                            zip_list.remove('volume-rights.txt')
-                            if not rights:
-                                rights.append(rights_data)
-                            else:
-                                # due to the format in which 'volume-rights.txt' is created, we have to skip
-                                # the first 4 lines which make up the header of the file, to extract only the
-                                # actual volume rights data for accumulation
-                                rights.append(''.join(rights_data.splitlines(keepends=True)[4:]))
-
-                        zip_volume_paths = [zip_vol_path for zip_vol_path in zip_list if zip_vol_path.endswith('/')]
-                        num_vols_in_zip = len(zip_volume_paths)
-
-                        if not remove_headers_footers:
-                            vols_zip.extractall(output_dir, members=zip_list)
-                            progress.update(num_vols_in_zip)
-                        else:
-                            for zip_vol_path in zip_volume_paths:
-                                sorted_vol_zip_page_paths = sorted(zip_page_path for zip_page_path in zip_list if zip_page_path.startswith(zip_vol_path) and not zip_page_path.endswith('/'))
-                                vol_pages = [_to_htrc_page(page_path, vols_zip) for page_path in sorted_vol_zip_page_paths]
-                                volumes.append((zip_vol_path, sorted_vol_zip_page_paths, vol_pages))
-
-                    del data, vols_zip
-
-                    num_missing = batch_size - num_vols_in_zip if num_vols >= batch_size else num_vols - num_vols_in_zip
+                        num_bytes = data.seek(0, os.SEEK_END)
+                        data.seek(0)
+                    batches.observe(len(ids), num_bytes, time.monotonic() - start)
+                return data
+
+            def fetch_batch(ids):
+                # failed requests are retried, then split up to isolate the volumes which cannot be downloaded
+                return fetch_bisecting(fetch_response, ids, retry_policy)
+
+            def save_hf_result(result):
+                zip_vol_path, files, removed_hf = result
+                if bundle_writer is not None:
+                    # the header/footer removal workers return the files of the volume instead of writing them
+                    bundle_writer.write_volume(zip_vol_path, files)
+                if removed_hf is not None:
+                    hf_report_writer.write_volume(zip_vol_path[:-1], removed_hf)
+
+            def save_streamed_batch(ids, batch):
+                if batch.errors is not None:
+                    errors.append(batch.errors)
+                if batch.rights is not None:
+                    rights.append(batch.rights)
+
+                if not remove_headers_footers:
+                    progress.update(len(batch.volume_paths))
+                progress.update(len(ids) - len(batch.volume_paths))
+
+                for result in batch.results:
+                    save_hf_result(result.get())
+                    progress.update()
+
+                if bundle_writer is not None:
+                    bundle_writer.checkpoint()
+                if hf_report_writer is not None:
+                    hf_report_writer.sync()
+                journal.record(ids, batch.errors, batch.rights)
+
+            def save_batch(ids, data, from_cache=False):
+                if isinstance(data, StreamedBatch):
+                    return save_streamed_batch(ids, data)
+
+                batch_errors = batch_rights = None
+
+                # `data` is a file, which holds at most `spool_max_size` bytes of the response in memory if spooled
+                with data, ZipFile(data) as vols_zip, ExitStack() as batch_resources:
+                    # members are grouped by volume once, rather than scanning all members for each volume
+                    zip_index = ZipIndex.from_zip(vols_zip)
+                    if zip_index.errors is not None:
+                        batch_errors = vols_zip.read(zip_index.errors).decode('utf-8')
+                        errors.append(batch_errors)
+                    if zip_index.rights is not None:
+                        batch_rights = vols_zip.read(zip_index.rights).decode('utf-8')
+                        rights.append(batch_rights)
+
+                    num_vols_in_zip = len(zip_index)
+
+                    if cache is not None and not from_cache:
+                        vol_dirs = {}
+                        for volume_id in ids:
+                            vol_dirs.setdefault(volume_dir(volume_id), []).append(volume_id)
+                        for zip_vol_path in zip_index.volume_paths:
+                            # the pages requested by several page ids of the same volume are merged into a
+                            # single directory, which cannot be cached as the pages of any one of them
+                            if len(vol_dirs.get(zip_vol_path[:-1], ())) == 1:
+                                cache.put(vol_dirs[zip_vol_path[:-1]][0], vols_zip,
+                                          zip_index.volume_members(zip_vol_path), **request_options)
+
+                    num_missing = len(ids) - num_vols_in_zip
                     progress.update(num_missing)  # update progress bar state to include the missing volumes also
 
-                    # `volumes` will be empty if `remove_headers_footers=False` since the ZIP was extracted
-                    # without further processing
-                    if volumes:
-                        for _ in pool.imap_unordered(remove_hf_fun, volumes):
+                    if not remove_headers_footers and bundle_writer is not None:
+                        bundle_writer.write_zip(vols_zip, zip_index)
+                        progress.update(num_vols_in_zip)
+                    elif not remove_headers_footers and transfer.extract_workers > 1:
+                        _extract_parallel(vols_zip, zip_index, output_dir, extract_executor, transfer.buffer_size)
+                        progress.update(num_vols_in_zip)
+                    elif not remove_headers_footers:
+                        vols_zip.extractall(output_dir, members=zip_index.content_members())
+                        progress.update(num_vols_in_zip)
+                    else:
+                        if transfer.hf_read_from_zip:
+                            # the workers read the pages of their volume from the response on disk, so only the
+                            # locations of the pages are pickled rather than their decoded text
+                            batch_zip_file = data
+                            if from_cache:
+                                # the batches of cached volumes are not written to a named file as they are read
+                                batch_zip_file = batch_resources.enter_context(
+                                    NamedTemporaryFile(prefix='htrc-batch-', suffix='.zip'))
+                                data.seek(0)
+                                shutil.copyfileobj(data, batch_zip_file, transfer.buffer_size)
+                                batch_zip_file.flush()
+                            remove_hf_batch_fun = partial(_read_volume_and_remove_headers_footers,
+                                                          zip_path=batch_zip_file.name, **hf_options)
+                            volumes = ((zip_vol_path, zip_index.locate(sorted_vol_zip_page_paths))
+                                       for zip_vol_path, sorted_vol_zip_page_paths in zip_index.pages.items())
+                        else:
+                            remove_hf_batch_fun = remove_hf_fun
+                            volumes = ((zip_vol_path, sorted_vol_zip_page_paths,
+                                        [_to_htrc_page(page_path, vols_zip) for page_path in sorted_vol_zip_page_paths])
+                                       for zip_vol_path, sorted_vol_zip_page_paths in zip_index.pages.items())
+
+                        # volumes are decoded as the workers become ready for them, so that only a few of them
+                        # are held in memory at a time
+                        volumes = batch_resources.enter_context(_BoundedFeed(volumes, hf_max_pending))
+                        for result in pool.imap_unordered(remove_hf_batch_fun, volumes):
+                            volumes.release()
+                            save_hf_result(result)
                             progress.update()
 
+                if bundle_writer is not None:
+                    bundle_writer.checkpoint()
+                if hf_report_writer is not None:
+                    hf_report_writer.sync()
+                journal.record(ids, batch_errors, batch_rights)
+
+            with ExitStack() as resources, tqdm(total=num_vols, initial=num_vols - len(volume_ids)) as progress, \
+                    multiprocessing.Pool(processes=parallelism) as pool:
+                resources.enter_context(client)
+                bundle_writer = None
+                if output.bundle is not None:
+                    # the volumes which are downloaded again may have been partly written before an interruption
+                    replace = {volume_dir(volume_id) for volume_id in volume_ids}
+                    if cache is not None:
+                        replace.update(volume_dir(volume_id) for volume_id in cached_volume_ids)
+                    replace.difference_update(volume_dir(volume_id) for volume_id in journal.completed)
+                    bundle_writer = resources.enter_context(BundleWriter(output_dir, output.bundle, replace=replace))
+                hf_report_writer = None
+                if remove_headers_footers and hf_report == 'workset' and not skip_removed_hf:
+                    # the workers return the removed headers/footers, which are appended to a single report
+                    hf_report_writer = resources.enter_context(WorksetReport(output_dir, append=output.resume))
+                if transfer.extract_workers > 1:
+                    extract_executor = resources.enter_context(
+                        ThreadPoolExecutor(max_workers=transfer.extract_workers, thread_name_prefix='htrc-extract'))
+                if transfer.use_asyncio:
+                    # requests of all download threads are multiplexed on a single event loop
+                    aio_loop = resources.enter_context(htrc.volumes.aio.EventLoopThread())
+                    aio_client = htrc.volumes.aio.AsyncDataApiClient(data_api_config,
+                                                                     max_connections=transfer.concurrency,
+                                                                     timeout=transfer.timeout)
+                    resources.callback(lambda: aio_loop.run(aio_client.close()))
+
+                if cache is not None:
+                    for ids in split_items(cached_volume_ids, batch_size):
+                        save_batch(ids, cache.get_batch(ids, **request_options), from_cache=True)
+
+                # up to `concurrency` batches are downloaded at once, and the next `prefetch` ones while the
+                # current one is extracted/processed, which happens in the order the downloads complete
+                for _, batch in _prefetch(fetch_batch, batches, transfer.prefetch, concurrency=transfer.concurrency,
+                                          max_pending_bytes=transfer.max_pending_bytes, sizeof=FetchedBatch.size):
+                    try:
+                        for ids, data in batch.parts:
+                            save_batch(ids, data)
+                    finally:
+                        batch.close()
+
+                    failed.extend(batch.failed)
+                    progress.update(len(batch.failed))
+
+            if failed:
+                with open(os.path.join(output_dir, 'volumes_failed.txt'), 'w') as volumes_failed:
+                    volumes_failed.write("\n".join(failed))
+
+                print("\n{:,} volumes could not be downloaded. Please check volumes_failed.txt for the complete "
+                      "list, and run the download again with --resume to retry them.".format(len(failed)))
+
             na_volumes_all = []
 
             if errors:
@@ -373,6 +840,10 @@ def download_volumes(volume_ids, output_dir, concat=False, mets=False, pages=Fal
                 na_volumes_all.extend(na_volumes_error)
 
             if rights:
+                # due to the format in which 'volume-rights.txt' is created, we have to skip the first 4 lines
+                # which make up the header of the file for all but the first batch, to extract only the actual
+                # volume rights data for accumulation
+                rights = rights[:1] + [''.join(rights_data.splitlines(keepends=True)[4:]) for rights_data in rights[1:]]
                 with open(os.path.join(output_dir, 'volume-rights.txt'), 'w') as rights_file:
                     rights_file.write(''.join(rights))
 
@@ -399,59 +870,322 @@ def download_volumes(volume_ids, output_dir, concat=False, mets=False, pages=Fal
                           "htrc-help@hathitrust.org "
                           "for assistance.".format(num_na))
 
-        except socket.error:
-            raise RuntimeError("HTRC Data API time out. Check your inode usage if downloading a large workset. "
-                               "Contact HTRC for further help.")
+        except OSError as e:
+            if e.errno in (errno.ENOSPC, getattr(errno, 'EDQUOT', errno.ENOSPC)):
+                raise RuntimeError("No space left on the device. Check your inode usage if downloading a large "
+                                   "workset, or save it as a bundle (--bundle). Contact HTRC for further help.") from e
+            if isinstance(e, RetryPolicy.NETWORK_ERRORS):
+                raise RuntimeError("HTRC Data API time out. Contact HTRC for further help.") from e
+            raise
 
     else:
         raise RuntimeError("Failed to obtain the JWT token.")
 
 
-def _remove_headers_footers_and_save(vol_data, concat, hf_min_similarity, hf_window_size, skip_removed_hf, output_dir):
+def _parse_volume_structure(vol_data, hf_window_size, hf_min_similarity, hf_candidates='window'):
+    zip_vol_path, _, vol_pages = vol_data
+    vol_pages = parse_page_structure(vol_pages, window_size=hf_window_size, min_similarity_ratio=hf_min_similarity,
+                                     candidates=hf_candidates)
+
+    # the pages parsed by `parse_page_structure` are of a class which cannot be sent back to the parent process
+    return zip_vol_path, [HtrcStructuredPage(page.text_lines, page.num_header_lines, page.num_footer_lines)
+                          for page in vol_pages]
+
+
+def iter_volumes(volume_ids, data_api_config=None, pages=False, remove_headers_footers=False, hf_window_size=6,
+                 hf_min_similarity=0.7, parallelism=multiprocessing.cpu_count(), batch_size=250,
+                 hf_candidates='window', transfer=None, batching=None, retry_policy=None, failed=None):
+    """
+    Downloads volumes from the Data API and yields `(volume_id, pages)` for each
+    of them, without writing anything to disk.
+
+    `pages` is the list of `HtrcPage` objects of the volume, in page order. With
+    `remove_headers_footers`, the pages are `HtrcStructuredPage` objects whose
+    header and footer lines were identified by a pool of `parallelism` worker
+    processes, so that e.g. only their `body` is used.
+
+    Volumes are requested in batches like with `download_volumes`, with the
+    same `batching` and `retry_policy` options, and the `prefetch`,
+    `concurrency`, `max_pending_bytes`, `hf_max_pending` and `buffer_size`
+    options of `transfer` (the others do not apply). Responses are held in
+    memory, so memory use is bounded by the number of batches being downloaded
+    or waiting (`concurrency + prefetch`, and `max_pending_bytes`) and by the
+    number of volumes waiting for a worker (`hf_max_pending`, by default twice
+    `parallelism`). Volumes are yielded in the order in which they become
+    available. The ids of volumes which could not be downloaded
+    are appended to the list `failed` if given, and skipped otherwise.
+    """
+    transfer = transfer or TransferOptions()
+    batching = batching or BatchOptions()
+
+    if not 0 < parallelism <= multiprocessing.cpu_count():
+        raise ValueError("Invalid parallelism level specified")
+
+    hf_max_pending = transfer.hf_max_pending or 2 * parallelism
+
+    volume_ids = list(OrderedDict.fromkeys(volume_ids))  # ensure unique volume ids
+    vol_dirs = {volume_dir(volume_id): volume_id for volume_id in volume_ids}
+    data_api_config = data_api_config or htrc.config.HtrcDataApiConfig()
+    get_batch = get_pages if pages else get_volumes
+    batches = batching.batches(volume_ids, batch_size)
+
+    def fetch_response(ids):
+        start = time.monotonic()
+        # the response is read into the buffer which is then parsed, so that it is only held once
+        data = get_batch(data_api_config, ids, client=client,
+                         stream=partial(_buffer_response, buffer_size=transfer.buffer_size))
+        if batching.adaptive:
+            batches.observe(len(ids), data.getbuffer().nbytes, time.monotonic() - start)
+        return data
+
+    def fetch_batch(ids):
+        return fetch_bisecting(fetch_response, ids, retry_policy)
+
+    def iter_batch_volumes(vols_zip):
+        for zip_vol_path, sorted_vol_zip_page_paths in ZipIndex.from_zip(vols_zip).pages.items():
+            sorted_vol_zip_page_paths = [page_path for page_path in sorted_vol_zip_page_paths
+                                         if page_path.endswith('.txt')]
+            vol_pages = [_to_htrc_page(page_path, vols_zip) for page_path in sorted_vol_zip_page_paths]
+            yield zip_vol_path, sorted_vol_zip_page_paths, vol_pages
+
+    parse_fun = partial(_parse_volume_structure, hf_window_size=hf_window_size, hf_min_similarity=hf_min_similarity,
+                        hf_candidates=hf_candidates)
+
+    with ExitStack() as resources:
+        client = resources.enter_context(DataApiClient(data_api_config,
+                                                       max_idle_connections=max(4, transfer.concurrency),
+                                                       timeout=transfer.timeout))
+        if remove_headers_footers:
+            pool = resources.enter_context(multiprocessing.Pool(processes=parallelism))
+
+        fetched_batches = resources.enter_context(closing(
+            _prefetch(fetch_batch, batches, transfer.prefetch, concurrency=transfer.concurrency,
+                      max_pending_bytes=transfer.max_pending_bytes, sizeof=FetchedBatch.size)))
+        for _, batch in fetched_batches:
+            with closing(batch):
+                for _, data in batch.parts:
+                    with ZipFile(data) as vols_zip:
+                        if not remove_headers_footers:
+                            for zip_vol_path, _, vol_pages in iter_batch_volumes(vols_zip):
+                                yield vol_dirs.get(zip_vol_path[:-1], zip_vol_path[:-1]), vol_pages
+                            continue
+
+                        with _BoundedFeed(iter_batch_volumes(vols_zip), hf_max_pending) as volumes:
+                            for zip_vol_path, vol_pages in pool.imap_unordered(parse_fun, volumes):
+                                volumes.release()
+                                yield vol_dirs.get(zip_vol_path[:-1], zip_vol_path[:-1]), vol_pages
+
+            if batch.failed and failed is None:
+                logging.warning("Skipping {:,} volumes which could not be downloaded".format(len(batch.failed)))
+            elif batch.failed:
+                failed.extend(batch.failed)
+
+
+def _read_volume_and_remove_headers_footers(vol_locations, zip_path, **kwargs):
+    """
+    Reads the pages of a volume from the Data API response saved at `zip_path`,
+    then removes their headers and footers like `_remove_headers_footers_and_save`.
+
+    `vol_locations` is `(zip_vol_path, page_locations)`, with the
+    `htrc.volumes.zipindex.MemberLocation` of each page, so that only the
+    locations of the pages are sent to the worker process rather than their text.
+    """
+    zip_vol_path, page_locations = vol_locations
+    with open(zip_path, 'rb') as zip_file:
+        vol_pages = [_bytes_to_htrc_page(read_member(zip_file, location)) for location in page_locations]
+
+    return _remove_headers_footers_and_save((zip_vol_path, [location.name for location in page_locations], vol_pages),
+                                            **kwargs)
+
+
+def _remove_headers_footers_and_save(vol_data, concat, hf_min_similarity, hf_window_size, skip_removed_hf, output_dir,
+                                     bundle=False, hf_report='volume', hf_candidates='window'):
+    """
+    Removes the headers and footers of a volume's pages and saves the rest in
+    `output_dir`. If `bundle` is True, nothing is written, and the files are
+    returned as `(path, text)` pairs relative to `output_dir` instead.
+
+    Returns `(zip_vol_path, files, removed_hf)`, where `files` is empty unless
+    `bundle` is True, and `removed_hf` holds the rows of the report of the
+    removed headers and footers if `hf_report` is 'workset' (so that the caller
+    appends them to the report of the workset), or None otherwise.
+    """
     zip_vol_path, sorted_vol_zip_page_paths, vol_pages = vol_data
     clean_volid = zip_vol_path[:-1]
+    files = []
+
+    def save(path, text):
+        if bundle:
+            files.append((path, text))
+        else:
+            with open(os.path.join(output_dir, path), 'w', encoding='utf-8') as out_file:
+                out_file.write(text)
 
-    vol_pages = parse_page_structure(vol_pages, window_size=hf_window_size, min_similarity_ratio=hf_min_similarity)
+    vol_pages = parse_page_structure(vol_pages, window_size=hf_window_size, min_similarity_ratio=hf_min_similarity,
+                                     candidates=hf_candidates)
     pages_body = (page.body for page in vol_pages)
+    if concat:
+        save(clean_volid + '.txt', '\n'.join(pages_body))
+    else:
+        if not bundle:
+            os.makedirs(os.path.join(output_dir, zip_vol_path), exist_ok=True)
+        for vol_page_path, page_body in zip(sorted_vol_zip_page_paths, pages_body):
+            save(vol_page_path, page_body)
+
     # save the removed headers/footers for user inspection
-    if skip_removed_hf:
-        if concat:
-            with open(os.path.join(output_dir, clean_volid + '.txt'), 'w', encoding='utf-8') as vol_file:
-                vol_file.write('\n'.join(pages_body))
-        else:
-            vol_path = os.path.join(output_dir, zip_vol_path)
-            os.mkdir(vol_path)
-            for vol_page_path, page_body in zip(sorted_vol_zip_page_paths, pages_body):
-                with open(os.path.join(output_dir, vol_page_path), 'w', encoding='utf-8') as page_file:
-                    page_file.write(page_body)
+    removed_hf = None
+    if not skip_removed_hf:
+        removed_hf = removed_hf_rows(sorted_vol_zip_page_paths, vol_pages)
+        if hf_report == 'volume':
+            if concat:
+                removed_hf_filename = clean_volid + '_removed_hf.csv'
+            else:
+                removed_hf_filename = os.path.join(clean_volid, 'removed_hf.csv')
+
+            save(removed_hf_filename, volume_report(removed_hf))
+            removed_hf = None
+
+    return zip_vol_path, files, removed_hf
+
+
+def _remove_volume_output(zip_vol_path, sorted_vol_zip_page_paths, output_dir, concat):
+    """
+    Removes the files written by `_remove_headers_footers_and_save` for a
+    volume, leaving the other pages of its directory (e.g. downloaded by
+    other page ids) in place.
+    """
+    clean_volid = zip_vol_path[:-1]
+    if concat:
+        paths = [clean_volid + '.txt', clean_volid + '_removed_hf.csv']
     else:
-        if concat:
-            with open(os.path.join(output_dir, clean_volid + '.txt'), 'w', encoding='utf-8') as vol_file:
-                vol_file.write('\n'.join(pages_body))
-        else:
-            vol_path = os.path.join(output_dir, zip_vol_path)
-            os.mkdir(vol_path)
-            for vol_page_path, page_body in zip(sorted_vol_zip_page_paths, pages_body):
-                with open(os.path.join(output_dir, vol_page_path), 'w', encoding='utf-8') as page_file:
-                    page_file.write(page_body)
+        paths = list(sorted_vol_zip_page_paths) + [os.path.join(clean_volid, 'removed_hf.csv')]
 
+    for path in paths:
+        if os.path.exists(os.path.join(output_dir, path)):
+            os.remove(os.path.join(output_dir, path))
+    if not concat and os.path.isdir(os.path.join(output_dir, clean_volid)) and \
+            not os.listdir(os.path.join(output_dir, clean_volid)):
+        os.rmdir(os.path.join(output_dir, clean_volid))
 
 
-        removed_hf = []
-        for vol_page_path, vol_page in zip(sorted_vol_zip_page_paths, vol_pages):
-            if not (vol_page.has_header or vol_page.has_footer):
-                # skip reporting pages that don't have an identified header or footer
-                continue
-            _, page_name = os.path.split(vol_page_path)
-            page_name, _ = os.path.splitext(page_name)
-            removed_hf.append({'page': page_name, 'header': vol_page.header, 'footer': vol_page.footer})
+def _remove_output(vol_dir, output_dir):
+    # a volume cleaned before with other options may have left files which would not be overwritten
+    shutil.rmtree(os.path.join(output_dir, vol_dir), ignore_errors=True)
+    for name in (vol_dir + '.txt', vol_dir + '_removed_hf.csv'):
+        if os.path.exists(os.path.join(output_dir, name)):
+            os.remove(os.path.join(output_dir, name))
 
-        if concat:
-            removed_hf_filename = os.path.join(output_dir, clean_volid + '_removed_hf.csv')
-        else:
-            removed_hf_filename = os.path.join(output_dir, clean_volid, 'removed_hf.csv')
 
-        pd.DataFrame(removed_hf, columns=['page', 'header', 'footer']).to_csv(removed_hf_filename, index=False)
+def _clean_volume(vol_data, input_dir, **kwargs):
+    """
+    Reads the pages of a volume downloaded into `input_dir`, then removes their
+    headers and footers like `_remove_headers_footers_and_save`.
+    """
+    vol_dir, page_names = vol_data
+    _remove_output(vol_dir, kwargs['output_dir'])
+
+    vol_pages = []
+    for name in page_names:
+        with open(os.path.join(input_dir, vol_dir, name), 'rb') as page_file:
+            vol_pages.append(_bytes_to_htrc_page(page_file.read()))
+
+    return _remove_headers_footers_and_save((vol_dir + '/', [vol_dir + '/' + name for name in page_names], vol_pages),
+                                            **kwargs)
+
+
+def clean_volumes(input_dir, output_dir, volume_ids=None, concat=False, hf_window_size=6, hf_min_similarity=0.7,
+                  skip_removed_hf=False, parallelism=multiprocessing.cpu_count(), force=False, hf_report='volume',
+                  hf_candidates='window'):
+    """
+    Removes the headers and footers of the volumes already downloaded into
+    `input_dir` (without `--concat` or header/footer removal), and saves the
+    rest in `output_dir` like `download_volumes` with `remove_headers_footers`.
+
+    The volumes are processed by a pool of `parallelism` worker processes, which
+    read their pages from `input_dir`. `output_dir` keeps a manifest of the
+    volumes it holds, and volumes which were already cleaned with the same
+    parameters from unchanged pages are skipped unless `force` is True, so that
+    cleaning can be resumed, or repeated with other parameters into another
+    output directory without downloading the volumes again. With
+    `hf_report='workset'`, the removed headers and footers are appended to a
+    single report in `output_dir` rather than saved per volume.
+
+    Only the volumes `volume_ids` are cleaned if given. Returns the ids of the
+    volumes which were cleaned, by their directory names in the output layout.
+    """
+    if not 0 < parallelism <= multiprocessing.cpu_count():
+        raise ValueError("Invalid parallelism level specified")
+
+    if os.path.realpath(input_dir) == os.path.realpath(output_dir):
+        raise ValueError("Cannot clean the volumes into their own directory.")
+
+    if hf_report not in HF_REPORT_MODES:
+        raise ValueError("Invalid header/footer report mode specified")
+
+    if hf_candidates not in CANDIDATE_MODES:
+        raise ValueError("Invalid header/footer candidate mode specified")
+
+    if volume_ids is None:
+        vol_dirs = sorted(entry.name for entry in os.scandir(input_dir)
+                          if entry.is_dir() and not entry.name.startswith('.'))
+        num_concatenated = sum(1 for name in os.listdir(input_dir)
+                               if name.endswith('.txt') and name not in REPORT_FILENAMES)
+        if num_concatenated:
+            logging.warning("Skipping {:,} concatenated volumes, whose pages cannot be told apart"
+                            .format(num_concatenated))
+    else:
+        vol_dirs = sorted(set(volume_dir(volume_id) for volume_id in volume_ids))
+
+    params = {'concat': concat, 'window_size': hf_window_size, 'min_similarity': hf_min_similarity,
+              'skip_removed_hf': skip_removed_hf, 'hf_report': hf_report, 'candidates': hf_candidates}
+
+    os.makedirs(output_dir, exist_ok=True)
+    manifest = CleanManifest(output_dir, force=force)
+
+    pending = []
+    signatures = {}
+    for vol_dir in vol_dirs:
+        page_names = volume_pages(os.path.join(input_dir, vol_dir))
+        signatures[vol_dir] = source_signature(os.path.join(input_dir, vol_dir), page_names)
+        output_path = os.path.join(output_dir, vol_dir + '.txt' if concat else vol_dir)
+        if os.path.exists(output_path) and manifest.is_up_to_date(vol_dir, params, signatures[vol_dir]):
+            continue
+        pending.append((vol_dir, page_names))
+
+    if len(pending) < len(vol_dirs):
+        logging.info("Skipping {:,} volumes which are already up to date".format(len(vol_dirs) - len(pending)))
+
+    clean_fun = partial(_clean_volume, input_dir=input_dir, concat=concat, hf_min_similarity=hf_min_similarity,
+                        hf_window_size=hf_window_size, skip_removed_hf=skip_removed_hf, output_dir=output_dir,
+                        hf_report=hf_report, hf_candidates=hf_candidates)
+
+    cleaned = []
+    with ExitStack() as resources, tqdm(total=len(vol_dirs), initial=len(vol_dirs) - len(pending)) as progress, \
+            multiprocessing.Pool(processes=parallelism) as pool:
+        if hf_report == 'workset' and not skip_removed_hf:
+            hf_report_writer = resources.enter_context(WorksetReport(output_dir, append=not force))
+        for zip_vol_path, _, removed_hf in pool.imap_unordered(clean_fun, pending):
+            vol_dir = zip_vol_path[:-1]
+            if removed_hf is not None:
+                hf_report_writer.write_volume(vol_dir, removed_hf)
+                hf_report_writer.sync()
+            manifest.record(vol_dir, params, signatures[vol_dir])
+            cleaned.append(vol_dir)
+            progress.update()
+
+    return cleaned
+
+
+def clean(args):
+    return clean_volumes(args.input, args.output,
+                         concat=args.concat,
+                         hf_window_size=args.window_size,
+                         hf_min_similarity=args.min_similarity_ratio,
+                         skip_removed_hf=args.skip_removed_hf,
+                         parallelism=args.parallelism,
+                         force=args.force,
+                         hf_report=args.hf_report,
+                         hf_candidates=args.hf_candidates)
 
 
 def download(args):
@@ -468,6 +1202,21 @@ def download(args):
         key=args.datakey
     )
 
+    transfer = TransferOptions(buffer_size=args.buffer_size * 1024 * 1024,
+                               prefetch=args.prefetch,
+                               concurrency=args.concurrency,
+                               max_pending_bytes=args.max_pending_size * 1024 * 1024 if args.max_pending_size else None,
+                               use_asyncio=args.use_asyncio,
+                               stream_extract=args.stream_extract,
+                               extract_workers=args.extract_workers,
+                               hf_read_from_zip=args.hf_read_from_zip,
+                               timeout=args.timeout or None)
+    batching = BatchOptions(adaptive=args.adaptive_batch_size,
+                            min_size=args.min_batch_size,
+                            max_size=args.max_batch_size,
+                            target_bytes=args.target_batch_size * 1024 * 1024)
+    output = OutputOptions(resume=args.resume, bundle=args.bundle)
+
     return download_volumes(volumeIDs, args.output,
                             remove_headers_footers=args.remove_headers_footers or args.remove_headers_footers_and_concat,
                             concat=args.concat or args.remove_headers_footers_and_concat,
@@ -478,5 +1227,12 @@ def download(args):
                             parallelism=args.parallelism,
                             batch_size=args.batch_size,
                             skip_removed_hf=args.skip_removed_hf,
+                            hf_report=args.hf_report,
+                            hf_candidates=args.hf_candidates,
+                            transfer=transfer,
+                            batching=batching,
+                            output=output,
+                            retry_policy=RetryPolicy(max_attempts=args.max_attempts),
+                            cache=VolumeCache(args.cache_dir, args.cache_size * 1024 * 1024) if args.cache else None,
                             data_api_config=data_api_config)
 
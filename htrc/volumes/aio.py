@@ -0,0 +1,411 @@
+#!/usr/bin/env python
+"""
+`htrc.volumes.aio`
+
+Contains asyncio counterparts of `htrc.volumes.get_volumes` and
+`htrc.volumes.get_pages`, for applications running on an event loop.
+
+Requests are sent over a pool of keep-alive connections of an
+`AsyncDataApiClient`, so many requests can run concurrently on one event loop.
+Response bodies are streamed, and cancelling a request closes its connection.
+Truncated responses raise `http.client.IncompleteRead` and stalled connections
+`TimeoutError` (after the same `DEFAULT_TIMEOUT` as the `socket.timeout` of the
+requests of `htrc.volumes.client.DataApiClient`), so that they are retried the
+same way.
+"""
+from __future__ import print_function
+from future import standard_library
+
+standard_library.install_aliases()
+
+import asyncio
+from contextlib import asynccontextmanager
+import http.client
+from io import BytesIO
+import ssl
+from tempfile import NamedTemporaryFile, SpooledTemporaryFile
+import threading
+from typing import AsyncIterator, Dict, Optional, Tuple
+from urllib.parse import urlencode
+
+import htrc.config
+from htrc.volumes.client import DEFAULT_TIMEOUT, DataApiError
+
+import logging
+from logging import NullHandler
+
+logging.getLogger(__name__).addHandler(NullHandler())
+
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+
+
+async def _wait(awaitable, timeout: Optional[float]):
+    try:
+        return await asyncio.wait_for(awaitable, timeout)
+    except asyncio.TimeoutError:
+        # `asyncio.TimeoutError` is not the built-in `TimeoutError` before Python 3.11
+        raise TimeoutError("Data API did not respond within {}s".format(timeout)) from None
+
+
+class AsyncResponse:
+    """
+    The response to a Data API request, whose body is read from the connection
+    on demand.
+    """
+
+    def __init__(self, reader: asyncio.StreamReader, status: int, reason: str, headers: Dict[str, str],
+                 timeout: Optional[float] = DEFAULT_TIMEOUT) -> None:
+        self._reader = reader
+        self._timeout = timeout
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.will_close = headers.get('connection', '').lower() == 'close'
+
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            self._remaining = None
+            self._chunk_remaining = 0
+        elif 'content-length' in headers:
+            self._remaining = int(headers['content-length'])
+        else:
+            # the body ends when the server closes the connection
+            self._remaining = -1
+            self.will_close = True
+
+        self._chunked = self._remaining is None
+        self._eof = self._remaining == 0
+
+    def isclosed(self) -> bool:
+        """
+        Returns True once the whole body has been read.
+        """
+        return self._eof
+
+    async def _readline(self) -> bytes:
+        return await _wait(self._reader.readline(), self._timeout)
+
+    async def _read_some(self, n: int, expected: int) -> bytes:
+        data = await _wait(self._reader.read(n), self._timeout)
+        if not data:
+            raise http.client.IncompleteRead(b'', expected)
+
+        return data
+
+    async def _read_chunked(self, n: int) -> bytes:
+        if not self._chunk_remaining:
+            size_line = await self._readline()
+            if not size_line.endswith(b'\n'):
+                raise http.client.IncompleteRead(b'')
+            self._chunk_remaining = int(size_line.split(b';', 1)[0].strip(), 16)
+            if not self._chunk_remaining:
+                # skip the trailers ending the body
+                while (await self._readline()) not in (b'\r\n', b'\n', b''):
+                    pass
+                self._eof = True
+                return b''
+
+        data = await self._read_some(min(n, self._chunk_remaining), self._chunk_remaining)
+        self._chunk_remaining -= len(data)
+        if not self._chunk_remaining and not (await self._readline()).endswith(b'\n'):
+            # CRLF after the chunk data
+            raise http.client.IncompleteRead(data)
+
+        return data
+
+    async def read(self, n: int = DEFAULT_CHUNK_SIZE) -> bytes:
+        """
+        Returns up to `n` bytes of the body, or b'' once it has been read to the end.
+        """
+        if self._eof:
+            return b''
+
+        if self._chunked:
+            return await self._read_chunked(n)
+
+        if self._remaining < 0:
+            data = await _wait(self._reader.read(n), self._timeout)
+            self._eof = not data
+            return data
+
+        data = await self._read_some(min(n, self._remaining), self._remaining)
+        self._remaining -= len(data)
+        self._eof = not self._remaining
+
+        return data
+
+    async def iter_chunks(self, chunk_size: int = DEFAULT_CHUNK_SIZE) -> AsyncIterator[bytes]:
+        """
+        Yields the body in chunks of up to `chunk_size` bytes.
+        """
+        while True:
+            data = await self.read(chunk_size)
+            if not data:
+                return
+            yield data
+
+
+class AsyncDataApiClient:
+    """
+    An asyncio client for the HTRC Data API holding a pool of keep-alive
+    connections.
+
+    At most `max_connections` requests are sent at the same time; further
+    requests wait for a connection to become available. `ssl_context` replaces
+    the context built from the config's client certificate and key, and may be
+    False to connect without TLS (e.g. to a local stand-in server).
+
+    Connecting, sending a request and each read of its response fail with
+    `TimeoutError` after `timeout` seconds (None to wait forever), so that a
+    stalled connection does not hold on to its slot.
+    """
+
+    def __init__(self, data_api_config: htrc.config.HtrcDataApiConfig = None, max_connections: int = 8,
+                 ssl_context=None, timeout: Optional[float] = DEFAULT_TIMEOUT) -> None:
+        self.config = data_api_config or htrc.config.HtrcDataApiConfig()
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self._ssl_context = ssl_context
+        self._idle_connections = []
+        self._semaphore = None
+
+    async def __aenter__(self) -> 'AsyncDataApiClient':
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.close()
+
+    @property
+    def ssl_context(self):
+        if self._ssl_context is None:
+            # TODO: Fix SSL cert verification
+            ctx = ssl.create_default_context()
+            ctx.check_hostname = False
+            #ctx.verify_mode = ssl.CERT_NONE
+            if self.config.cert:
+                ctx.load_cert_chain(self.config.cert, self.config.key)
+            self._ssl_context = ctx
+
+        return self._ssl_context or None
+
+    async def _connect(self) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        return await _wait(asyncio.open_connection(self.config.host, self.config.port, ssl=self.ssl_context),
+                           self.timeout)
+
+    async def _send(self, connection, url: str, body: bytes):
+        reader, writer = connection
+        request = ("POST {} HTTP/1.1\r\n"
+                   "Host: {}:{}\r\n"
+                   "Authorization: Bearer {}\r\n"
+                   "Content-Type: application/x-www-form-urlencoded\r\n"
+                   "Content-Length: {}\r\n"
+                   "Connection: keep-alive\r\n"
+                   "\r\n").format(url, self.config.host, self.config.port, self.config.token, len(body))
+        writer.write(request.encode('latin-1') + body)
+        await _wait(writer.drain(), self.timeout)
+
+        status_line = await _wait(reader.readline(), self.timeout)
+        if not status_line:
+            raise ConnectionResetError("Data API closed the connection")
+        _, status, reason = (status_line.decode('latin-1').rstrip('\r\n').split(' ', 2) + [''])[:3]
+
+        headers = {}
+        while True:
+            line = await _wait(reader.readline(), self.timeout)
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        return AsyncResponse(reader, int(status), reason, headers, self.timeout)
+
+    @asynccontextmanager
+    async def post(self, endpoint: str, data: dict) -> AsyncIterator[AsyncResponse]:
+        """
+        Sends `data` as a form-encoded POST to `endpoint` (relative to the Data API
+        EPR) and yields the response. The connection is returned to the pool if the
+        response body was read to the end, and closed otherwise (including when the
+        request is cancelled).
+        """
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_connections)
+
+        url = self.config.epr + endpoint
+        body = urlencode(data).encode('utf-8')
+
+        async with self._semaphore:
+            reused = bool(self._idle_connections)
+            connection = self._idle_connections.pop() if reused else await self._connect()
+            try:
+                try:
+                    response = await self._send(connection, url, body)
+                except (ConnectionResetError, BrokenPipeError):
+                    if not reused:
+                        raise
+                    # the server closed the idle keep-alive connection, retry on a fresh one
+                    logging.debug("Reconnecting to Data API after stale keep-alive connection")
+                    connection[1].close()
+                    connection = await self._connect()
+                    response = await self._send(connection, url, body)
+
+                yield response
+            except BaseException:
+                connection[1].close()
+                raise
+
+            if response.isclosed() and not response.will_close:
+                self._idle_connections.append(connection)
+            else:
+                connection[1].close()
+
+    async def close(self) -> None:
+        """
+        Closes all idle connections.
+        """
+        connections, self._idle_connections = self._idle_connections, []
+        for _, writer in connections:
+            writer.close()
+        for _, writer in connections:
+            try:
+                await writer.wait_closed()
+            except (ConnectionError, ssl.SSLError):
+                pass
+
+
+async def _read_response(response: AsyncResponse, buffer_size: int, spool_max_size: Optional[int],
+                         named_spool: bool = False):
+    if named_spool:
+        data = NamedTemporaryFile(prefix='htrc-batch-', suffix='.zip')
+    elif spool_max_size is None:
+        data = BytesIO()
+    else:
+        data = SpooledTemporaryFile(max_size=spool_max_size)
+
+    try:
+        async for chunk in response.iter_chunks(buffer_size):
+            data.write(chunk)
+    except BaseException:
+        data.close()
+        raise
+
+    if spool_max_size is None and not named_spool:
+        return data.getvalue()
+
+    data.seek(0)
+    return data
+
+
+async def _get(data_api_config, endpoint, data, buffer_size, spool_max_size, client, named_spool=False):
+    own_client = client is None
+    if own_client:
+        client = AsyncDataApiClient(data_api_config)
+
+    try:
+        async with client.post(endpoint, data) as response:
+            if response.status == 200:
+                return await _read_response(response, buffer_size, spool_max_size, named_spool)
+
+            logging.debug("Unable to get {}".format(endpoint))
+            logging.debug("Response Code: {}".format(response.status))
+            logging.debug("Response: {}".format(response.reason))
+            raise DataApiError("Unable to get {}.".format(endpoint), response.status)
+    finally:
+        if own_client:
+            await client.close()
+
+
+async def get_volumes(data_api_config: htrc.config.HtrcDataApiConfig, volume_ids, concat=False, mets=False,
+                      buffer_size=DEFAULT_CHUNK_SIZE, spool_max_size=None, client=None, named_spool=False):
+    """
+    Returns volumes from the Data API as a raw zip stream.
+
+    Parameters:
+    :data_api_config: The configuration data of the DataAPI endpoint.
+    :volume_ids: A list of volume_ids
+    :concat: If True, return a single file per volume. If False, return a single
+    file per page (default).
+    :buffer_size: The max size in bytes of each chunk read from the response.
+    :spool_max_size: If set, stream the response into a temporary file which is
+    kept in memory up to this many bytes and rolled over to disk beyond that. The
+    open file, rewound to the start, is returned instead of bytes.
+    :client: An `AsyncDataApiClient` whose connections are reused for the request.
+    If not given, a client is created for this request only.
+    :named_spool: If True, stream the response into a named temporary file on
+    disk instead, which other processes can open by its `name`. The open file,
+    rewound to the start, is returned instead of bytes.
+    """
+    if not volume_ids:
+        raise ValueError("volume_ids is empty.")
+
+    data = {'volumeIDs': '|'.join(
+        [id.replace('+', ':').replace('=', '/') for id in volume_ids])}
+
+    if concat:
+        data['concat'] = 'true'
+
+    if mets:
+        data['mets'] = 'true'
+
+    return await _get(data_api_config, "volumes", data, buffer_size, spool_max_size, client, named_spool)
+
+
+async def get_pages(data_api_config: htrc.config.HtrcDataApiConfig, page_ids, concat=False, mets=False,
+                    buffer_size=DEFAULT_CHUNK_SIZE, spool_max_size=None, client=None, named_spool=False):
+    """
+    Returns a ZIP file containing specfic pages.
+
+    Parameters:
+    :data_api_config: The configuration data of the DataAPI endpoint.
+    :page_ids: A list of page_ids
+    :concat: If True, return a single file per volume. If False, return a single
+    file per page (default).
+    :buffer_size: See `get_volumes`.
+    :spool_max_size: See `get_volumes`.
+    :client: See `get_volumes`.
+    :named_spool: See `get_volumes`.
+    """
+    if not page_ids:
+        raise ValueError("page_ids is empty.")
+
+    data = {'pageIDs': '|'.join(
+        [id.replace('+', ':').replace('=', '/') for id in page_ids])}
+
+    if concat and mets:
+        print("Cannot set both concat and mets with pages.")
+    elif concat:
+        data['concat'] = 'true'
+    elif mets:
+        data['mets'] = 'true'
+
+    return await _get(data_api_config, "pages", data, buffer_size, spool_max_size, client, named_spool)
+
+
+class EventLoopThread:
+    """
+    Runs an event loop in a background thread, so that blocking code (such as
+    `htrc.volumes.download_volumes`) can run coroutines on it from any thread.
+    """
+
+    def __init__(self) -> None:
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, name='htrc-aio', daemon=True)
+
+    def __enter__(self) -> 'EventLoopThread':
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.loop.close()
+
+    def run(self, coroutine):
+        """
+        Runs `coroutine` on the event loop and returns its result. If the calling
+        thread is interrupted while waiting, the coroutine is cancelled.
+        """
+        future = asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+        try:
+            return future.result()
+        except BaseException:
+            future.cancel()
+            raise
@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+"""
+`htrc.volumes.batching`
+
+Contains the batching strategies used by `download_volumes` to split a list of
+volume ids into Data API requests.
+"""
+from __future__ import print_function
+from future import standard_library
+
+standard_library.install_aliases()
+
+import http.client
+import os
+import random
+import socket
+import ssl
+import threading
+import time
+from typing import Any, Callable, Iterator, List, Tuple, TypeVar
+
+from htrc.volumes.client import DataApiError
+
+import logging
+from logging import NullHandler
+
+logging.getLogger(__name__).addHandler(NullHandler())
+
+T = TypeVar('T')
+
+
+class AdaptiveBatcher:
+    """
+    Splits `volume_ids` into batches whose size follows the observed cost of the
+    previous requests.
+
+    After each request, `observe` is told how many volumes it contained, how many
+    bytes the response had and how long it took. The next batch is sized so that
+    it is expected to stay within both `target_bytes` and `target_seconds`,
+    bounded by `min_size` and `max_size`. A batch at most doubles in size from one
+    request to the next, while shrinking takes effect immediately.
+    """
+
+    # weight of the latest observation in the running per-volume averages
+    SMOOTHING = 0.5
+
+    def __init__(self, volume_ids: List[str], initial_size: int = 250, min_size: int = 10, max_size: int = 1000,
+                 target_bytes: int = 256 * 1024 * 1024, target_seconds: float = 60) -> None:
+        if not 0 < min_size <= max_size:
+            raise ValueError("Invalid batch size bounds specified")
+
+        self.volume_ids = volume_ids
+        self.min_size = min_size
+        self.max_size = max_size
+        self.target_bytes = target_bytes
+        self.target_seconds = target_seconds
+        self.batch_size = min(max(initial_size, min_size), max_size)
+        self.bytes_per_volume = None
+        self.seconds_per_volume = None
+        self._lock = threading.Lock()
+
+    def __iter__(self) -> Iterator[List[str]]:
+        start = 0
+        while start < len(self.volume_ids):
+            with self._lock:
+                end = start + self.batch_size
+            yield self.volume_ids[start:end]
+            start = end
+
+    def _average(self, average, value):
+        if average is None:
+            return value
+
+        return self.SMOOTHING * value + (1 - self.SMOOTHING) * average
+
+    def observe(self, num_volumes: int, num_bytes: int, seconds: float) -> None:
+        """
+        Updates the size of the following batches from a completed request.
+        """
+        if num_volumes <= 0:
+            return
+
+        with self._lock:
+            self.bytes_per_volume = self._average(self.bytes_per_volume, num_bytes / num_volumes)
+            self.seconds_per_volume = self._average(self.seconds_per_volume, seconds / num_volumes)
+
+            size = self.max_size
+            if self.bytes_per_volume > 0:
+                size = min(size, int(self.target_bytes / self.bytes_per_volume))
+            if self.seconds_per_volume > 0:
+                size = min(size, int(self.target_seconds / self.seconds_per_volume))
+
+            self.batch_size = max(self.min_size, min(size, 2 * self.batch_size))
+
+        logging.debug("Next batch size: {} ({:,.0f} bytes/volume, {:.3f}s/volume)".format(
+            self.batch_size, self.bytes_per_volume, self.seconds_per_volume))
+
+
+class RetryPolicy:
+    """
+    Decides whether and when a failed Data API request is retried.
+
+    A request is attempted at most `max_attempts` times. The n-th retry waits for
+    `backoff * 2 ** (n - 1)` seconds, capped at `max_backoff`, of which a random
+    part (`jitter`, between 0 and 1) is dropped so that concurrent clients do not
+    retry in lockstep.
+
+    Only network failures (connection errors, timeouts, TLS streams closed early
+    and truncated responses) and Data API errors with a 429 or 5xx status are
+    retried. Other errors, such as a missing client certificate, a certificate
+    verification error or a full disk, are raised right away.
+    """
+
+    # errors raised by failed requests, including socket errors, connections closed in the middle of the TLS stream
+    # (but not other SSL errors such as certificate errors) and truncated responses
+    NETWORK_ERRORS = (ConnectionError, TimeoutError, socket.timeout, ssl.SSLEOFError, ssl.SSLZeroReturnError,
+                      http.client.HTTPException)
+
+    # errors which `call` may retry: network errors and the Data API errors for which `is_retryable` is True
+    RETRYABLE_ERRORS = NETWORK_ERRORS + (DataApiError,)
+
+    # HTTP statuses for which retrying or splitting a batch cannot help
+    FATAL_STATUSES = (401, 403)
+
+    # HTTP statuses of transient Data API errors, in addition to 5xx
+    RETRYABLE_STATUSES = (429,)
+
+    def __init__(self, max_attempts: int = 3, backoff: float = 1.0, max_backoff: float = 30.0,
+                 jitter: float = 0.5) -> None:
+        if max_attempts < 1:
+            raise ValueError("Invalid number of attempts specified")
+
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+
+    def is_fatal(self, error: BaseException) -> bool:
+        return getattr(error, 'status', None) in self.FATAL_STATUSES
+
+    def is_retryable(self, error: BaseException) -> bool:
+        """
+        Returns whether a request which failed with `error` may succeed if sent again.
+        """
+        if isinstance(error, DataApiError):
+            return error.status is not None and (error.status in self.RETRYABLE_STATUSES or error.status >= 500)
+
+        return isinstance(error, self.NETWORK_ERRORS)
+
+    def can_bisect(self, error: BaseException) -> bool:
+        """
+        Returns whether a batch which failed with `error` is worth splitting up:
+        if the error may be caused by one of its volumes, i.e. after retries, or
+        when the Data API rejects the batch.
+        """
+        if isinstance(error, DataApiError):
+            return not self.is_fatal(error)
+
+        return self.is_retryable(error)
+
+    def delay(self, retry: int) -> float:
+        """
+        Returns the number of seconds to wait before the given retry (starting at 1).
+        """
+        delay = min(self.max_backoff, self.backoff * 2 ** (retry - 1))
+
+        return delay * (1 - self.jitter * random.random())
+
+    def call(self, func: Callable[..., T], *args, **kwargs) -> T:
+        """
+        Calls `func`, retrying it when it raises an error for which
+        `is_retryable` is True.
+        """
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                return func(*args, **kwargs)
+            except self.RETRYABLE_ERRORS as e:
+                if not self.is_retryable(e) or attempt == self.max_attempts:
+                    raise
+                delay = self.delay(attempt)
+                logging.warning("Data API request failed ({}), retrying in {:.1f}s".format(e, delay))
+                time.sleep(delay)
+
+
+class FetchedBatch:
+    """
+    The outcome of fetching a batch with `fetch_bisecting`: the responses of the
+    (sub-)batches which succeeded, as `(volume_ids, data)` pairs, and the volume
+    ids which could not be fetched.
+    """
+
+    def __init__(self) -> None:
+        self.parts = []  # type: List[Tuple[List[str], Any]]
+        self.failed = []  # type: List[str]
+
+    def size(self) -> int:
+        """
+        Returns the total number of bytes of the responses. Responses which were
+        extracted while being received (see `htrc.volumes.zipstream`) take no space.
+        """
+        num_bytes = 0
+        for _, data in self.parts:
+            if not hasattr(data, 'seek'):
+                continue
+            position = data.tell()
+            num_bytes += data.seek(0, os.SEEK_END)
+            data.seek(position)
+
+        return num_bytes
+
+    def close(self) -> None:
+        for _, data in self.parts:
+            data.close()
+
+
+def fetch_bisecting(fetch: Callable[[List[str]], Any], volume_ids: List[str],
+                    retry_policy: RetryPolicy = None) -> FetchedBatch:
+    """
+    Fetches `volume_ids` with `fetch`, retrying according to `retry_policy`.
+
+    If a batch still fails, it is split in halves which are fetched separately,
+    recursively, so that a volume which makes the Data API fail does not keep the
+    rest of its batch from being downloaded. Single volumes which cannot be
+    fetched are reported in `FetchedBatch.failed`. Errors which splitting the
+    batch cannot help with (see `RetryPolicy.can_bisect`) are raised.
+    """
+    retry_policy = retry_policy or RetryPolicy()
+    batch = FetchedBatch()
+
+    def _fetch(ids):
+        try:
+            batch.parts.append((ids, retry_policy.call(fetch, ids)))
+        except RetryPolicy.RETRYABLE_ERRORS as e:
+            if not retry_policy.can_bisect(e):
+                raise
+            if len(ids) == 1:
+                logging.warning("Unable to download {}: {}".format(ids[0], e))
+                batch.failed.extend(ids)
+            else:
+                logging.info("Splitting failed batch of {} volumes".format(len(ids)))
+                middle = len(ids) // 2
+                _fetch(ids[:middle])
+                _fetch(ids[middle:])
+
+    try:
+        _fetch(list(volume_ids))
+    except BaseException:
+        batch.close()
+        raise
+
+    return batch
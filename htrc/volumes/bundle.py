@@ -0,0 +1,333 @@
+#!/usr/bin/env python
+"""
+`htrc.volumes.bundle`
+
+Contains the packed "workset bundle" output format of `download_volumes`, and
+a reader for it.
+
+Writing one file per page creates millions of small files for large worksets,
+which can exhaust the inodes of the secure volume. A bundle instead stores the
+files of the `output_dir` layout (e.g. 'mdp.39015050817181/00000001.txt') as
+the members of compressed ZIP archives: either a single `workset.zip` for the
+whole workset, or one `<volume>.zip` per volume. The central directory of each
+archive serves as the index for random access to volumes and pages.
+"""
+from __future__ import print_function
+from future import standard_library
+
+standard_library.install_aliases()
+
+import os
+import os.path
+import threading
+import time
+from typing import Callable, Dict, Iterable, Iterator, List, Tuple, Union
+from zipfile import BadZipFile, ZipFile, ZIP_DEFLATED
+
+from htrc.models import HtrcPage, decode_lines
+from htrc.volumes.cache import volume_dir
+from htrc.volumes.zipindex import ZipIndex
+from htrc.volumes.zipstream import iter_zip_members
+
+import logging
+from logging import NullHandler
+
+logging.getLogger(__name__).addHandler(NullHandler())
+
+BUNDLE_FILENAME = 'workset.zip'
+
+BUNDLE_MODES = ('workset', 'volume')
+
+# the seconds between two rewrites of the central directory of a workset bundle
+DEFAULT_CHECKPOINT_INTERVAL = 60
+
+
+class BundleWriter:
+    """
+    Writes the files of downloaded volumes into the bundle(s) in `output_dir`.
+
+    With `mode='workset'`, all volumes go into `output_dir/workset.zip`, which is
+    appended to if it exists (e.g. when resuming a download). Its central
+    directory is only written by `checkpoint` (at most every
+    `checkpoint_interval` seconds) and `close`; if the download was interrupted
+    in between, the members written before the interruption are recovered from
+    their local headers when the bundle is opened again. With `mode='volume'`,
+    each volume goes into its own `output_dir/<volume>.zip`, to which the files
+    of a volume written again by the same writer (e.g. the pages of a volume
+    split across batches) are added.
+
+    `replace` holds the directory names of the volumes which are about to be
+    written again, e.g. those which are not in the journal of an interrupted
+    download: their members already in the workset bundle are dropped when it
+    is opened, so that they are not stored twice.
+    """
+
+    def __init__(self, output_dir: str, mode: str = 'workset', replace: Iterable[str] = (),
+                 checkpoint_interval: float = DEFAULT_CHECKPOINT_INTERVAL) -> None:
+        if mode not in BUNDLE_MODES:
+            raise ValueError("Invalid bundle mode specified: {}".format(mode))
+
+        self.output_dir = output_dir
+        self.mode = mode
+        self.checkpoint_interval = checkpoint_interval
+        self._workset_zip = None
+        self._last_checkpoint = time.monotonic()
+        self._written_paths = set()  # the volume bundles written by this writer
+        if mode == 'workset':
+            self._open_workset(set(replace))
+
+    def _open_workset(self, replace: set = None) -> None:
+        path = os.path.join(self.output_dir, BUNDLE_FILENAME)
+        if not os.path.exists(path):
+            self._workset_zip = ZipFile(path, 'w', ZIP_DEFLATED)
+            return
+
+        if replace is not None:
+            def keep(name):
+                return _member_volume(name) not in replace
+
+            # in append mode, ZipFile would silently append to a file without a valid central directory
+            try:
+                with ZipFile(path) as bundle_zip:
+                    names = bundle_zip.namelist()
+                if len(set(names)) < len(names) or not all(map(keep, names)):
+                    logging.warning("Dropping the members of incomplete volumes from the bundle {}".format(path))
+                    _rewrite(path, keep)
+            except BadZipFile:
+                logging.warning("Recovering the members of the incomplete bundle {}".format(path))
+                _recover(path, keep)
+        self._workset_zip = ZipFile(path, 'a', ZIP_DEFLATED)
+
+    def checkpoint(self, force: bool = False) -> None:
+        """
+        Flushes the workset bundle, and writes its central directory if
+        `checkpoint_interval` seconds have passed since it was last written (or
+        if `force` is True), so that it holds all volumes written so far even if
+        the download is interrupted later on.
+
+        Writing the central directory takes time proportional to the number of
+        members of the bundle, so it is not written after every batch; the
+        members written since are recovered from their local headers.
+        """
+        if self._workset_zip is None:
+            return
+
+        if force or time.monotonic() - self._last_checkpoint >= self.checkpoint_interval:
+            self._workset_zip.close()
+            self._open_workset()
+            self._last_checkpoint = time.monotonic()
+        else:
+            self._workset_zip.fp.flush()
+
+    def __enter__(self) -> 'BundleWriter':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def write_volume(self, vol_path: str, files: Iterable[Tuple[str, Union[str, bytes]]]) -> None:
+        """
+        Writes the `files` of a volume, as `(path, contents)` pairs with paths
+        relative to the output directory (e.g. 'mdp.39015050817181/00000001.txt').
+        """
+        if self._workset_zip is not None:
+            for path, contents in files:
+                self._workset_zip.writestr(path, contents)
+            return
+
+        path = os.path.join(self.output_dir, vol_path.rstrip('/') + '.zip')
+        tmp_path = path + '.tmp'
+        # the volume's archive is only moved into place once complete
+        with ZipFile(tmp_path, 'w', ZIP_DEFLATED) as vol_zip:
+            if path in self._written_paths:
+                # the files written earlier are kept, unless written again
+                files = list(files)
+                names = {member for member, _ in files}
+                with ZipFile(path) as written_zip:
+                    for info in written_zip.infolist():
+                        if info.filename not in names:
+                            vol_zip.writestr(info, written_zip.read(info))
+            for member, contents in files:
+                vol_zip.writestr(member, contents)
+        os.replace(tmp_path, path)
+        self._written_paths.add(path)
+
+    def write_zip(self, vols_zip: ZipFile, zip_index: ZipIndex) -> None:
+        """
+        Writes all volumes of a Data API response `vols_zip`, and its other
+        top-level members (except `ERROR.err` and `volume-rights.txt`).
+        """
+        for vol_path in zip_index.volume_paths:
+            self.write_volume(vol_path, ((member, vols_zip.read(member))
+                                         for member in zip_index.volume_members(vol_path)))
+        for member in zip_index.other:
+            self.write_volume(os.path.splitext(member)[0], [(member, vols_zip.read(member))])
+
+    def close(self) -> None:
+        if self._workset_zip is not None:
+            self._workset_zip.close()
+            self._workset_zip = None
+
+
+def _member_volume(name: str) -> str:
+    # the directory name of the volume a member of the output layout belongs to
+    if '/' in name:
+        return name.split('/', 1)[0]
+    if name.endswith('_removed_hf.csv'):
+        return name[:-len('_removed_hf.csv')]
+    return os.path.splitext(name)[0]
+
+
+def _rewrite(path: str, keep: Callable[[str], bool]) -> None:
+    # keeps the last entry of each name among the members to keep
+    with ZipFile(path) as bundle_zip, ZipFile(path + '.tmp', 'w', ZIP_DEFLATED) as rewritten_zip:
+        infos = {info.filename: info for info in bundle_zip.infolist()}
+        for info in sorted(infos.values(), key=lambda info: info.header_offset):
+            if keep(info.filename):
+                rewritten_zip.writestr(info.filename, bundle_zip.read(info))
+    os.replace(path + '.tmp', path)
+
+
+def _recover(path: str, keep: Callable[[str], bool]) -> None:
+    # keeps the members which were completely written before the central directory was lost: a first
+    # pass finds the last entry of each name, as a volume written again appends new entries of its files
+    def members():
+        with open(path, 'rb') as bundle_file:
+            try:
+                for member in iter_zip_members(bundle_file):
+                    yield member
+            except BadZipFile:
+                pass
+
+    last_entries = {name: i for i, (name, _) in enumerate(members())}
+    num_members = 0
+    with ZipFile(path + '.tmp', 'w', ZIP_DEFLATED) as recovered_zip:
+        for i, (name, data) in enumerate(members()):
+            if last_entries[name] == i and keep(name):
+                recovered_zip.writestr(name, data)
+                num_members += 1
+    os.replace(path + '.tmp', path)
+    logging.warning("Recovered {:,} members of {}".format(num_members, path))
+
+
+def is_bundle(path: str) -> bool:
+    """
+    Returns True if `path` is a bundle file, or a directory holding bundles.
+    """
+    if os.path.isdir(path):
+        return os.path.isfile(os.path.join(path, BUNDLE_FILENAME)) or \
+            any(name.endswith('.zip') for name in os.listdir(path))
+
+    return path.endswith('.zip') and os.path.isfile(path)
+
+
+class WorksetBundle:
+    """
+    Reads volumes and pages from the bundle(s) written by `download_volumes`.
+
+    `path` is either a bundle file, or an output directory holding a
+    `workset.zip` or per-volume archives. Volumes are identified by their
+    directory names in the output layout, or by their volume ids. Archives are
+    opened on first access and kept open until `close`; reads are thread-safe.
+    """
+
+    def __init__(self, path: str) -> None:
+        if os.path.isdir(path) and os.path.isfile(os.path.join(path, BUNDLE_FILENAME)):
+            archives = [os.path.join(path, BUNDLE_FILENAME)]
+        elif os.path.isdir(path):
+            archives = sorted(os.path.join(path, name) for name in os.listdir(path) if name.endswith('.zip'))
+        else:
+            archives = [path]
+
+        self._archives = {}  # type: Dict[str, ZipFile]
+        self._volumes = {}  # type: Dict[str, Tuple[str, List[str], List[str]]]
+        self._lock = threading.Lock()
+
+        for archive in archives:
+            with ZipFile(archive) as bundle_zip:
+                zip_index = ZipIndex(bundle_zip.namelist())
+            for vol_path, vol_files in zip_index.pages.items():
+                self._volumes[vol_path[:-1]] = (archive, vol_files,
+                                                [member for member in vol_files if member.endswith('.txt')])
+            for member in zip_index.other:
+                # concatenated volumes are stored as a single '<volume>.txt' file
+                if member.endswith('.txt'):
+                    self._volumes.setdefault(member[:-len('.txt')], (archive, [member], [member]))
+
+    def __enter__(self) -> 'WorksetBundle':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def __len__(self) -> int:
+        return len(self._volumes)
+
+    def __contains__(self, volume_id: str) -> bool:
+        return volume_dir(volume_id) in self._volumes
+
+    @property
+    def volume_ids(self) -> List[str]:
+        """
+        The volumes in the bundle, by their directory names in the output layout.
+        """
+        return list(self._volumes)
+
+    def _volume(self, volume_id: str) -> Tuple[str, List[str], List[str]]:
+        try:
+            return self._volumes[volume_dir(volume_id)]
+        except KeyError:
+            raise KeyError("Volume {} is not in the bundle".format(volume_id))
+
+    def files(self, volume_id: str) -> List[str]:
+        """
+        Returns the paths of the files of a volume, in page order.
+        """
+        return list(self._volume(volume_id)[1])
+
+    def page_names(self, volume_id: str) -> List[str]:
+        """
+        Returns the paths of the pages of a volume (i.e. its text files), in order.
+        """
+        return list(self._volume(volume_id)[2])
+
+    def read(self, member: str, archive: str = None) -> bytes:
+        """
+        Returns the contents of a file of the bundle, by its path in the output
+        layout.
+        """
+        if archive is None:
+            volume_id = member.split('/', 1)[0] if '/' in member else os.path.splitext(member)[0]
+            archive = self._volume(volume_id)[0]
+
+        with self._lock:
+            if archive not in self._archives:
+                self._archives[archive] = ZipFile(archive)
+            return self._archives[archive].read(member)
+
+    def page(self, volume_id: str, page: Union[int, str]) -> HtrcPage:
+        """
+        Returns a page of a volume, by its index (from 0) or its path.
+        """
+        archive, _, vol_pages = self._volume(volume_id)
+        member = vol_pages[page] if isinstance(page, int) else page
+        return HtrcPage(decode_lines(self.read(member, archive)))
+
+    def pages(self, volume_id: str) -> List[HtrcPage]:
+        """
+        Returns all pages of a volume.
+        """
+        return [self.page(volume_id, page) for page in self._volume(volume_id)[2]]
+
+    def __iter__(self) -> Iterator[Tuple[str, List[HtrcPage]]]:
+        """
+        Yields `(volume_id, pages)` for each volume of the bundle.
+        """
+        for volume_id in self._volumes:
+            yield volume_id, self.pages(volume_id)
+
+    def close(self) -> None:
+        with self._lock:
+            archives, self._archives = self._archives, {}
+        for archive in archives.values():
+            archive.close()
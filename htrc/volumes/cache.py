@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+"""
+`htrc.volumes.cache`
+
+Contains an on-disk cache of the volumes returned by the HTRC Data API, so
+that worksets which overlap with earlier downloads only request the volumes
+which have not been downloaded before.
+
+Each volume is stored as a small ZIP file holding the volume's members as they
+appeared in the Data API response. Entries are addressed by a hash of the
+volume (or page) id and of the request options (`concat`, `mets`, `pages`),
+and the least recently used entries are evicted once the cache exceeds its
+size limit.
+"""
+from __future__ import print_function
+from future import standard_library
+
+standard_library.install_aliases()
+
+from collections import OrderedDict
+import hashlib
+import json
+import os
+import os.path
+from tempfile import NamedTemporaryFile, SpooledTemporaryFile
+from typing import Iterable, List, Tuple
+from zipfile import ZipFile, ZIP_DEFLATED, ZIP_STORED
+
+import logging
+from logging import NullHandler
+
+logging.getLogger(__name__).addHandler(NullHandler())
+
+DEFAULT_CACHE_DIR = os.path.expanduser('~/.htrc-cache')
+DEFAULT_CACHE_MAX_SIZE = 10 * 1024 * 1024 * 1024
+
+
+def volume_dir(volume_id: str) -> str:
+    """
+    Returns the name of the directory holding a volume (or the pages of a
+    volume) in Data API responses.
+    """
+    return volume_id.split('[', 1)[0].replace(':', '+').replace('/', '=')
+
+
+class VolumeCache:
+    """
+    An LRU cache of Data API volume payloads stored under `cache_dir`, holding up
+    to `max_size` bytes.
+    """
+
+    def __init__(self, cache_dir: str = DEFAULT_CACHE_DIR, max_size: int = DEFAULT_CACHE_MAX_SIZE) -> None:
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.size = 0
+        self.hits = self.misses = 0
+        self._entries = OrderedDict()  # entry path -> size, least recently used first
+
+        os.makedirs(cache_dir, exist_ok=True)
+        self._load()
+
+    def _load(self) -> None:
+        entries = []
+        for dirpath, _, filenames in os.walk(self.cache_dir):
+            for filename in filenames:
+                if filename.endswith('.zip'):
+                    stat = os.stat(os.path.join(dirpath, filename))
+                    entries.append((stat.st_mtime, os.path.join(dirpath, filename), stat.st_size))
+
+        for _, path, size in sorted(entries):
+            self._entries[path] = size
+            self.size += size
+
+    @staticmethod
+    def key(volume_id: str, concat: bool = False, mets: bool = False, pages: bool = False) -> str:
+        """
+        Returns the key addressing a volume downloaded with the given options.
+        """
+        options = {'concat': bool(concat), 'mets': bool(mets), 'pages': bool(pages)}
+
+        return hashlib.sha256(json.dumps([volume_id, options], sort_keys=True).encode('utf-8')).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], key + '.zip')
+
+    def __contains__(self, key: str) -> bool:
+        return self._path(key) in self._entries
+
+    def partition(self, volume_ids: Iterable[str], **options) -> Tuple[List[str], List[str]]:
+        """
+        Splits `volume_ids` into the ones which are cached for `options` and the
+        ones which are not.
+        """
+        cached, missing = [], []
+        for volume_id in volume_ids:
+            (cached if self.key(volume_id, **options) in self else missing).append(volume_id)
+
+        self.hits += len(cached)
+        self.misses += len(missing)
+
+        return cached, missing
+
+    def get_batch(self, volume_ids: Iterable[str], **options):
+        """
+        Returns the cached volumes as a Data API response, i.e. a ZIP file (in a
+        rewound `SpooledTemporaryFile`) holding the members of all volumes.
+        """
+        data = SpooledTemporaryFile(max_size=64 * 1024 * 1024)
+        names = set()
+        try:
+            with ZipFile(data, 'w', ZIP_STORED) as batch_zip:
+                for volume_id in volume_ids:
+                    path = self._path(self.key(volume_id, **options))
+                    with ZipFile(path) as vol_zip:
+                        for info in vol_zip.infolist():
+                            # the entries of page ids of the same volume share its directory (and maybe pages)
+                            if info.filename not in names:
+                                names.add(info.filename)
+                                batch_zip.writestr(info.filename, vol_zip.read(info))
+                    # mark the entry as the most recently used
+                    os.utime(path)
+                    self._entries.move_to_end(path)
+        except BaseException:
+            data.close()
+            raise
+
+        data.seek(0)
+        return data
+
+    def put(self, volume_id: str, vols_zip: ZipFile, members: List[str], **options) -> None:
+        """
+        Stores the `members` of a Data API response `vols_zip` which belong to a
+        volume.
+        """
+        path = self._path(self.key(volume_id, **options))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # write to a temporary file first so that concurrent readers never see a partial entry
+        with NamedTemporaryFile(dir=os.path.dirname(path), suffix='.tmp', delete=False) as entry:
+            try:
+                with ZipFile(entry, 'w', ZIP_DEFLATED) as vol_zip:
+                    for member in members:
+                        vol_zip.writestr(member, vols_zip.read(member))
+            except BaseException:
+                os.remove(entry.name)
+                raise
+        os.replace(entry.name, path)
+
+        self.size -= self._entries.pop(path, 0)
+        self._entries[path] = os.path.getsize(path)
+        self.size += self._entries[path]
+        self._evict()
+
+    def _evict(self) -> None:
+        while self.size > self.max_size and self._entries:
+            path, size = self._entries.popitem(last=False)
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.size -= size
+            logging.debug("Evicted {} from the volume cache".format(path))
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+"""
+`htrc.volumes.client`
+
+Contains a reusable client for the HTRC Data API. The client creates a single
+SSL context, loading the client certificate and key once, and keeps its HTTPS
+connections alive so that consecutive requests skip the TLS handshake.
+"""
+from __future__ import print_function
+from future import standard_library
+
+standard_library.install_aliases()
+
+from contextlib import contextmanager
+import http.client
+import ssl
+import threading
+from typing import Optional
+from urllib.parse import urlencode
+
+import htrc.config
+
+import logging
+from logging import NullHandler
+
+logging.getLogger(__name__).addHandler(NullHandler())
+
+# seconds to wait for a connection, or for the next data on it
+DEFAULT_TIMEOUT = 300
+
+
+class DataApiError(EnvironmentError):
+    """
+    Raised when the Data API responds to a request with an error status.
+    """
+
+    def __init__(self, message: str, status: int = None) -> None:
+        super().__init__(message)
+        self.status = status
+
+
+class DataApiClient:
+    """
+    A client for the HTRC Data API holding a pool of keep-alive connections.
+
+    The client is safe to share between threads: each request checks out an idle
+    connection (or opens a new one) and returns it to the pool once the response
+    has been read. At most `max_idle_connections` connections are kept open.
+
+    Connecting and each read of a response fail with `socket.timeout` after
+    `timeout` seconds (None to wait forever), so that a stalled request is
+    retried rather than blocking its thread.
+    """
+
+    def __init__(self, data_api_config: htrc.config.HtrcDataApiConfig = None, max_idle_connections: int = 4,
+                 timeout: Optional[float] = DEFAULT_TIMEOUT) -> None:
+        self.config = data_api_config or htrc.config.HtrcDataApiConfig()
+        self.max_idle_connections = max_idle_connections
+        self.timeout = timeout
+        self._ssl_context = None
+        self._idle_connections = []
+        self._lock = threading.Lock()
+
+    def __enter__(self) -> 'DataApiClient':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    @property
+    def ssl_context(self) -> ssl.SSLContext:
+        with self._lock:
+            if self._ssl_context is None:
+                # TODO: Fix SSL cert verification
+                ctx = ssl.create_default_context()
+                ctx.check_hostname = False
+                #ctx.verify_mode = ssl.CERT_NONE
+                if self.config.cert:
+                    ctx.load_cert_chain(self.config.cert, self.config.key)
+                self._ssl_context = ctx
+
+            return self._ssl_context
+
+    def _new_connection(self) -> http.client.HTTPSConnection:
+        return http.client.HTTPSConnection(self.config.host, self.config.port, timeout=self.timeout,
+                                           context=self.ssl_context)
+
+    def _checkout(self):
+        with self._lock:
+            if self._idle_connections:
+                return self._idle_connections.pop(), True
+
+        return self._new_connection(), False
+
+    def _checkin(self, connection) -> None:
+        with self._lock:
+            if len(self._idle_connections) < self.max_idle_connections:
+                self._idle_connections.append(connection)
+                return
+
+        connection.close()
+
+    @contextmanager
+    def post(self, endpoint: str, data: dict):
+        """
+        Sends `data` as a form-encoded POST to `endpoint` (relative to the Data API
+        EPR) and yields the response. The connection is returned to the pool if the
+        response body was read to the end, and closed otherwise.
+        """
+        url = self.config.epr + endpoint
+        body = urlencode(data)
+        headers = {"Authorization": "Bearer " + self.config.token,
+                   "Content-type": "application/x-www-form-urlencoded"}
+
+        connection, reused = self._checkout()
+        try:
+            try:
+                connection.request("POST", url, body, headers)
+                response = connection.getresponse()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                if not reused:
+                    raise
+                # the server closed the idle keep-alive connection, retry on a fresh one
+                logging.debug("Reconnecting to Data API after stale keep-alive connection")
+                connection.close()
+                connection = self._new_connection()
+                connection.request("POST", url, body, headers)
+                response = connection.getresponse()
+
+            yield response
+        except BaseException:
+            connection.close()
+            raise
+
+        if response.isclosed() and not response.will_close:
+            self._checkin(connection)
+        else:
+            connection.close()
+
+    def close(self) -> None:
+        """
+        Closes all idle connections.
+        """
+        with self._lock:
+            connections, self._idle_connections = self._idle_connections, []
+
+        for connection in connections:
+            connection.close()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+"""
+`htrc.volumes.hfreport`
+
+Contains the writers of the reports of the headers and footers removed from
+the pages of volumes, which are saved for inspection.
+
+By default, each volume gets its own report: 'removed_hf.csv' in the volume's
+directory, or '<volume>_removed_hf.csv' next to a concatenated volume, with the
+columns `page`, `header` and `footer`. Alternatively, a single report for the
+whole workset, 'removed_hf.csv' in the output directory, has a leading
+`volume` column and is appended to as volumes are processed.
+"""
+from __future__ import print_function
+from future import standard_library
+
+standard_library.install_aliases()
+
+import csv
+from io import StringIO
+import os
+import os.path
+from typing import Iterable, List, Sequence, Tuple
+
+import logging
+from logging import NullHandler
+
+logging.getLogger(__name__).addHandler(NullHandler())
+
+REPORT_COLUMNS = ('page', 'header', 'footer')
+
+WORKSET_REPORT_FILENAME = 'removed_hf.csv'
+
+HF_REPORT_MODES = ('volume', 'workset')
+
+
+def removed_hf_rows(page_paths: Iterable[str], pages: Iterable) -> List[Tuple[str, str, str]]:
+    """
+    Returns `(page, header, footer)` for each of the `pages` with an identified
+    header or footer, where `page` is the file name of the page (from
+    `page_paths`) without its extension.
+    """
+    rows = []
+    for page_path, page in zip(page_paths, pages):
+        if not (page.has_header or page.has_footer):
+            # skip reporting pages that don't have an identified header or footer
+            continue
+        page_name, _ = os.path.splitext(os.path.basename(page_path))
+        rows.append((page_name, page.header, page.footer))
+
+    return rows
+
+
+def _to_csv(rows: Iterable[Sequence[str]], columns: Sequence[str] = None) -> str:
+    out = StringIO()
+    writer = csv.writer(out, lineterminator='\n')
+    if columns is not None:
+        writer.writerow(columns)
+    writer.writerows(rows)
+
+    return out.getvalue()
+
+
+def volume_report(rows: Iterable[Sequence[str]]) -> str:
+    """
+    Returns the CSV text of the report of a single volume.
+    """
+    return _to_csv(rows, REPORT_COLUMNS)
+
+
+class WorksetReport:
+    """
+    The append-only report of the headers and footers removed from all volumes
+    saved into `output_dir`, keyed by volume and page. If `append` is False any
+    existing report is discarded.
+
+    Each volume's rows are appended in a single write, so that reports of
+    volumes processed concurrently are never interleaved. A volume processed
+    again (e.g. when resuming a download) is reported again, and its later rows
+    supersede the earlier ones.
+    """
+
+    def __init__(self, output_dir: str, append: bool = True) -> None:
+        self.path = os.path.join(output_dir, WORKSET_REPORT_FILENAME)
+        if not append and os.path.exists(self.path):
+            os.remove(self.path)
+        self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        if os.fstat(self._fd).st_size == 0:
+            os.write(self._fd, _to_csv([], ('volume',) + REPORT_COLUMNS).encode('utf-8'))
+
+    def __enter__(self) -> 'WorksetReport':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def write_volume(self, volume: str, rows: Iterable[Sequence[str]]) -> None:
+        """
+        Appends the `(page, header, footer)` rows of `volume`.
+        """
+        data = _to_csv((volume,) + tuple(row) for row in rows)
+        if data:
+            os.write(self._fd, data.encode('utf-8'))
+
+    def sync(self) -> None:
+        """
+        Makes sure the rows written so far are on disk.
+        """
+        os.fsync(self._fd)
+
+    def close(self) -> None:
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
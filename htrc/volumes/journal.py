@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+"""
+`htrc.volumes.journal`
+
+Contains the checkpoint journal `download_volumes` keeps in its output directory.
+
+After each batch has been fully written to disk, one JSON line listing the
+volumes of the batch (together with any error and rights reports the Data API
+returned for them) is appended to the journal and synced. A line is only ever
+trusted once it is complete, so a download interrupted at any point can be
+resumed by skipping the volumes the journal lists.
+"""
+from __future__ import print_function
+from future import standard_library
+
+standard_library.install_aliases()
+
+import json
+import os
+import os.path
+from typing import Iterable, List, Set
+
+import logging
+from logging import NullHandler
+
+logging.getLogger(__name__).addHandler(NullHandler())
+
+# the `.log` extension keeps `htrc.workset.path_to_volumes` from treating the journal as a volume
+JOURNAL_FILENAME = '.htrc-download.log'
+
+
+class DownloadJournal:
+    """
+    An append-only journal of the volumes downloaded to `output_dir`.
+
+    If `resume` is False any existing journal is discarded, otherwise the
+    completed volumes, errors and rights reports it records are loaded.
+    """
+
+    def __init__(self, output_dir: str, resume: bool = False) -> None:
+        self.path = os.path.join(output_dir, JOURNAL_FILENAME)
+        self.completed = set()  # type: Set[str]
+        self.errors = []  # type: List[str]
+        self.rights = []  # type: List[str]
+
+        if resume:
+            self._load()
+        elif os.path.exists(self.path):
+            os.remove(self.path)
+
+    def _load(self) -> None:
+        if not os.path.exists(self.path):
+            return
+
+        valid_size = 0
+        with open(self.path, 'rb') as journal:
+            for line in journal:
+                if not line.endswith(b'\n'):
+                    # the process died while appending this entry, so its batch is not complete
+                    logging.debug("Ignoring incomplete journal entry at offset {}".format(valid_size))
+                    break
+                entry = json.loads(line.decode('utf-8'))
+                self.completed.update(entry['volumes'])
+                if entry.get('errors'):
+                    self.errors.append(entry['errors'])
+                if entry.get('rights'):
+                    self.rights.append(entry['rights'])
+                valid_size += len(line)
+
+        # drop an incomplete trailing entry so that new entries start on a fresh line
+        if valid_size < os.path.getsize(self.path):
+            os.truncate(self.path, valid_size)
+
+        logging.info("Resuming download: {:,} volumes already completed".format(len(self.completed)))
+
+    def remaining(self, volume_ids: Iterable[str]) -> List[str]:
+        """
+        Returns the volume ids which have not been completed yet.
+        """
+        return [volume_id for volume_id in volume_ids if volume_id not in self.completed]
+
+    def record(self, volume_ids: Iterable[str], errors: str = None, rights: str = None) -> None:
+        """
+        Durably records a batch of volumes as completed.
+        """
+        volume_ids = list(volume_ids)
+        entry = json.dumps({'volumes': volume_ids, 'errors': errors, 'rights': rights}) + '\n'
+
+        # a single write to a file opened for appending, followed by a sync, so the
+        # entry is either fully on disk or detected as incomplete when loading
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, entry.encode('utf-8'))
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+        self.completed.update(volume_ids)
+        if errors:
+            self.errors.append(errors)
+        if rights:
+            self.rights.append(rights)
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+"""
+`htrc.volumes.manifest`
+
+Contains the manifest `clean_volumes` keeps in its output directory.
+
+Each volume whose headers and footers were removed is recorded by appending
+one JSON line with the parameters of the removal and a signature of the
+volume's pages in the source directory. A volume is up to date, and skipped
+when cleaning again, as long as both are unchanged and its output exists.
+"""
+from __future__ import print_function
+from future import standard_library
+
+standard_library.install_aliases()
+
+import json
+import os
+import os.path
+from typing import Dict, List, Optional, Tuple
+
+import logging
+from logging import NullHandler
+
+logging.getLogger(__name__).addHandler(NullHandler())
+
+# the `.log` extension keeps `htrc.workset.path_to_volumes` from treating the manifest as a volume
+MANIFEST_FILENAME = '.htrc-clean.log'
+
+
+def volume_pages(vol_path: str) -> List[str]:
+    """
+    Returns the sorted file names of the pages of the volume directory
+    `vol_path`, leaving out the reports of a previous header/footer removal.
+    """
+    return sorted(name for name in os.listdir(vol_path) if name.endswith('.txt'))
+
+
+def source_signature(vol_path: str, page_names: List[str]) -> List[int]:
+    """
+    Returns `[number of pages, total size, latest modification time]` of the
+    pages of a volume, which changes whenever a page is added, removed or
+    rewritten.
+    """
+    size = mtime = 0
+    for name in page_names:
+        stat = os.stat(os.path.join(vol_path, name))
+        size += stat.st_size
+        mtime = max(mtime, stat.st_mtime_ns)
+
+    return [len(page_names), size, mtime]
+
+
+class CleanManifest:
+    """
+    An append-only manifest of the volumes cleaned into `output_dir`.
+
+    If `force` is True any existing manifest is discarded, so that all volumes
+    are cleaned again.
+    """
+
+    def __init__(self, output_dir: str, force: bool = False) -> None:
+        self.path = os.path.join(output_dir, MANIFEST_FILENAME)
+        self.volumes = {}  # type: Dict[str, Tuple[dict, List[int]]]
+
+        if force:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+        else:
+            self._load()
+
+    def _load(self) -> None:
+        if not os.path.exists(self.path):
+            return
+
+        valid_size = 0
+        with open(self.path, 'rb') as manifest:
+            for line in manifest:
+                if not line.endswith(b'\n'):
+                    logging.debug("Ignoring incomplete manifest entry at offset {}".format(valid_size))
+                    break
+                entry = json.loads(line.decode('utf-8'))
+                # later entries supersede earlier ones for the same volume
+                self.volumes[entry['volume']] = (entry['params'], entry['source'])
+                valid_size += len(line)
+
+        if valid_size < os.path.getsize(self.path):
+            os.truncate(self.path, valid_size)
+
+    def is_up_to_date(self, volume: str, params: dict, source: List[int]) -> bool:
+        """
+        Returns True if `volume` was cleaned with `params` from pages with the
+        signature `source`.
+        """
+        recorded = self.volumes.get(volume)  # type: Optional[Tuple[dict, List[int]]]
+        return recorded is not None and recorded[0] == params and recorded[1] == source
+
+    def record(self, volume: str, params: dict, source: List[int]) -> None:
+        """
+        Durably records that `volume` was cleaned.
+        """
+        entry = json.dumps({'volume': volume, 'params': params, 'source': source}) + '\n'
+
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, entry.encode('utf-8'))
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+        self.volumes[volume] = (params, source)
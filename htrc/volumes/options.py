@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+"""
+`htrc.volumes.options`
+
+Contains the groups of options of `download_volumes` (and `iter_volumes`):
+how responses are transferred, how volumes are batched, and how the output is
+saved.
+"""
+from __future__ import print_function
+from future import standard_library
+
+standard_library.install_aliases()
+
+from typing import Iterable, List, Optional
+
+from htrc.util import split_items
+from htrc.volumes.batching import AdaptiveBatcher
+from htrc.volumes.bundle import BUNDLE_MODES
+from htrc.volumes.client import DEFAULT_TIMEOUT
+
+# Responses larger than this are spooled to disk by `download_volumes`
+DEFAULT_SPOOL_MAX_SIZE = 64 * 1024 * 1024
+
+# Size of the reusable buffer responses are read into
+DEFAULT_BUFFER_SIZE = 1024 * 1024
+
+
+class TransferOptions:
+    """
+    How Data API responses are received and handed over for extraction.
+
+    Up to `concurrency` batches are downloaded at once, and the next `prefetch`
+    ones while the current one is processed; if `max_pending_bytes` is set,
+    no more batches are requested while the responses waiting to be processed
+    exceed it. Responses are read through a buffer of `buffer_size` bytes and
+    spooled to disk beyond `spool_max_size` bytes, or held in memory if it is
+    None. Requests whose connection stalls for `timeout` seconds fail (and are
+    retried), unless it is None. With `use_asyncio`, requests are multiplexed on
+    an event loop rather than made by one thread each.
+
+    With `stream_extract`, responses are extracted while they are received,
+    rather than once complete; otherwise they are extracted by
+    `extract_workers` threads. With `hf_read_from_zip`, responses are written to
+    a named temporary file on disk (whatever `spool_max_size`), from which the
+    header/footer removal workers read the pages themselves.
+    `hf_max_pending` bounds the number of volumes waiting for a worker (by
+    default, twice the number of workers).
+    """
+
+    def __init__(self, buffer_size: int = DEFAULT_BUFFER_SIZE,
+                 spool_max_size: Optional[int] = DEFAULT_SPOOL_MAX_SIZE, prefetch: int = 1, concurrency: int = 1,
+                 max_pending_bytes: Optional[int] = None, use_asyncio: bool = False, stream_extract: bool = False,
+                 extract_workers: int = 1, hf_read_from_zip: bool = False,
+                 hf_max_pending: Optional[int] = None, timeout: Optional[float] = DEFAULT_TIMEOUT) -> None:
+        if prefetch < 0:
+            raise ValueError("Invalid prefetch depth specified")
+
+        if concurrency < 1:
+            raise ValueError("Invalid concurrency level specified")
+
+        if extract_workers < 1:
+            raise ValueError("Invalid number of extraction workers specified")
+
+        if hf_max_pending is not None and hf_max_pending < 1:
+            raise ValueError("Invalid number of pending volumes specified")
+
+        if timeout is not None and timeout <= 0:
+            raise ValueError("Invalid timeout specified")
+
+        if stream_extract and use_asyncio:
+            raise ValueError("Cannot stream the extraction with asyncio.")
+
+        self.buffer_size = buffer_size
+        self.spool_max_size = spool_max_size
+        self.prefetch = prefetch
+        self.concurrency = concurrency
+        self.max_pending_bytes = max_pending_bytes
+        self.use_asyncio = use_asyncio
+        self.stream_extract = stream_extract
+        self.extract_workers = extract_workers
+        self.hf_read_from_zip = hf_read_from_zip
+        self.hf_max_pending = hf_max_pending
+        self.timeout = timeout
+
+
+class BatchOptions:
+    """
+    How the volumes are split into batches of requests.
+
+    By default batches have a fixed size. With `adaptive`, the size of each
+    batch follows the bytes per volume and the latency observed for the
+    previous requests (see `htrc.volumes.batching.AdaptiveBatcher`), between
+    `min_size` and `max_size` volumes, aiming for responses of `target_bytes`
+    bytes which take `target_seconds` seconds.
+    """
+
+    def __init__(self, adaptive: bool = False, min_size: int = 10, max_size: int = 1000,
+                 target_bytes: int = 256 * 1024 * 1024, target_seconds: float = 60) -> None:
+        self.adaptive = adaptive
+        self.min_size = min_size
+        self.max_size = max_size
+        self.target_bytes = target_bytes
+        self.target_seconds = target_seconds
+
+    def batches(self, volume_ids: List[str], batch_size: int) -> Iterable[List[str]]:
+        """
+        Returns the batches of `volume_ids`, starting with batches of `batch_size`.
+        """
+        if self.adaptive:
+            return AdaptiveBatcher(volume_ids, initial_size=batch_size, min_size=self.min_size,
+                                   max_size=self.max_size, target_bytes=self.target_bytes,
+                                   target_seconds=self.target_seconds)
+
+        return split_items(volume_ids, batch_size)
+
+
+class OutputOptions:
+    """
+    How the downloaded volumes are saved.
+
+    With `resume`, the volumes recorded in the journal of an interrupted
+    download into the same output directory are skipped. If `bundle` is set
+    ('workset' or 'volume'), the files are stored in ZIP bundles (see
+    `htrc.volumes.bundle`) rather than one file per page.
+    """
+
+    def __init__(self, resume: bool = False, bundle: Optional[str] = None) -> None:
+        if bundle is not None and bundle not in BUNDLE_MODES:
+            raise ValueError("Invalid bundle mode specified")
+
+        self.resume = resume
+        self.bundle = bundle
@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+"""
+`htrc.volumes.reader`
+
+Contains a random-access reader for worksets downloaded by `download_volumes`
+into the usual output layout: one directory of page files per volume, or one
+'<volume>.txt' file per concatenated volume.
+
+By default, each page is read from its file when it is requested. With
+`pack=True`, the first time a workset is opened the text of its pages is packed
+into a single data file next to an index of the offsets of each page. Both are
+kept in the output directory (or `index_dir`) and reused as long as the volumes
+are unchanged. The data file is memory-mapped, so reading any page of any volume
+is a constant-time lookup which does not open the page's file. Either way, pages
+are only decoded when their text is accessed.
+
+Note that the data file is a copy of the text of every page, so a packed
+workset takes twice its size on disk: only pack worksets which are read many
+times, on a disk with room for the copy (see `index_dir`).
+"""
+from __future__ import print_function
+from future import standard_library
+
+standard_library.install_aliases()
+
+from array import array
+import json
+import mmap
+import os
+import os.path
+from typing import Dict, Iterator, List, Tuple, Union
+
+from htrc.models import HtrcPage, decode_lines
+from htrc.volumes.cache import volume_dir
+from htrc.volumes.manifest import source_signature
+
+import logging
+from logging import NullHandler
+
+logging.getLogger(__name__).addHandler(NullHandler())
+
+INDEX_FILENAME = '.htrc-workset-index.json'
+DATA_FILENAME = '.htrc-workset-index.dat'
+
+INDEX_VERSION = 2
+
+# text files written by `download_volumes` next to the volumes
+REPORT_FILENAMES = ('volume-rights.txt', 'volumes_failed.txt', 'volumes_not_available.txt')
+
+
+class MappedPage(HtrcPage):
+    """
+    A page whose text is decoded from its (e.g. memory-mapped) data on first
+    access.
+    """
+
+    def __init__(self, data: Union[bytes, memoryview]) -> None:
+        super().__init__(None)
+        self._data = data
+
+    @property
+    def text_lines(self) -> List[str]:
+        if self._lines is None:
+            self._lines = decode_lines(self._data)
+            self._data = None
+
+        return self._lines
+
+
+def _volume_pages(output_dir: str) -> Dict[str, Tuple[str, List[str]]]:
+    # volume -> (path of the directory holding its pages, page names)
+    volumes = {}
+    with os.scandir(output_dir) as scan:
+        for entry in scan:
+            if entry.name.startswith('.') or entry.name in REPORT_FILENAMES:
+                continue
+            if entry.is_dir():
+                volumes[entry.name] = (entry.path, sorted(name for name in os.listdir(entry.path)
+                                                          if name.endswith('.txt')))
+            elif entry.name.endswith('.txt'):
+                volumes[entry.name[:-len('.txt')]] = (output_dir, [entry.name])
+
+    return volumes
+
+
+class WorksetReader:
+    """
+    Reads the pages of the volumes downloaded into `output_dir`.
+
+    If `pack` is True, the pages are read from a data file holding a copy of
+    all of them, which takes as much disk space as the workset. The index and
+    data file are written to `index_dir` (by default `output_dir`). They are
+    rebuilt when pages were added, removed or rewritten since they were written
+    (as told by the number, total size and latest modification time of the
+    pages of each volume), or if `rebuild` is True.
+    """
+
+    def __init__(self, output_dir: str, index_dir: str = None, rebuild: bool = False, pack: bool = False) -> None:
+        self.output_dir = output_dir
+        self.index_dir = index_dir or output_dir
+        self.pack = pack
+        self._index_path = os.path.join(self.index_dir, INDEX_FILENAME)
+        self._data_path = os.path.join(self.index_dir, DATA_FILENAME)
+
+        volumes = _volume_pages(output_dir)
+        self._paths = {volume_id: path for volume_id, (path, _) in volumes.items()}
+        self._volumes = {}  # type: Dict[str, Tuple[int, List[str]]]
+        self._data_file = self._data = self._view = None
+
+        if not pack:
+            first = 0
+            for volume_id in sorted(volumes):
+                self._volumes[volume_id] = (first, volumes[volume_id][1])
+                first += len(volumes[volume_id][1])
+            return
+
+        signatures = {volume_id: source_signature(path, page_names)
+                      for volume_id, (path, page_names) in volumes.items()}
+        index = None if rebuild else self._load_index(volumes, signatures)
+        if index is None:
+            index = self._build_index(volumes, signatures)
+
+        first = 0
+        for volume_id, _, page_names in index['volumes']:
+            self._volumes[volume_id] = (first, page_names)
+            first += len(page_names)
+        self._offsets = array('Q', index['offsets'])
+
+        self._data_file = open(self._data_path, 'rb')
+        if self._offsets[-1]:
+            self._data = mmap.mmap(self._data_file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            # an empty file cannot be mapped
+            self._data = b''
+        self._view = memoryview(self._data)
+
+    def _load_index(self, volumes, signatures):
+        try:
+            with open(self._index_path) as index_file:
+                index = json.load(index_file)
+        except (FileNotFoundError, ValueError):
+            return None
+
+        if index.get('version') != INDEX_VERSION or \
+                {volume_id: (signature, page_names) for volume_id, signature, page_names in index['volumes']} != \
+                {volume_id: (signatures[volume_id], page_names) for volume_id, (_, page_names) in volumes.items()}:
+            logging.info("The index of {} is out of date".format(self.output_dir))
+            return None
+
+        try:
+            if os.path.getsize(self._data_path) != index['offsets'][-1]:
+                return None
+        except FileNotFoundError:
+            return None
+
+        return index
+
+    def _build_index(self, volumes, signatures):
+        logging.info("Indexing the volumes of {}".format(self.output_dir))
+        indexed_volumes = []
+        offsets = [0]
+
+        with open(self._data_path + '.tmp', 'wb') as data_file:
+            for volume_id in sorted(volumes):
+                path, page_names = volumes[volume_id]
+                for name in page_names:
+                    with open(os.path.join(path, name), 'rb') as page_file:
+                        offsets.append(offsets[-1] + data_file.write(page_file.read()))
+                indexed_volumes.append([volume_id, signatures[volume_id], page_names])
+
+        index = {'version': INDEX_VERSION, 'volumes': indexed_volumes, 'offsets': offsets}
+        with open(self._index_path + '.tmp', 'w') as index_file:
+            json.dump(index, index_file)
+
+        # the data file is replaced first, so that an index never refers to a data file it was not built with
+        os.replace(self._data_path + '.tmp', self._data_path)
+        os.replace(self._index_path + '.tmp', self._index_path)
+
+        return index
+
+    def __enter__(self) -> 'WorksetReader':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def __len__(self) -> int:
+        return len(self._volumes)
+
+    def __contains__(self, volume_id: str) -> bool:
+        return volume_dir(volume_id) in self._volumes
+
+    @property
+    def volume_ids(self) -> List[str]:
+        """
+        The volumes of the workset, by their names in the output layout.
+        """
+        return list(self._volumes)
+
+    def _volume(self, volume_id: str) -> Tuple[int, List[str]]:
+        try:
+            return self._volumes[volume_dir(volume_id)]
+        except KeyError:
+            raise KeyError("Volume {} is not in {}".format(volume_id, self.output_dir))
+
+    def page_names(self, volume_id: str) -> List[str]:
+        """
+        Returns the file names of the pages of a volume, in order.
+        """
+        return list(self._volume(volume_id)[1])
+
+    def num_pages(self, volume_id: str) -> int:
+        return len(self._volume(volume_id)[1])
+
+    def page(self, volume_id: str, page: Union[int, str]) -> MappedPage:
+        """
+        Returns a page of a volume, by its index (from 0) or its file name.
+        """
+        first, page_names = self._volume(volume_id)
+        if not isinstance(page, int):
+            page = page_names.index(page)
+        elif page < 0:
+            page += len(page_names)
+        if not 0 <= page < len(page_names):
+            raise IndexError("Volume {} has no page {}".format(volume_id, page))
+
+        if not self.pack:
+            with open(os.path.join(self._paths[volume_dir(volume_id)], page_names[page]), 'rb') as page_file:
+                return MappedPage(page_file.read())
+
+        return MappedPage(self._view[self._offsets[first + page]:self._offsets[first + page + 1]])
+
+    def pages(self, volume_id: str) -> List[MappedPage]:
+        """
+        Returns all pages of a volume.
+        """
+        return [self.page(volume_id, page) for page in range(self.num_pages(volume_id))]
+
+    def __iter__(self) -> Iterator[Tuple[str, List[MappedPage]]]:
+        """
+        Yields `(volume_id, pages)` for each volume of the workset.
+        """
+        for volume_id in self._volumes:
+            yield volume_id, self.pages(volume_id)
+
+    def close(self) -> None:
+        """
+        Closes the data file. Pages of a packed workset whose text was not
+        accessed before can no longer be read.
+        """
+        if not self.pack:
+            return
+
+        self._view.release()
+        if isinstance(self._data, mmap.mmap):
+            try:
+                self._data.close()
+            except BufferError:
+                # pages which were never read still refer to the mapping, which is closed once they are gone
+                pass
+        self._data_file.close()
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+"""
+`htrc.volumes.zipindex`
+
+Contains an index of the members of a Data API response, grouped by volume.
+
+The index is built in a single pass over the member names, so that finding the
+pages of a volume does not require scanning all members of the response.
+"""
+from __future__ import print_function
+from future import standard_library
+
+standard_library.install_aliases()
+
+from collections import OrderedDict, namedtuple
+import struct
+from typing import BinaryIO, Dict, Iterable, List, Optional
+import zlib
+from zipfile import BadZipFile, ZipFile, ZipInfo, ZIP_DEFLATED, ZIP_STORED, sizeFileHeader, structFileHeader
+
+ERRORS_MEMBER = 'ERROR.err'
+RIGHTS_MEMBER = 'volume-rights.txt'
+
+# where the data of a member is found in a ZIP file, so that it can be read without parsing the whole archive
+MemberLocation = namedtuple('MemberLocation', ['name', 'header_offset', 'compress_size', 'compress_type'])
+
+
+class ZipIndex:
+    """
+    The members of a Data API response, from their names.
+
+    `volume_paths` lists the volume directories (e.g. 'mdp.39015050817181/') in
+    the order in which they appear in the response, and `pages` maps each of them
+    to the sorted paths of the volume's members. `errors` and `rights` are the
+    names of the `ERROR.err` and `volume-rights.txt` members, or None if the
+    response has no such member, and `other` lists any other top-level members.
+    A name which appears several times (e.g. a file of a volume written again
+    into a bundle) is only listed once, as `ZipFile` reads its last entry.
+
+    If the index is built with `from_zip`, `locate` returns where the data of
+    members is found in the ZIP file.
+    """
+
+    def __init__(self, names: Iterable[str], infos: Dict[str, ZipInfo] = None) -> None:
+        self._infos = infos
+        self.errors = None  # type: Optional[str]
+        self.rights = None  # type: Optional[str]
+        self.other = []  # type: List[str]
+        self.pages = OrderedDict()  # volume path -> member paths
+        self._directories = set()  # volume paths which have a directory entry
+        seen = set()
+
+        for name in names:
+            if name in seen:
+                continue
+            seen.add(name)
+            slash = name.find('/')
+            if slash < 0:
+                if name == ERRORS_MEMBER:
+                    self.errors = name
+                elif name == RIGHTS_MEMBER:
+                    self.rights = name
+                else:
+                    self.other.append(name)
+            else:
+                vol_pages = self.pages.setdefault(name[:slash + 1], [])
+                if not name.endswith('/'):
+                    vol_pages.append(name)
+                elif slash + 1 == len(name):
+                    self._directories.add(name)
+
+        for vol_pages in self.pages.values():
+            vol_pages.sort()
+
+    @classmethod
+    def from_zip(cls, vols_zip: ZipFile) -> 'ZipIndex':
+        infos = vols_zip.infolist()
+        return cls([info.filename for info in infos], {info.filename: info for info in infos})
+
+    @property
+    def volume_paths(self) -> List[str]:
+        return list(self.pages)
+
+    def __len__(self) -> int:
+        return len(self.pages)
+
+    def volume_members(self, vol_path: str) -> List[str]:
+        """
+        Returns the directory entry and the pages of a volume.
+        """
+        return ([vol_path] if vol_path in self._directories else []) + self.pages[vol_path]
+
+    def locate(self, names: Iterable[str]) -> List[MemberLocation]:
+        """
+        Returns the locations of the members `names`, which `read_member` reads.
+        """
+        if self._infos is None:
+            raise ValueError("Member locations are only known for indexes built with ZipIndex.from_zip")
+
+        return [MemberLocation(name, self._infos[name].header_offset, self._infos[name].compress_size,
+                               self._infos[name].compress_type) for name in names]
+
+    def content_members(self) -> List[str]:
+        """
+        Returns all members except `ERROR.err` and `volume-rights.txt`, which the
+        caller handles separately.
+        """
+        members = list(self.other)
+        for vol_path in self.pages:
+            members.extend(self.volume_members(vol_path))
+
+        return members
+
+
+def read_member(zip_file: BinaryIO, location: MemberLocation) -> bytes:
+    """
+    Returns the contents of the member at `location` of the ZIP file `zip_file`,
+    reading only its local file header and data.
+    """
+    zip_file.seek(location.header_offset)
+    header = struct.unpack(structFileHeader, zip_file.read(sizeFileHeader))
+    if header[0] != b'PK\x03\x04':
+        raise BadZipFile("Bad local file header for member {}".format(location.name))
+    # the local header may hold a different extra field than the central directory
+    zip_file.seek(header[10] + header[11], 1)
+    data = zip_file.read(location.compress_size)
+
+    if location.compress_type == ZIP_DEFLATED:
+        return zlib.decompress(data, -zlib.MAX_WBITS)
+    if location.compress_type == ZIP_STORED:
+        return data
+    raise BadZipFile("Unsupported compression method {} for member {}".format(location.compress_type,
+                                                                                location.name))
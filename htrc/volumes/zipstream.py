@@ -0,0 +1,323 @@
+#!/usr/bin/env python
+"""
+`htrc.volumes.zipstream`
+
+Contains a parser for ZIP archives which are still being received.
+
+`ZipFile` needs the central directory at the end of an archive before it can
+read any member. `iter_zip_members` instead reads the local file header
+preceding each member, so the members of a Data API response can be handed
+downstream while the rest of the response is still being transferred.
+"""
+from __future__ import print_function
+from future import standard_library
+
+standard_library.install_aliases()
+
+import os
+import os.path
+import struct
+import zlib
+from typing import Callable, Iterator, List, Tuple
+from zipfile import BadZipFile
+
+from htrc.volumes.zipindex import ERRORS_MEMBER, RIGHTS_MEMBER
+
+import logging
+from logging import NullHandler
+
+logging.getLogger(__name__).addHandler(NullHandler())
+
+LOCAL_FILE_HEADER = b'PK\x03\x04'
+CENTRAL_DIRECTORY_HEADER = b'PK\x01\x02'
+END_OF_CENTRAL_DIRECTORY = b'PK\x05\x06'
+DATA_DESCRIPTOR = b'PK\x07\x08'
+
+_LOCAL_FILE_HEADER = struct.Struct('<4sHHHHHIIIHH')
+
+_FLAG_DATA_DESCRIPTOR = 0x08
+_FLAG_UTF8 = 0x800
+
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
+
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+
+
+class ZipStreamError(BadZipFile):
+    """
+    Raised when a ZIP stream is malformed or uses an unsupported feature.
+    """
+    pass
+
+
+class _StreamReader:
+    def __init__(self, stream, chunk_size: int) -> None:
+        self._stream = stream
+        self._chunk_size = chunk_size
+        self._buffer = bytearray()
+        self.num_bytes = 0
+
+    def read_some(self) -> bytes:
+        if self._buffer:
+            data, self._buffer = bytes(self._buffer), bytearray()
+            return data
+
+        data = self._stream.read(self._chunk_size)
+        self.num_bytes += len(data)
+        return data
+
+    def read_exact(self, n: int) -> bytes:
+        while len(self._buffer) < n:
+            data = self._stream.read(max(self._chunk_size, n - len(self._buffer)))
+            if not data:
+                raise ZipStreamError("Unexpected end of ZIP stream")
+            self.num_bytes += len(data)
+            self._buffer += data
+
+        data = bytes(self._buffer[:n])
+        del self._buffer[:n]
+        return data
+
+    def unread(self, data: bytes) -> None:
+        self._buffer[:0] = data
+
+    def drain(self) -> None:
+        # reads (and discards) the rest of the stream
+        del self._buffer[:]
+        while True:
+            data = self._stream.read(self._chunk_size)
+            if not data:
+                break
+            self.num_bytes += len(data)
+
+
+def _zip64_sizes(extra: bytes, compressed_size: int, size: int) -> Tuple[int, int]:
+    while len(extra) >= 4:
+        header_id, data_size = struct.unpack('<HH', extra[:4])
+        if header_id == 0x0001:
+            fields = extra[4:4 + data_size]
+            if size == 0xFFFFFFFF:
+                size, fields = struct.unpack('<Q', fields[:8])[0], fields[8:]
+            if compressed_size == 0xFFFFFFFF:
+                compressed_size = struct.unpack('<Q', fields[:8])[0]
+            break
+        extra = extra[4 + data_size:]
+
+    return compressed_size, size
+
+
+def _read_deflated(reader: _StreamReader) -> bytes:
+    # the end of the member is found by the decompressor when its size is not known up front
+    decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+    output = []
+    while not decompressor.eof:
+        data = reader.read_some()
+        if not data:
+            raise ZipStreamError("Unexpected end of ZIP stream")
+        output.append(decompressor.decompress(data))
+    reader.unread(decompressor.unused_data)
+
+    return b''.join(output)
+
+
+def _read_stored(reader: _StreamReader, zip64: bool) -> bytes:
+    # the end of a stored member of unknown size is found by looking for a data descriptor which matches
+    # the data before it
+    descriptor = struct.Struct('<4sIQQ' if zip64 else '<4sIII')
+    data = bytearray()
+    start = 0
+    while True:
+        index = data.find(DATA_DESCRIPTOR, start)
+        if index >= 0 and len(data) >= index + descriptor.size:
+            _, crc, compressed_size, _ = descriptor.unpack_from(data, index)
+            if compressed_size == index and zlib.crc32(data[:index]) == crc:
+                reader.unread(data[index + descriptor.size:])
+                return bytes(data[:index])
+            start = index + 1
+            continue
+        if index < 0:
+            start = max(0, len(data) - len(DATA_DESCRIPTOR) + 1)
+
+        chunk = reader.read_some()
+        if not chunk:
+            raise ZipStreamError("Unexpected end of ZIP stream")
+        data += chunk
+
+
+def _skip_data_descriptor(reader: _StreamReader, zip64: bool) -> None:
+    signature = reader.read_exact(4)
+    if signature != DATA_DESCRIPTOR:
+        # the signature is optional
+        reader.unread(signature)
+    reader.read_exact(4 + (16 if zip64 else 8))  # CRC-32 and sizes
+
+
+def iter_zip_members(stream, chunk_size: int = DEFAULT_CHUNK_SIZE) -> Iterator[Tuple[str, bytes]]:
+    """
+    Yields `(name, data)` for each member of the ZIP archive read from the
+    file-like `stream`, as soon as the member has been received.
+
+    Only the stored and deflated compression methods are supported. Reading
+    stops at the central directory, which is not needed.
+    """
+    return _iter_members(_StreamReader(stream, chunk_size))
+
+
+def _iter_members(reader: _StreamReader) -> Iterator[Tuple[str, bytes]]:
+    while True:
+        try:
+            signature = reader.read_exact(4)
+        except ZipStreamError:
+            # an archive without any members may end before a central directory
+            return
+
+        if signature in (CENTRAL_DIRECTORY_HEADER, END_OF_CENTRAL_DIRECTORY):
+            return
+        if signature != LOCAL_FILE_HEADER:
+            raise ZipStreamError("Bad ZIP local file header signature: {!r}".format(signature))
+
+        (_, _, flags, method, _, _, crc, compressed_size, size,
+         name_length, extra_length) = _LOCAL_FILE_HEADER.unpack(signature + reader.read_exact(26))
+        name = reader.read_exact(name_length)
+        name = name.decode('utf-8' if flags & _FLAG_UTF8 else 'cp437')
+        extra = reader.read_exact(extra_length)
+        zip64 = compressed_size == 0xFFFFFFFF or size == 0xFFFFFFFF
+        compressed_size, size = _zip64_sizes(extra, compressed_size, size)
+
+        has_data_descriptor = flags & _FLAG_DATA_DESCRIPTOR
+        if method == ZIP_DEFLATED:
+            if has_data_descriptor:
+                data = _read_deflated(reader)
+            else:
+                data = zlib.decompress(reader.read_exact(compressed_size), -zlib.MAX_WBITS)
+        elif method == ZIP_STORED:
+            if has_data_descriptor and not compressed_size:
+                yield name, _read_stored(reader, zip64)
+                continue
+            data = reader.read_exact(compressed_size)
+        else:
+            raise ZipStreamError("Unsupported compression method {} for member {}".format(method, name))
+
+        if has_data_descriptor:
+            _skip_data_descriptor(reader, zip64)
+        elif zlib.crc32(data) != crc:
+            raise ZipStreamError("Bad CRC-32 for member {}".format(name))
+
+        yield name, data
+
+
+class StreamedBatch:
+    """
+    The outcome of extracting a Data API response with `extract_stream`.
+
+    `volume_paths` lists the volume directories of the response, `errors` and
+    `rights` hold the contents of its `ERROR.err` and `volume-rights.txt` files
+    (if any), and `results` the values returned by the `on_volume` callback.
+    """
+
+    def __init__(self) -> None:
+        self.volume_paths = []  # type: List[str]
+        self.errors = None
+        self.rights = None
+        self.results = []
+        self.num_bytes = 0
+
+    def close(self) -> None:
+        pass
+
+
+def check_member_name(name: str) -> None:
+    """
+    Raises a `ZipStreamError` if the member `name` of a ZIP archive would be
+    extracted outside of the output directory.
+    """
+    if os.path.isabs(name) or '..' in name.split('/'):
+        raise ZipStreamError("Refusing to extract member {} outside of the output directory".format(name))
+
+
+def extract_stream(stream, output_dir: str, on_volume: Callable[[str, List[str], List[bytes]], object] = None,
+                   chunk_size: int = DEFAULT_CHUNK_SIZE) -> StreamedBatch:
+    """
+    Extracts the Data API response read from `stream` into `output_dir` while it
+    is being received, and returns a `StreamedBatch`.
+
+    If `on_volume` is given, pages are not written to disk. Instead, as soon as
+    all pages of a volume have been received, `on_volume` is called with the
+    volume's directory, the sorted paths of its pages and their contents. The
+    pages of each volume must be contiguous in the response, as they are in the
+    responses of the Data API.
+
+    The response is read to the end, past the members. If it cannot be, the files
+    and directories written so far are removed, so that no partially extracted
+    volume is left behind.
+    """
+    batch = StreamedBatch()
+    reader = _StreamReader(stream, chunk_size)
+    vol_pages = {}  # page path -> contents, for the volume being received
+    current_path = None
+    done_paths = set()
+    written_paths = []  # the files written, then the directories created, in order
+
+    def _emit():
+        page_paths = sorted(vol_pages)
+        batch.results.append(on_volume(current_path, page_paths, [vol_pages[path] for path in page_paths]))
+        done_paths.add(current_path)
+
+    def _makedirs(path):
+        if not os.path.isdir(path):
+            _makedirs(os.path.dirname(path))
+            os.mkdir(path)
+            written_paths.append(path)
+
+    def _remove_written():
+        for path in reversed(written_paths):
+            try:
+                if os.path.isdir(path):
+                    os.rmdir(path)
+                else:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    try:
+        for name, data in _iter_members(reader):
+            check_member_name(name)
+
+            if name == ERRORS_MEMBER:
+                batch.errors = data.decode('utf-8')
+            elif name == RIGHTS_MEMBER:
+                batch.rights = data.decode('utf-8')
+            elif name.endswith('/'):
+                batch.volume_paths.append(name)
+                if on_volume is None:
+                    _makedirs(os.path.normpath(os.path.join(output_dir, name)))
+            elif on_volume is None:
+                path = os.path.join(output_dir, name)
+                _makedirs(os.path.dirname(path))
+                written_paths.append(path)
+                with open(path, 'wb') as page_file:
+                    page_file.write(data)
+            elif '/' in name:
+                vol_path = name.split('/', 1)[0] + '/'
+                if vol_path != current_path:
+                    if vol_path in done_paths:
+                        raise ZipStreamError("Pages of {} are not contiguous in the ZIP stream".format(vol_path))
+                    if current_path is not None:
+                        _emit()
+                    current_path, vol_pages = vol_path, {}
+                vol_pages[name] = data
+
+        if current_path is not None:
+            _emit()
+
+        # the central directory is not needed, but is read so that the connection of the response can be reused
+        reader.drain()
+    except BaseException:
+        _remove_written()
+        raise
+
+    batch.num_bytes = reader.num_bytes
+    logging.debug("Extracted {:,} volumes from a {:,} byte ZIP stream".format(len(batch.volume_paths),
+                                                                              batch.num_bytes))
+    return batch
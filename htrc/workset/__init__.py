@@ -161,12 +161,20 @@ def path_to_volumes(path):
 
     Accepts:
     - Plaintext file, each line is an ID
-    - Directory with subfolders that are volume pages
+    - Directory with subfolders that are volume pages, or with bundles of them
     - JSON or JSONLD workset representation
     - HT CB or HTRC WCSA URL.
     """
-    if os.path.isdir(path):
-        volumes = [id for id in os.listdir(path) if not id.endswith('.log')]
+    if os.path.isdir(path) and os.path.isfile(os.path.join(path, 'workset.zip')):
+        # a workset bundle written by `htrc download --bundle workset`
+        from htrc.volumes.bundle import WorksetBundle
+        volumes = WorksetBundle(path).volume_ids
+    elif os.path.isdir(path):
+        # per-volume bundles are named '<volume>.zip', hidden files hold indexes of the volumes, and '.csv'
+        # files are reports of the removed headers and footers
+        volumes = [id[:-len('.zip')] if id.endswith('.zip') else id
+                   for id in os.listdir(path)
+                   if not id.endswith('.log') and not id.endswith('.csv') and not id.startswith('.')]
     elif (path.endswith('json')
         or path.endswith('jsonld')
         or path.startswith('http://')
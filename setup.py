@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 from __future__ import print_function
 
-from setuptools import setup, find_packages
+from setuptools import setup, find_packages, Extension
 from setuptools.command.install import install
 import os
 import platform
@@ -13,13 +13,23 @@ import tarfile
 __version__ = '0.1.58'
 
 # Installing Cython indepdently bc of numpy version. Pinning packages bc of python3.6
-install_requires = ['PyLD', 'future', 'prov', 'unicodecsv', 'progressbar2==3.55.0', 'pandas==1.1.5','requests', 'argparse==1.1', 'Cython','tqdm==4.46.0']
+install_requires = ['PyLD', 'future', 'prov', 'unicodecsv', 'progressbar2==3.55.0','requests', 'argparse==1.1', 'Cython','tqdm==4.46.0']
 # TODO: migrate to docs confix:, 'sphinx-argparse', 'sphinxcontrib-fulltoc']
 if sys.version_info.major == 2:
     install_requires.append('configparser')
     install_requires.append('mock')
 
 
+# The compiled versions of the hot functions of `htrc.hf_utils` are optional: if Cython is unavailable or the
+# extension fails to build, the pure-Python versions are used instead.
+try:
+    from Cython.Build import cythonize
+    ext_modules = cythonize([Extension('htrc.hf_utils._speedups', ['htrc/hf_utils/_speedups.pyx'], optional=True)],
+                            language_level=3)
+except ImportError:
+    ext_modules = []
+
+
 def _download_config():
     print("Downloading .htrc file...")
 
@@ -79,6 +89,7 @@ setup(
         "Topic :: Text Processing :: Linguistic",
     ],
     packages=find_packages(),
+    ext_modules=ext_modules,
     install_requires=install_requires,
     include_package_data=True,
     data_files=[('htrc/mock/volumes', ['htrc/mock/volumes/example.zip']),
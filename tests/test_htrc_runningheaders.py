@@ -0,0 +1,270 @@
+from __future__ import print_function
+from future import standard_library
+standard_library.install_aliases()
+
+import sys
+if sys.version_info.major == 2:
+    from mock import Mock, patch
+elif sys.version_info.major == 3:
+    from unittest.mock import Mock, patch
+
+from collections import Counter
+import os.path
+import random
+import unittest2 as unittest
+from zipfile import ZipFile
+
+import htrc.hf_utils
+from htrc.hf_utils import common_letters, letter_histogram, levenshtein, levenshtein_within, lsh_candidate_pairs, \
+    max_edit_distance, min_common_letters, union_find_clusters
+import htrc.hf_utils.pure
+from htrc.models import HtrcPage
+import htrc.runningheaders
+from htrc.runningheaders import parse_page_structure
+
+WORDS = ['the', 'history', 'of', 'england', 'from', 'accession', 'james', 'second', 'chapter', 'volume',
+         'introduction', 'preface', 'contents', 'notes']
+
+
+def _noisy(text, rng, p=0.08):
+    # simulates OCR errors by dropping, replacing and inserting letters
+    out = []
+    for c in text:
+        r = rng.random()
+        if r < p / 3:
+            continue
+        elif r < 2 * p / 3:
+            out.append(rng.choice('abcdefghijklmnopqrstuvwxyz'))
+        elif r < p:
+            out.extend([c, rng.choice('abcdefghijklmnopqrstuvwxyz ')])
+        else:
+            out.append(c)
+
+    return ''.join(out)
+
+
+def make_volume(num_pages, seed=0, body_words=WORDS):
+    """
+    Returns the text lines of the pages of a volume with noisy running headers
+    (alternating with the page number on either side) and page number footers,
+    around body lines made of `body_words`.
+    """
+    rng = random.Random(seed)
+    titles = [' '.join(rng.choice(WORDS) for _ in range(rng.randint(3, 6))).upper()
+              for _ in range(max(1, num_pages // 20))]
+    volume = []
+    for page in range(num_pages):
+        title = titles[page * len(titles) // num_pages]
+        header = '{} {}'.format(page + 1, title) if page % 2 else '{} {}'.format(title, page + 1)
+        lines = [_noisy(header, rng)]
+        lines.extend(' '.join(rng.choice(body_words) for _ in range(rng.randint(2, 6)))
+                     for _ in range(rng.randint(3, 8)))
+        lines.append(_noisy(str(page + 1), rng, 0.02))
+        volume.append(lines)
+
+    return volume
+
+
+def structure(volume, **kwargs):
+    return [(page.num_header_lines, page.num_footer_lines)
+            for page in parse_page_structure([HtrcPage(list(lines)) for lines in volume], **kwargs)]
+
+
+class TestRunningHeaders(unittest.TestCase):
+    def test_levenshtein_within(self):
+        rng = random.Random(0)
+        for _ in range(2000):
+            s = ''.join(rng.choice('abc d') for _ in range(rng.randint(0, 10)))
+            t = ''.join(rng.choice('abc d') for _ in range(rng.randint(0, 10)))
+            distance = levenshtein(s, t)
+            for max_distance in range(12):
+                self.assertEqual(levenshtein_within(s, t, max_distance), min(distance, max_distance + 1))
+
+    def test_max_edit_distance(self):
+        for len0, len1 in [(4, 4), (10, 7), (1, 30), (0, 5)]:
+            for ratio in (0.0, 0.5, 0.7, 0.75, 0.9, 1.0, 1.1):
+                max_len = max(len0, len1)
+                distances = [d for d in range(max_len + 1) if 1 - float(d) / max_len >= ratio]
+                self.assertEqual(max_edit_distance(len0, len1, ratio), max(distances) if distances else -1)
+
+    def test_parse_page_structure(self):
+        volume = make_volume(40)
+        pages = parse_page_structure([HtrcPage(list(lines)) for lines in volume])
+        self.assertTrue(all(page.num_header_lines == 1 for page in pages))
+        self.assertTrue(all(page.num_footer_lines == 1 for page in pages))
+        self.assertEqual(pages[3].body_lines, volume[3][1:-1])
+
+    def test_letter_histogram(self):
+        rng = random.Random(0)
+        for _ in range(3000):
+            s = ''.join(rng.choice('abz \u00e9\u00fc\u4e2d') for _ in range(rng.randint(0, 30)))
+            t = ''.join(rng.choice('abz \u00e9\u00fc\u4e2d') for _ in range(rng.randint(0, 30)))
+            common = common_letters(letter_histogram(s), letter_histogram(t))
+            # other letters share counts, which only overestimates the letters in common
+            self.assertGreaterEqual(common, sum((Counter(s) & Counter(t)).values()))
+            if not set(s + t) - set('abz '):
+                self.assertEqual(common, sum((Counter(s) & Counter(t)).values()))
+            # pairs are only pruned if their edit distance is above the bound
+            self.assertGreaterEqual(common, min_common_letters(len(s), len(t), levenshtein(s, t)))
+
+        self.assertEqual(letter_histogram('x' * 40000), -1)
+
+    def test_match_stats(self):
+        match_stats = Counter()
+        structure(make_volume(30), match_stats=match_stats)
+        self.assertEqual(match_stats['pairs'], match_stats['pruned_by_length'] + match_stats['pruned_by_histogram'] +
+                         match_stats['compared'])
+        self.assertGreater(match_stats['pruned_by_histogram'], 0)
+        self.assertGreater(match_stats['similar'], 0)
+        self.assertLessEqual(match_stats['similar'], match_stats['compared'])
+
+    def test_parse_page_structure_parity(self):
+        # the structure is the same as when computing the full edit distance of every pair of lines
+        def full_levenshtein(s, t, max_distance):
+            return min(levenshtein(s, t), max_distance + 1)
+
+        for seed in range(2):
+            volume = make_volume(20, seed)
+            for window_size in (3, 6):
+                for min_similarity_ratio in (0.5, 0.8):
+                    with patch.multiple(htrc.runningheaders, levenshtein_within=full_levenshtein,
+                                        common_letters=lambda histogram0, histogram1: float('inf')):
+                        expected = structure(volume, window_size=window_size,
+                                             min_similarity_ratio=min_similarity_ratio)
+                    self.assertEqual(structure(volume, window_size=window_size,
+                                               min_similarity_ratio=min_similarity_ratio), expected)
+
+    def test_union_find_clusters(self):
+        rng = random.Random(0)
+        for _ in range(50):
+            num_items = rng.randint(0, 30)
+            pairs = [(rng.randrange(num_items), rng.randrange(num_items)) for _ in range(rng.randint(0, 30))] \
+                if num_items else []
+            # the connected components found by a traversal of the graph
+            neighbours = {}
+            for x1, x2 in pairs:
+                neighbours.setdefault(x1, set()).add(x2)
+                neighbours.setdefault(x2, set()).add(x1)
+            expected, seen = [], set()
+            for x in range(num_items):
+                if x in seen or not neighbours.get(x, set()) - {x}:
+                    continue
+                component, stack = set(), [x]
+                while stack:
+                    y = stack.pop()
+                    if y not in component:
+                        component.add(y)
+                        stack.extend(neighbours[y])
+                seen |= component
+                expected.append(sorted(component))
+
+            self.assertEqual(union_find_clusters(num_items, pairs), expected)
+
+    def test_lsh_candidate_pairs(self):
+        texts = ['chapter one', 'chapter onf', 'the history', 'chapter one', 'contents']
+        pairs = set(lsh_candidate_pairs(texts))
+        self.assertIn((0, 3), pairs)
+        self.assertIn((0, 1), pairs)
+        self.assertTrue(all(i < j for i, j in pairs))
+
+        # pairs at the same position or too far apart are not yielded
+        self.assertEqual(set(lsh_candidate_pairs(texts, [0, 0, 1, 1, 4], 2)), {(0, 3), (1, 3)})
+
+    def test_parse_page_structure_lsh(self):
+        volume = make_volume(60)
+        window_stats, lsh_stats = Counter(), Counter()
+        expected = structure(volume, window_size=6, match_stats=window_stats)
+        self.assertEqual(structure(volume, window_size=6, candidates='lsh', match_stats=lsh_stats), expected)
+        self.assertLess(lsh_stats['pairs'], window_stats['pairs'])
+
+        # lines are paired across the whole volume, with body lines which do not look alike
+        rng = random.Random(0)
+        words = [''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(rng.randint(3, 9)))
+                 for _ in range(2000)]
+        volume = make_volume(100, body_words=words)
+        expected = structure(volume)
+        self.assertTrue(all(num_header_lines == 1 for num_header_lines, _ in expected))
+        self.assertEqual(structure(volume, window_size=None, candidates='lsh'), expected)
+
+        with self.assertRaises(ValueError):
+            structure(volume, candidates='minhash')
+        with self.assertRaises(ValueError):
+            structure(volume, window_size=None)
+
+
+def example_volumes():
+    """
+    Returns the text lines of the pages of each volume in `tests/data/example.zip`.
+    """
+    with ZipFile(os.path.join(os.path.dirname(__file__), 'data', 'example.zip')) as vols_zip:
+        names = sorted(name for name in vols_zip.namelist() if name.endswith('.txt'))
+        volumes = {}
+        for name in names:
+            lines = vols_zip.read(name).decode('utf-8').splitlines()
+            volumes.setdefault(name.split('/')[0], []).append([line.rstrip() for line in lines])
+
+    return list(volumes.values())
+
+
+try:
+    import htrc.hf_utils._speedups as speedups
+except ImportError:
+    speedups = None
+
+
+@unittest.skipIf(speedups is None, "the compiled extension htrc.hf_utils._speedups is not built")
+class TestSpeedups(unittest.TestCase):
+    """
+    The compiled functions give the same results as their pure-Python versions.
+    """
+
+    def setUp(self):
+        self.volumes = example_volumes() + [make_volume(30, seed) for seed in range(2)]
+        self.lines = [line for volume in self.volumes for page in volume for line in page]
+
+    def test_backend(self):
+        self.assertEqual(htrc.hf_utils.BACKEND, 'cython')
+
+    def test_clean_text(self):
+        for line in self.lines:
+            self.assertEqual(speedups.clean_text(line), htrc.hf_utils.pure.clean_text(line))
+
+        # every character is told apart the same way as by the regular expressions
+        chars = ''.join(map(chr, range(0x3000))) + ''.join(map(chr, range(0x1d400, 0x1d800)))
+        for text in ('', '  ', '_a_', '12 ab 34', chars, chars[::-1], ' x '.join(chars[:2000])):
+            self.assertEqual(speedups.clean_text(text), htrc.hf_utils.pure.clean_text(text))
+
+    def test_levenshtein(self):
+        rng = random.Random(0)
+        # header-sized prefixes of the lines, and strings longer than the 64 letters of a bit-parallel pattern
+        texts = [htrc.hf_utils.pure.clean_text(line)[:60] for line in rng.sample(self.lines, 24)]
+        texts += ['', 'caf\u00e9', 'cafe', 'x' * 70, 'x' * 69 + 'y', 'y' + 'x' * 80, '\u4e2d\u6587' * 40]
+        for s in texts:
+            for t in texts:
+                distance = htrc.hf_utils.pure.levenshtein(s, t)
+                self.assertEqual(speedups.levenshtein(s, t), distance)
+                self.assertEqual(speedups.levenshtein(s, t, 2, 3, 4), htrc.hf_utils.pure.levenshtein(s, t, 2, 3, 4))
+                for max_distance in (-1, 0, 1, 3, distance - 1, distance, 40):
+                    self.assertEqual(speedups.levenshtein_within(s, t, max_distance),
+                                     htrc.hf_utils.pure.levenshtein_within(s, t, max_distance))
+
+    def test_union_find_clusters(self):
+        rng = random.Random(0)
+        for num_pairs in (0, 10, 40, 200):
+            pairs = [(rng.randrange(50), rng.randrange(50)) for _ in range(num_pairs)]
+            self.assertEqual(speedups.union_find_clusters(50, pairs), htrc.hf_utils.pure.union_find_clusters(50, pairs))
+
+        with self.assertRaises(IndexError):
+            speedups.union_find_clusters(3, [(1, 3)])
+
+    def test_parse_page_structure(self):
+        for volume in self.volumes:
+            for window_size in (3, 6):
+                for min_similarity_ratio in (0.5, 0.7, 0.9):
+                    with patch.multiple(htrc.runningheaders, clean_text=htrc.hf_utils.pure.clean_text,
+                                        union_find_clusters=htrc.hf_utils.pure.union_find_clusters,
+                                        levenshtein_within=htrc.hf_utils.pure.levenshtein_within):
+                        expected = structure(volume, window_size=window_size,
+                                             min_similarity_ratio=min_similarity_ratio)
+                    self.assertEqual(structure(volume, window_size=window_size,
+                                               min_similarity_ratio=min_similarity_ratio), expected)
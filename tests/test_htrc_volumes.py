@@ -8,17 +8,99 @@ if sys.version_info.major == 2:
 elif sys.version_info.major == 3:
     from unittest.mock import Mock, patch, PropertyMock
 
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import csv
+import http.client
 from io import BytesIO  # used to stream http response into zipfile.
 from tempfile import NamedTemporaryFile, mkdtemp
+from zipfile import ZipFile, ZIP_DEFLATED, ZIP_STORED
+import multiprocessing
+import os
+import shutil
+import socket
+import ssl
+import threading
+import time
 import unittest2 as unittest
 
+import htrc.models
+from htrc.runningheaders import parse_page_structure
 import htrc.volumes
 import htrc.config
+import htrc.workset
 
 class MockResponse(BytesIO):
     def __init__(self, data, status=200, *args, **kwargs):
         BytesIO.__init__(self, data, *args, **kwargs)
         self.status = status
+        self.will_close = False
+
+    def isclosed(self):
+        return self.tell() == len(self.getvalue())
+
+def make_zip(volume_ids, num_pages=3):
+    data = BytesIO()
+    with ZipFile(data, 'w') as vols_zip:
+        for volume_id in volume_ids:
+            vols_zip.writestr(volume_id + '/', b'')
+        for volume_id in volume_ids:
+            for page in range(1, num_pages + 1):
+                vols_zip.writestr('{}/{:08d}.txt'.format(volume_id, page),
+                                  'Running header\nText of page {} of {}\n{}\n'.format(page, volume_id, page))
+    data.seek(0)
+    return data
+
+
+def mock_get_volumes(num_pages=3):
+    """
+    Returns a side effect for mocks of `htrc.volumes.get_volumes`, which responds
+    with the ZIP file of the requested volumes (in a named temporary file if
+    `named_spool` is set), or passes it to `stream` if given.
+    """
+    def get_volumes(config, ids, *args, stream=None, named_spool=False, **kwargs):
+        data = make_zip(ids, num_pages)
+        if named_spool:
+            data_file = NamedTemporaryFile(prefix='htrc-batch-', suffix='.zip')
+            data_file.write(data.getvalue())
+            data_file.seek(0)
+            return data_file
+        return data if stream is None else stream(data)
+
+    return get_volumes
+
+
+def mock_get_pages():
+    """
+    Returns a side effect for mocks of `htrc.volumes.get_pages`, which responds
+    with the ZIP file of the requested pages (e.g. 'mdp.1[1,2]').
+    """
+    def get_pages(config, page_ids, *args, stream=None, **kwargs):
+        data = BytesIO()
+        with ZipFile(data, 'w') as vols_zip:
+            for page_id in page_ids:
+                volume_id, _, seqs = page_id.rstrip(']').partition('[')
+                for seq in seqs.split(','):
+                    vols_zip.writestr('{}/{:08d}.txt'.format(volume_id, int(seq)), 'Page {}\n'.format(seq))
+        data.seek(0)
+        return data if stream is None else stream(data)
+
+    return get_pages
+
+
+class NonSeekableStream(BytesIO):
+    """
+    Makes `ZipFile` write data descriptors, as it does when streaming an archive.
+    """
+    def seekable(self):
+        return False
+
+    def seek(self, *args):
+        raise OSError("not seekable")
+
+    def tell(self):
+        raise OSError("not seekable")
+
 
 class TestVolumes(unittest.TestCase):
     def setUp(self):
@@ -30,6 +112,15 @@ class TestVolumes(unittest.TestCase):
 
         self.output_path = mkdtemp()
 
+        self.data_api_config = htrc.config.HtrcDataApiConfig(
+            token='1234',
+            host='data-host',
+            port=443,
+            epr='/',
+            cert='/home/client-certs/client.pem',
+            key='/home/client-certs/client.pem'
+        )
+
     def tearDown(self):
         import os, shutil
         os.remove(self.config_path)
@@ -54,59 +145,937 @@ class TestVolumes(unittest.TestCase):
     #     with self.assertRaises(EnvironmentError):
     #         token = htrc.volumes.get_oauth2_token('1234','1234')
 
+    @patch('ssl.SSLContext.load_cert_chain')
     @patch('htrc.volumes.http.client.HTTPSConnection')
-    def test_get_volumes_and_pages(self, https_mock):
+    def test_get_volumes_and_pages(self, https_mock, load_cert_chain_mock):
         response_mock = Mock(status=200)
-        response_mock.read.return_value =\
-            ''.encode('utf8')
+        response_mock.readinto.return_value = 0
         https_mock.return_value.getresponse.return_value = response_mock
-        data_api_config = htrc.config.HtrcDataApiConfig(
-            token='1234',
-            host='data-host',
-            port=443,
-            epr='/',
-            cert='/home/client-certs/client.pem',
-            key='/home/client-certs/client.pem'
-        )
 
-        htrc.volumes.get_volumes(data_api_config, self.test_vols)
-        htrc.volumes.get_pages(data_api_config, self.test_vols)
+        htrc.volumes.get_volumes(self.data_api_config, self.test_vols)
+        htrc.volumes.get_pages(self.data_api_config, self.test_vols)
 
+    @patch('ssl.SSLContext.load_cert_chain')
     @patch('htrc.volumes.http.client.HTTPSConnection')
-    def test_get_volumes_and_pages_error(self, https_mock):
+    def test_get_volumes_and_pages_error(self, https_mock, load_cert_chain_mock):
         response_mock = Mock(status=500)
         https_mock.return_value.getresponse.return_value = response_mock
 
-        data_api_config = htrc.config.HtrcDataApiConfig(
-            token='1234',
-            host='data-host',
-            port=443,
-            epr='/',
-            cert='/home/client-certs/client.pem',
-            key='/home/client-certs/client.pem'
-        )
+        with self.assertRaises(EnvironmentError):
+            htrc.volumes.get_volumes(self.data_api_config, self.test_vols)
 
         with self.assertRaises(EnvironmentError):
-            htrc.volumes.get_volumes(data_api_config, self.test_vols)
+            htrc.volumes.get_pages(self.data_api_config, self.test_vols)
+
+    @patch('ssl.SSLContext.load_cert_chain')
+    @patch('htrc.volumes.http.client.HTTPSConnection')
+    def test_get_volumes_spooled(self, https_mock, load_cert_chain_mock):
+        response_mock = MockResponse(b'PK\x05\x06' + b'\x00' * 18)
+        https_mock.return_value.getresponse.return_value = response_mock
+
+        with htrc.volumes.get_volumes(self.data_api_config, self.test_vols, spool_max_size=4) as data:
+            self.assertTrue(data._rolled)
+            self.assertEqual(data.read(), b'PK\x05\x06' + b'\x00' * 18)
+
+        https_mock.return_value.getresponse.return_value = MockResponse(b'PK\x05\x06' + b'\x00' * 18)
+        with htrc.volumes.get_volumes(self.data_api_config, self.test_vols, named_spool=True) as data:
+            with open(data.name, 'rb') as data_file:
+                self.assertEqual(data_file.read(), b'PK\x05\x06' + b'\x00' * 18)
+            self.assertEqual(data.read(), b'PK\x05\x06' + b'\x00' * 18)
+
+    @patch('ssl.SSLContext.load_cert_chain')
+    @patch('htrc.volumes.http.client.HTTPSConnection')
+    def test_client_reuses_connection(self, https_mock, load_cert_chain_mock):
+        https_mock.return_value.getresponse.side_effect = lambda: MockResponse(b'')
+
+        with htrc.volumes.DataApiClient(self.data_api_config) as client:
+            htrc.volumes.get_volumes(self.data_api_config, self.test_vols, client=client)
+            htrc.volumes.get_pages(self.data_api_config, self.test_vols, client=client)
+
+        https_mock.assert_called_once()
+        load_cert_chain_mock.assert_called_once_with('/home/client-certs/client.pem', '/home/client-certs/client.pem')
+        self.assertEqual(https_mock.return_value.request.call_count, 2)
+        https_mock.return_value.close.assert_called_once()
+
+    @patch('ssl.SSLContext.load_cert_chain')
+    def test_client_timeout(self, load_cert_chain_mock):
+        # the server accepts the connection but never responds
+        with socket.socket() as server:
+            server.bind(('127.0.0.1', 0))
+            server.listen(1)
+            config = htrc.config.HtrcDataApiConfig(token='1234', host='127.0.0.1', port=server.getsockname()[1],
+                                                   epr='/', cert='/home/client-certs/client.pem',
+                                                   key='/home/client-certs/client.pem')
+
+            start = time.monotonic()
+            with htrc.volumes.DataApiClient(config, timeout=0.2) as client, \
+                    self.assertRaises(htrc.volumes.RetryPolicy.NETWORK_ERRORS):
+                htrc.volumes.get_volumes(config, self.test_vols, client=client)
+            self.assertLess(time.monotonic() - start, 5)
+
+        with self.assertRaises(ValueError):
+            htrc.volumes.TransferOptions(timeout=0)
+
+    @patch('ssl.SSLContext.load_cert_chain')
+    @patch('htrc.volumes.http.client.HTTPSConnection')
+    def test_download_volumes_not_spooled(self, https_mock, load_cert_chain_mock):
+        https_mock.return_value.getresponse.side_effect = lambda: MockResponse(make_zip(self.test_vols).getvalue())
+
+        # responses which are not spooled are kept in memory
+        htrc.volumes.download_volumes(self.test_vols, self.output_path, data_api_config=self.data_api_config,
+                                      parallelism=1, transfer=htrc.volumes.TransferOptions(spool_max_size=None))
+
+        for volume_id in self.test_vols:
+            self.assertEqual(sorted(os.listdir(os.path.join(self.output_path, volume_id))),
+                             ['00000001.txt', '00000002.txt', '00000003.txt'])
+
+    @patch('ssl.SSLContext.load_cert_chain')
+    @patch('htrc.volumes.http.client.HTTPSConnection')
+    def test_client_reuses_connection_stream(self, https_mock, load_cert_chain_mock):
+        https_mock.return_value.getresponse.side_effect = lambda: MockResponse(make_zip(self.test_vols).getvalue())
 
+        # the responses extracted while they are received are read to the end, past the central directory
+        extract = partial(htrc.volumes.extract_stream, output_dir=self.output_path, chunk_size=16)
+        with htrc.volumes.DataApiClient(self.data_api_config) as client:
+            htrc.volumes.get_volumes(self.data_api_config, self.test_vols, client=client, stream=extract)
+            htrc.volumes.get_volumes(self.data_api_config, self.test_vols, client=client, stream=extract)
+
+        https_mock.assert_called_once()
+        self.assertEqual(https_mock.return_value.request.call_count, 2)
+
+    def test_journal(self):
+        journal = htrc.volumes.DownloadJournal(self.output_path)
+        journal.record(self.test_vols[:2], errors='KeyNotFoundException mdp.1', rights=None)
+        journal.record(self.test_vols[2:3])
+
+        journal_path = os.path.join(self.output_path, htrc.volumes.journal.JOURNAL_FILENAME)
+        with open(journal_path, 'a') as journal_file:
+            journal_file.write('{"volumes": ["' + self.test_vols[3])  # interrupted while recording
+
+        journal = htrc.volumes.DownloadJournal(self.output_path, resume=True)
+        self.assertEqual(journal.remaining(self.test_vols), self.test_vols[3:])
+        self.assertEqual(journal.errors, ['KeyNotFoundException mdp.1'])
+
+        journal.record(self.test_vols[3:])
+        journal = htrc.volumes.DownloadJournal(self.output_path, resume=True)
+        self.assertEqual(journal.remaining(self.test_vols), [])
+
+        journal = htrc.volumes.DownloadJournal(self.output_path)
+        self.assertEqual(journal.remaining(self.test_vols), self.test_vols)
+        self.assertFalse(os.path.exists(journal_path))
+
+    @patch('htrc.volumes.get_volumes')
+    def test_download_volumes_resume(self, volumes_mock):
+        volumes_mock.side_effect = mock_get_volumes()
+
+        htrc.volumes.DownloadJournal(self.output_path).record(self.test_vols[:3])
+        htrc.volumes.download_volumes(self.test_vols, self.output_path, data_api_config=self.data_api_config,
+                                      parallelism=1, batch_size=1, output=htrc.volumes.OutputOptions(resume=True))
+
+        requested = sorted(call[0][1][0] for call in volumes_mock.call_args_list)
+        self.assertEqual(requested, sorted(self.test_vols[3:]))
+        self.assertEqual(sorted(os.listdir(os.path.join(self.output_path, self.test_vols[3]))),
+                         ['00000001.txt', '00000002.txt', '00000003.txt'])
+
+        htrc.volumes.download_volumes(self.test_vols, self.output_path, data_api_config=self.data_api_config,
+                                      parallelism=1, batch_size=1, output=htrc.volumes.OutputOptions(resume=True))
+        self.assertEqual(volumes_mock.call_count, 2)
+
+    @patch('htrc.volumes.get_volumes')
+    def test_download_volumes_adaptive(self, volumes_mock):
+        volumes_mock.side_effect = mock_get_volumes()
+
+        htrc.volumes.download_volumes(self.test_vols, self.output_path, data_api_config=self.data_api_config,
+                                      parallelism=1, batch_size=1, transfer=htrc.volumes.TransferOptions(prefetch=0),
+                                      batching=htrc.volumes.BatchOptions(adaptive=True, min_size=1, max_size=4))
+
+        self.assertEqual([len(call[0][1]) for call in volumes_mock.call_args_list], [1, 2, 2])
+        self.assertEqual(sorted(os.listdir(self.output_path)), sorted(self.test_vols + ['.htrc-download.log']))
+
+    def test_adaptive_batcher(self):
+        volume_ids = ['htrc.test{}'.format(i) for i in range(100)]
+        batcher = htrc.volumes.AdaptiveBatcher(volume_ids, initial_size=10, min_size=2, max_size=50,
+                                               target_bytes=1000, target_seconds=100)
+
+        batches = []
+        for ids in batcher:
+            batches.append(ids)
+            batcher.observe(len(ids), 20 * len(ids), 0.01 * len(ids))
+
+        # growth is capped at doubling per batch and by max_size
+        self.assertEqual([len(ids) for ids in batches], [10, 20, 40, 30])
+        self.assertEqual(sum(batches, []), volume_ids)
+
+        # slow responses shrink the next batch right away, down to min_size
+        batcher.observe(50, 50, 5000)
+        self.assertEqual(batcher.batch_size, 2)
+
+    def test_retry_policy(self):
+        attempts = []
+
+        def fetch(ids):
+            attempts.append(ids)
+            if len(attempts) < 3:
+                raise socket.timeout("timed out")
+            return BytesIO()
+
+        retry_policy = htrc.volumes.RetryPolicy(max_attempts=3, backoff=0)
+        retry_policy.call(fetch, self.test_vols)
+        self.assertEqual(len(attempts), 3)
+
+        del attempts[:]
+        with self.assertRaises(htrc.volumes.DataApiError):
+            retry_policy.call(Mock(side_effect=htrc.volumes.DataApiError("Unable to get volumes.", 401)), [])
+
+        self.assertTrue(0.5 <= htrc.volumes.RetryPolicy(backoff=1, jitter=0.5).delay(2) <= 2)
+
+        # only network errors and transient Data API errors are retried
+        for error, retried in [(ConnectionResetError(), True), (http.client.IncompleteRead(b''), True),
+                               (htrc.volumes.DataApiError("Unable to get volumes.", 429), True),
+                               (htrc.volumes.DataApiError("Unable to get volumes.", 503), True),
+                               (htrc.volumes.DataApiError("Unable to get volumes.", 400), False),
+                               (FileNotFoundError(2, "No such file or directory"), False),
+                               (OSError(28, "No space left on device"), False), (ssl.SSLError(), False),
+                               (ssl.SSLCertVerificationError(), False), (ssl.SSLEOFError(), True),
+                               (ssl.SSLZeroReturnError(), True)]:
+            fetch = Mock(side_effect=error)
+            with self.assertRaises(type(error)):
+                retry_policy.call(fetch, [])
+            self.assertEqual(fetch.call_count, 3 if retried else 1)
+
+    def test_fetch_bisecting_local_error(self):
+        # a local error, e.g. a missing client certificate, is neither retried nor bisected
+        fetch = Mock(side_effect=FileNotFoundError(2, "No such file or directory"))
+        with self.assertRaises(FileNotFoundError):
+            htrc.volumes.fetch_bisecting(fetch, self.test_vols, htrc.volumes.RetryPolicy(backoff=0))
+        self.assertEqual(fetch.call_count, 1)
+
+        # the Data API rejecting a batch is not retried, but the batch is split to isolate the bad volume
+        def fetch(ids):
+            if self.test_vols[3] in ids:
+                raise htrc.volumes.DataApiError("Unable to get volumes.", 400)
+            return BytesIO()
+
+        fetch = Mock(side_effect=fetch)
+        batch = htrc.volumes.fetch_bisecting(fetch, self.test_vols, htrc.volumes.RetryPolicy(backoff=0))
+        self.assertEqual(batch.failed, [self.test_vols[3]])
+        self.assertEqual(fetch.call_count, 7)
+
+    def test_fetch_bisecting(self):
+        def fetch(ids):
+            if self.test_vols[3] in ids:
+                raise htrc.volumes.DataApiError("Unable to get volumes.", 500)
+            return BytesIO()
+
+        batch = htrc.volumes.fetch_bisecting(fetch, self.test_vols, htrc.volumes.RetryPolicy(backoff=0))
+
+        self.assertEqual(batch.failed, [self.test_vols[3]])
+        self.assertEqual(sorted(sum((ids for ids, _ in batch.parts), [])),
+                         sorted(self.test_vols[:3] + self.test_vols[4:]))
+
+    @patch('htrc.volumes.get_volumes')
+    def test_download_volumes_failed(self, volumes_mock):
+        def get_volumes(config, ids, *args, **kwargs):
+            if self.test_vols[0] in ids:
+                raise htrc.volumes.DataApiError("Unable to get volumes.", 500)
+            return make_zip(ids)
+
+        volumes_mock.side_effect = get_volumes
+
+        htrc.volumes.download_volumes(self.test_vols, self.output_path, data_api_config=self.data_api_config,
+                                      parallelism=1, retry_policy=htrc.volumes.RetryPolicy(backoff=0),
+                                      batch_size=2, transfer=htrc.volumes.TransferOptions(concurrency=3))
+
+        with open(os.path.join(self.output_path, 'volumes_failed.txt')) as volumes_failed:
+            self.assertEqual(volumes_failed.read(), self.test_vols[0])
+        self.assertEqual(htrc.volumes.DownloadJournal(self.output_path, resume=True).remaining(self.test_vols),
+                         self.test_vols[:1])
+
+    def test_volume_cache(self):
+        cache_path = os.path.join(self.output_path, 'cache')
+        cache = htrc.volumes.VolumeCache(cache_path)
+
+        with ZipFile(make_zip(self.test_vols[:2])) as vols_zip:
+            for volume_id in self.test_vols[:2]:
+                members = [member for member in vols_zip.namelist() if member.startswith(volume_id + '/')]
+                cache.put(volume_id, vols_zip, members, concat=False)
+
+        self.assertEqual(cache.partition(self.test_vols, concat=False), (self.test_vols[:2], self.test_vols[2:]))
+        self.assertEqual(cache.partition(self.test_vols[:2], concat=True), ([], self.test_vols[:2]))
+
+        with ZipFile(cache.get_batch(self.test_vols[:2])) as batch_zip, \
+                ZipFile(make_zip(self.test_vols[:2])) as vols_zip:
+            self.assertEqual(sorted(batch_zip.namelist()), sorted(vols_zip.namelist()))
+            self.assertEqual(batch_zip.read(self.test_vols[1] + '/00000002.txt'),
+                             vols_zip.read(self.test_vols[1] + '/00000002.txt'))
+
+        # entries are reloaded from disk, least recently used first
+        cache = htrc.volumes.VolumeCache(cache_path, max_size=cache.size)
+        cache.get_batch(self.test_vols[:1])
+        with ZipFile(make_zip(self.test_vols[2:3])) as vols_zip:
+            cache.put(self.test_vols[2], vols_zip, vols_zip.namelist())
+
+        self.assertEqual(cache.partition(self.test_vols)[0], [self.test_vols[0], self.test_vols[2]])
+        self.assertLessEqual(cache.size, cache.max_size)
+
+    @patch('htrc.volumes.get_volumes')
+    def test_download_volumes_cache(self, volumes_mock):
+        volumes_mock.side_effect = mock_get_volumes()
+        cache = htrc.volumes.VolumeCache(mkdtemp())
+
+        try:
+            htrc.volumes.download_volumes(self.test_vols[:3], os.path.join(self.output_path, 'first'),
+                                          data_api_config=self.data_api_config, parallelism=1, cache=cache)
+            htrc.volumes.download_volumes(self.test_vols, os.path.join(self.output_path, 'second'),
+                                          data_api_config=self.data_api_config, parallelism=1, cache=cache,
+                                          remove_headers_footers=True)
+            htrc.volumes.download_volumes(self.test_vols, os.path.join(self.output_path, 'third'),
+                                          data_api_config=self.data_api_config, parallelism=1, cache=cache)
+        finally:
+            shutil.rmtree(cache.cache_dir)
+
+        # header/footer removal requests the same (non-concatenated) payload, so it uses the cached volumes too
+        self.assertEqual([sorted(call[0][1]) for call in volumes_mock.call_args_list],
+                         [sorted(self.test_vols[:3]), sorted(self.test_vols[3:])])
+        for volume_id in self.test_vols:
+            with open(os.path.join(self.output_path, 'third', volume_id, '00000002.txt')) as page_file:
+                self.assertEqual(page_file.read(), 'Running header\nText of page 2 of {}\n2\n'.format(volume_id))
+
+    @patch('htrc.volumes.get_pages')
+    def test_download_pages_cache(self, pages_mock):
+        pages_mock.side_effect = mock_get_pages()
+        data_api_config = htrc.config.HtrcDataApiConfig(token='1234', host='data-host', port=443, epr='/')
+        cache = htrc.volumes.VolumeCache(mkdtemp())
+        page_ids = ['mdp.1[1,2]', 'mdp.1[3]', 'mdp.2[1]']
+
+        try:
+            htrc.volumes.download_volumes(page_ids, self.output_path, data_api_config=data_api_config,
+                                          parallelism=1, pages=True, cache=cache)
+
+            # the merged directory of the pages of mdp.1 is not cached as the pages of either id
+            self.assertEqual(cache.partition(page_ids, pages=True), (['mdp.2[1]'], ['mdp.1[1,2]', 'mdp.1[3]']))
+
+            # page ids of the same volume cached by separate downloads share its directory in a batch
+            for page_id, page in (('mdp.3[1]', 'mdp.3/00000001.txt'), ('mdp.3[2]', 'mdp.3/00000002.txt')):
+                data = BytesIO()
+                with ZipFile(data, 'w') as vols_zip:
+                    vols_zip.writestr('mdp.3/', b'')
+                    vols_zip.writestr(page, b'Page\n')
+                with ZipFile(data) as vols_zip:
+                    cache.put(page_id, vols_zip, vols_zip.namelist(), pages=True)
+            with cache.get_batch(['mdp.3[1]', 'mdp.3[2]'], pages=True) as data, ZipFile(data) as batch_zip:
+                self.assertEqual(batch_zip.namelist(), ['mdp.3/', 'mdp.3/00000001.txt', 'mdp.3/00000002.txt'])
+        finally:
+            shutil.rmtree(cache.cache_dir)
+
+    def test_zip_index(self):
+        names = ['ERROR.err', 'b.1/', 'a.2/', 'a.2/00000002.txt', 'b.1/00000001.txt', 'a.2/00000001.txt',
+                 'a.2/mets/', 'volume-rights.txt', 'c.3/00000001.txt', 'README']
+        zip_index = htrc.volumes.ZipIndex(names)
+
+        self.assertEqual(zip_index.errors, 'ERROR.err')
+        self.assertEqual(zip_index.rights, 'volume-rights.txt')
+        self.assertEqual(zip_index.other, ['README'])
+        self.assertEqual(zip_index.volume_paths, ['b.1/', 'a.2/', 'c.3/'])
+        self.assertEqual(zip_index.pages['a.2/'], ['a.2/00000001.txt', 'a.2/00000002.txt'])
+        self.assertEqual(zip_index.volume_members('c.3/'), ['c.3/00000001.txt'])
+        self.assertEqual(sorted(zip_index.content_members()),
+                         sorted(set(names) - {'ERROR.err', 'volume-rights.txt', 'a.2/mets/'}))
+
+    def test_extract_parallel(self):
+        stale_path = os.path.join(self.output_path, self.test_vols[0])
+        os.makedirs(stale_path)
+        with open(os.path.join(stale_path, 'stale.txt'), 'w'):
+            pass
+
+        with ZipFile(make_zip(self.test_vols)) as vols_zip, ThreadPoolExecutor(max_workers=3) as executor:
+            htrc.volumes._extract_parallel(vols_zip, htrc.volumes.ZipIndex.from_zip(vols_zip), self.output_path,
+                                           executor, buffer_size=16)
+
+        # only the complete volume directories are left, and the files of an existing directory are kept
+        self.assertEqual(sorted(os.listdir(self.output_path)), sorted(self.test_vols))
+        self.assertEqual(sorted(os.listdir(stale_path)), ['00000001.txt', '00000002.txt', '00000003.txt', 'stale.txt'])
+        for volume_id in self.test_vols:
+            self.assertEqual(sorted(os.listdir(os.path.join(self.output_path, volume_id)))[:3],
+                             ['00000001.txt', '00000002.txt', '00000003.txt'])
+            with open(os.path.join(self.output_path, volume_id, '00000003.txt')) as page_file:
+                self.assertEqual(page_file.read(), 'Running header\nText of page 3 of {}\n3\n'.format(volume_id))
+
+    @patch('htrc.volumes.get_volumes')
+    def test_download_volumes_extract_workers(self, volumes_mock):
+        volumes_mock.side_effect = mock_get_volumes()
+
+        htrc.volumes.download_volumes(self.test_vols, self.output_path, data_api_config=self.data_api_config,
+                                      parallelism=1, batch_size=2,
+                                      transfer=htrc.volumes.TransferOptions(extract_workers=4))
+
+        for volume_id in self.test_vols:
+            self.assertEqual(sorted(os.listdir(os.path.join(self.output_path, volume_id))),
+                             ['00000001.txt', '00000002.txt', '00000003.txt'])
+
+        with self.assertRaises(ValueError):
+            htrc.volumes.TransferOptions(extract_workers=0)
+
+    @patch('htrc.volumes.get_pages')
+    def test_download_pages_extract_workers(self, pages_mock):
+        pages_mock.side_effect = mock_get_pages()
+
+        # the pages of mdp.1 are split across batches, whose pages are all kept
+        for extract_workers in (1, 2):
+            output_path = os.path.join(self.output_path, str(extract_workers))
+            htrc.volumes.download_volumes(['mdp.1[1,2]', 'mdp.1[3]', 'mdp.2[1]'], output_path,
+                                          data_api_config=self.data_api_config, parallelism=1, pages=True,
+                                          batch_size=1,
+                                          transfer=htrc.volumes.TransferOptions(extract_workers=extract_workers))
+
+            self.assertEqual(sorted(os.listdir(os.path.join(output_path, 'mdp.1'))),
+                             ['00000001.txt', '00000002.txt', '00000003.txt'])
+            self.assertEqual(os.listdir(os.path.join(output_path, 'mdp.2')), ['00000001.txt'])
+
+    def test_read_member(self):
+        data = BytesIO()
+        with ZipFile(data, 'w', ZIP_DEFLATED) as vols_zip:
+            vols_zip.writestr('vol/', b'')
+            vols_zip.writestr('vol/00000001.txt', b'page 1\n' * 100)
+            vols_zip.writestr('vol/00000002.txt', b'page 2\n', compress_type=ZIP_STORED)
+
+        with ZipFile(data) as vols_zip:
+            zip_index = htrc.volumes.ZipIndex.from_zip(vols_zip)
+        for location in zip_index.locate(zip_index.pages['vol/']):
+            with ZipFile(data) as vols_zip:
+                self.assertEqual(htrc.volumes.zipindex.read_member(data, location), vols_zip.read(location.name))
+
+        with self.assertRaises(ValueError):
+            htrc.volumes.ZipIndex(['vol/00000001.txt']).locate(['vol/00000001.txt'])
+
+    @patch('htrc.volumes.get_volumes')
+    def test_download_volumes_hf_read_from_zip(self, volumes_mock):
+        volumes_mock.side_effect = mock_get_volumes(num_pages=8)
+
+        output_paths = [os.path.join(self.output_path, str(hf_read_from_zip)) for hf_read_from_zip in (False, True)]
+        for output_path, hf_read_from_zip in zip(output_paths, (False, True)):
+            htrc.volumes.download_volumes(self.test_vols, output_path, data_api_config=self.data_api_config,
+                                          parallelism=1, batch_size=2, remove_headers_footers=True,
+                                          transfer=htrc.volumes.TransferOptions(hf_read_from_zip=hf_read_from_zip))
+            # the workers open the responses written to a named file as they are received, rather than a copy
+            self.assertEqual(volumes_mock.call_args[1]['named_spool'], hf_read_from_zip)
+
+        for volume_id in self.test_vols:
+            for name in ('00000004.txt', 'removed_hf.csv'):
+                with open(os.path.join(output_paths[0], volume_id, name)) as expected, \
+                        open(os.path.join(output_paths[1], volume_id, name)) as actual:
+                    self.assertEqual(actual.read(), expected.read())
+
+    @patch('htrc.volumes.get_volumes')
+    def test_download_volumes_workset_hf_report(self, volumes_mock):
+        volumes_mock.side_effect = mock_get_volumes(num_pages=8)
+
+        output_paths = [os.path.join(self.output_path, hf_report) for hf_report in ('volume', 'workset')]
+        for output_path, hf_report in zip(output_paths, ('volume', 'workset')):
+            htrc.volumes.download_volumes(self.test_vols, output_path, data_api_config=self.data_api_config,
+                                          parallelism=1, batch_size=2, remove_headers_footers=True,
+                                          hf_report=hf_report)
+
+        expected = []
+        for volume_id in sorted(self.test_vols):
+            self.assertFalse(os.path.exists(os.path.join(output_paths[1], volume_id, 'removed_hf.csv')))
+            with open(os.path.join(output_paths[0], volume_id, 'removed_hf.csv'), newline='') as report:
+                rows = list(csv.reader(report))
+            self.assertEqual(rows[0], ['page', 'header', 'footer'])
+            expected.extend([volume_id] + row for row in rows[1:])
+        self.assertTrue(expected)
+
+        with open(os.path.join(output_paths[1], 'removed_hf.csv'), newline='') as report:
+            rows = list(csv.reader(report))
+        self.assertEqual(rows[0], ['volume', 'page', 'header', 'footer'])
+        self.assertEqual(sorted(rows[1:]), sorted(expected))
+        self.assertEqual(sorted(htrc.workset.path_to_volumes(output_paths[1])), sorted(self.test_vols))
+
+        # resuming appends to the report, and a new download replaces it
+        with htrc.volumes.WorksetReport(output_paths[1]) as workset_report:
+            workset_report.write_volume('vol', [('00000001', 'header', '')])
+        with open(os.path.join(output_paths[1], 'removed_hf.csv'), newline='') as report:
+            self.assertEqual(list(csv.reader(report))[-1], ['vol', '00000001', 'header', ''])
+        with htrc.volumes.WorksetReport(output_paths[1], append=False):
+            pass
+        with open(os.path.join(output_paths[1], 'removed_hf.csv')) as report:
+            self.assertEqual(report.read(), 'volume,page,header,footer\n')
+
+        with self.assertRaises(ValueError):
+            htrc.volumes.download_volumes(self.test_vols, output_paths[1], data_api_config=self.data_api_config,
+                                          parallelism=1, hf_report='page')
+
+    @patch('htrc.volumes.get_volumes')
+    def test_clean_volumes(self, volumes_mock):
+        volumes_mock.side_effect = mock_get_volumes(num_pages=8)
+
+        raw_path = os.path.join(self.output_path, 'raw')
+        expected_path = os.path.join(self.output_path, 'expected')
+        clean_path = os.path.join(self.output_path, 'clean')
+        htrc.volumes.download_volumes(self.test_vols, raw_path, data_api_config=self.data_api_config, parallelism=1)
+        htrc.volumes.download_volumes(self.test_vols, expected_path, data_api_config=self.data_api_config,
+                                      parallelism=1, remove_headers_footers=True)
+
+        cleaned = htrc.volumes.clean_volumes(raw_path, clean_path, parallelism=1)
+        self.assertEqual(sorted(cleaned), sorted(self.test_vols))
+        for volume_id in self.test_vols:
+            for name in ('00000004.txt', 'removed_hf.csv'):
+                with open(os.path.join(expected_path, volume_id, name)) as expected, \
+                        open(os.path.join(clean_path, volume_id, name)) as actual:
+                    self.assertEqual(actual.read(), expected.read())
+        self.assertEqual(sorted(htrc.workset.path_to_volumes(clean_path)), sorted(self.test_vols))
+
+        # up-to-date volumes are skipped, unless a page or the parameters changed
+        self.assertEqual(htrc.volumes.clean_volumes(raw_path, clean_path, parallelism=1), [])
+        with open(os.path.join(raw_path, self.test_vols[0], '00000009.txt'), 'w') as page_file:
+            page_file.write('Running header\nA new page\n9\n')
+        self.assertEqual(htrc.volumes.clean_volumes(raw_path, clean_path, parallelism=1), [self.test_vols[0]])
+        self.assertTrue(os.path.exists(os.path.join(clean_path, self.test_vols[0], '00000009.txt')))
+        self.assertEqual(len(htrc.volumes.clean_volumes(raw_path, clean_path, parallelism=1, force=True)),
+                         len(self.test_vols))
+        self.assertEqual(len(htrc.volumes.clean_volumes(raw_path, clean_path, parallelism=1, hf_candidates='lsh')),
+                         len(self.test_vols))
+        self.assertEqual(len(htrc.volumes.clean_volumes(raw_path, clean_path, parallelism=1)), len(self.test_vols))
+
+        # switching to concatenated output replaces the page directories
+        cleaned = htrc.volumes.clean_volumes(raw_path, clean_path, parallelism=1, concat=True, hf_window_size=4,
+                                             skip_removed_hf=True)
+        self.assertEqual(len(cleaned), len(self.test_vols))
+        for volume_id in self.test_vols:
+            self.assertFalse(os.path.exists(os.path.join(clean_path, volume_id)))
+            self.assertTrue(os.path.isfile(os.path.join(clean_path, volume_id + '.txt')))
+
+        with self.assertRaises(ValueError):
+            htrc.volumes.clean_volumes(raw_path, raw_path, parallelism=1)
+
+    def test_bounded_feed(self):
+        produced = []
+
+        def items():
+            for i in range(20):
+                produced.append(i)
+                yield i
+
+        with multiprocessing.Pool(processes=1) as pool, htrc.volumes._BoundedFeed(items(), 3) as feed:
+            results = []
+            for result in pool.imap_unordered(abs, feed):
+                # the pool never runs more than 3 items ahead of the results consumed (plus the one waiting)
+                self.assertLessEqual(len(produced), len(results) + 3 + 1)
+                results.append(result)
+                feed.release()
+
+        self.assertEqual(sorted(results), list(range(20)))
+
+        # a closed feed lets the pool shut down without consuming the remaining items
+        with multiprocessing.Pool(processes=1) as pool, htrc.volumes._BoundedFeed(iter(range(20)), 1) as feed:
+            next(pool.imap_unordered(abs, feed))
+        self.assertEqual(list(feed), [])
+
+    def test_bundle(self):
+        for mode in ('workset', 'volume'):
+            output_path = os.path.join(self.output_path, mode)
+            os.makedirs(output_path)
+            with htrc.volumes.BundleWriter(output_path, mode) as bundle_writer, \
+                    ZipFile(make_zip(self.test_vols[:2])) as vols_zip:
+                bundle_writer.write_zip(vols_zip, htrc.volumes.ZipIndex.from_zip(vols_zip))
+                bundle_writer.write_volume('a.1/', [('a.1.txt', 'Concatenated text')])
+
+            with htrc.volumes.WorksetBundle(output_path) as bundle:
+                self.assertEqual(sorted(bundle.volume_ids), sorted(self.test_vols[:2] + ['a.1']))
+                self.assertIn(self.test_vols[1], bundle)
+                self.assertEqual(bundle.page_names(self.test_vols[1]),
+                                 ['{}/{:08d}.txt'.format(self.test_vols[1], page) for page in (1, 2, 3)])
+                self.assertEqual(bundle.page(self.test_vols[1], 1).text_lines,
+                                 ['Running header', 'Text of page 2 of {}'.format(self.test_vols[1]), '2'])
+                self.assertEqual(len(bundle.pages(self.test_vols[0])), 3)
+                self.assertEqual(bundle.page('a.1', 0).text_lines, ['Concatenated text'])
+                with self.assertRaises(KeyError):
+                    bundle.pages('b.2')
+
+            self.assertEqual(sorted(htrc.workset.path_to_volumes(output_path)),
+                             sorted(self.test_vols[:2] + ['a.1']))
+
+    def test_bundle_recover(self):
+        bundle_path = os.path.join(self.output_path, htrc.volumes.BUNDLE_FILENAME)
+
+        def interrupt():
+            # the download is interrupted before the central directory is written again
+            shutil.copy(bundle_path, bundle_path + '.interrupted')
+
+        with htrc.volumes.BundleWriter(self.output_path) as bundle_writer:
+            bundle_writer.write_volume('a.1/', [('a.1/00000001.txt', 'Page 1')])
+            bundle_writer.checkpoint(force=True)
+            bundle_writer.write_volume('b.2/', [('b.2/00000001.txt', 'Page 1' * 100)])
+            # the central directory is not written again within the checkpoint interval
+            bundle_writer.checkpoint()
+            bundle_writer.write_volume('c.3/', [('c.3/00000001.txt', 'Page 1')])
+            bundle_writer._workset_zip.fp.flush()
+            interrupt()
+        os.replace(bundle_path + '.interrupted', bundle_path)
+
+        # the volume written after the last checkpoint is downloaded again
+        with htrc.volumes.BundleWriter(self.output_path, replace=['c.3']) as bundle_writer:
+            bundle_writer.write_volume('c.3/', [('c.3/00000001.txt', 'Page 1 again')])
+            bundle_writer.write_volume('d.4/', [('d.4/00000001.txt', 'Page 1')])
+
+        with htrc.volumes.WorksetBundle(self.output_path) as bundle:
+            self.assertEqual(sorted(bundle.volume_ids), ['a.1', 'b.2', 'c.3', 'd.4'])
+            self.assertEqual(bundle.page('b.2', 0).text, 'Page 1' * 100)
+            self.assertEqual(bundle.page('c.3', 0).text, 'Page 1 again')
+        with ZipFile(bundle_path) as bundle_zip:
+            self.assertEqual(len(bundle_zip.namelist()), len(set(bundle_zip.namelist())))
+
+        # a volume written again after a checkpoint is replaced as well
+        with htrc.volumes.BundleWriter(self.output_path, replace=['d.4']) as bundle_writer:
+            bundle_writer.write_volume('d.4/', [('d.4/00000001.txt', 'Page 1 again')])
+        with ZipFile(bundle_path) as bundle_zip:
+            self.assertEqual(sorted(bundle_zip.namelist()),
+                             ['a.1/00000001.txt', 'b.2/00000001.txt', 'c.3/00000001.txt', 'd.4/00000001.txt'])
+
+        # only the last entry of files which appear several times is read
+        with htrc.volumes.BundleWriter(self.output_path) as bundle_writer:
+            bundle_writer.write_volume('d.4/', [('d.4/00000001.txt', 'Page 1 once more')])
+        with htrc.volumes.WorksetBundle(bundle_path) as bundle:
+            self.assertEqual(bundle.page_names('d.4'), ['d.4/00000001.txt'])
+            self.assertEqual(bundle.page('d.4', 0).text, 'Page 1 once more')
+
+    @patch('htrc.volumes.get_volumes')
+    def test_download_volumes_bundle(self, volumes_mock):
+        volumes_mock.side_effect = mock_get_volumes()
+
+        for remove_headers_footers, stream_extract in ((False, False), (True, False), (True, True)):
+            output_path = os.path.join(self.output_path, str(remove_headers_footers) + str(stream_extract))
+            htrc.volumes.download_volumes(self.test_vols, output_path, data_api_config=self.data_api_config,
+                                          parallelism=1, batch_size=2, remove_headers_footers=remove_headers_footers,
+                                          transfer=htrc.volumes.TransferOptions(stream_extract=stream_extract),
+                                          output=htrc.volumes.OutputOptions(bundle='workset'))
+
+            # no files are written besides the bundle and the download journal
+            self.assertEqual(sorted(os.listdir(output_path)), ['.htrc-download.log', htrc.volumes.BUNDLE_FILENAME])
+            with htrc.volumes.WorksetBundle(output_path) as bundle:
+                self.assertEqual(sorted(bundle.volume_ids), sorted(self.test_vols))
+                self.assertEqual(len(bundle.pages(self.test_vols[2])), 3)
+                if remove_headers_footers:
+                    self.assertIn(self.test_vols[2] + '/removed_hf.csv', bundle.files(self.test_vols[2]))
+
+            # the volumes written before the download was interrupted, but not recorded in its journal,
+            # are replaced rather than appended a second time when it is resumed
+            os.remove(os.path.join(output_path, '.htrc-download.log'))
+            htrc.volumes.download_volumes(self.test_vols, output_path, data_api_config=self.data_api_config,
+                                          parallelism=1, batch_size=2, remove_headers_footers=remove_headers_footers,
+                                          transfer=htrc.volumes.TransferOptions(stream_extract=stream_extract),
+                                          output=htrc.volumes.OutputOptions(bundle='workset', resume=True))
+            with ZipFile(os.path.join(output_path, htrc.volumes.BUNDLE_FILENAME)) as bundle_zip:
+                self.assertEqual(len(bundle_zip.namelist()), len(set(bundle_zip.namelist())))
+                self.assertEqual(len(bundle_zip.namelist()), 4 * len(self.test_vols))
+
+        with self.assertRaises(ValueError):
+            htrc.volumes.OutputOptions(bundle='pages')
+        with self.assertRaises(ValueError):
+            htrc.volumes.download_volumes(self.test_vols, self.output_path, data_api_config=self.data_api_config,
+                                          parallelism=1, transfer=htrc.volumes.TransferOptions(stream_extract=True),
+                                          output=htrc.volumes.OutputOptions(bundle='workset'))
+
+    @patch('htrc.volumes.get_pages')
+    def test_download_pages_bundle(self, pages_mock):
+        pages_mock.side_effect = mock_get_pages()
+
+        # the pages of mdp.1 are split across batches, whose pages are all kept
+        for bundle in htrc.volumes.BUNDLE_MODES:
+            output_path = os.path.join(self.output_path, bundle)
+            htrc.volumes.download_volumes(['mdp.1[1,2]', 'mdp.1[3]', 'mdp.2[1]'], output_path,
+                                          data_api_config=self.data_api_config, parallelism=1, pages=True,
+                                          batch_size=1, output=htrc.volumes.OutputOptions(bundle=bundle))
+
+            with htrc.volumes.WorksetBundle(output_path) as workset_bundle:
+                self.assertEqual(workset_bundle.page_names('mdp.1'),
+                                 ['mdp.1/00000001.txt', 'mdp.1/00000002.txt', 'mdp.1/00000003.txt'])
+                self.assertEqual(workset_bundle.page('mdp.1', 2).text, 'Page 3')
+
+    def test_workset_reader(self):
+        with ZipFile(make_zip(self.test_vols[:3])) as vols_zip:
+            vols_zip.extractall(self.output_path)
+        with open(os.path.join(self.output_path, 'a.1.txt'), 'w') as vol_file:
+            vol_file.write('Concatenated text\nof a.1\n')
+        with open(os.path.join(self.output_path, 'volume-rights.txt'), 'w'):
+            pass
+
+        for pack in (False, True):
+            with htrc.volumes.WorksetReader(self.output_path, pack=pack) as reader:
+                self.assertEqual(reader.volume_ids, sorted(self.test_vols[:3] + ['a.1']))
+                self.assertEqual(reader.page_names(self.test_vols[1]),
+                                 ['00000001.txt', '00000002.txt', '00000003.txt'])
+                page = reader.page(self.test_vols[1], 1)
+                self.assertIsInstance(page, htrc.volumes.MappedPage)
+                self.assertEqual(page.text_lines,
+                                 ['Running header', 'Text of page 2 of {}'.format(self.test_vols[1]), '2'])
+                self.assertEqual(reader.page(self.test_vols[1], '00000003.txt').text_lines[-1], '3')
+                self.assertEqual(reader.page(self.test_vols[1], -1).text_lines[-1], '3')
+                self.assertEqual(reader.pages('a.1')[0].text_lines, ['Concatenated text', 'of a.1'])
+                unread_page = reader.page(self.test_vols[0], 0)
+                with self.assertRaises(IndexError):
+                    reader.page(self.test_vols[1], 3)
+                with self.assertRaises(KeyError):
+                    reader.pages('b.2')
+            del unread_page
+            # the data file holding a copy of the pages is only written on request
+            self.assertEqual(os.path.exists(os.path.join(self.output_path, htrc.volumes.reader.DATA_FILENAME)),
+                             pack)
+
+        # the index is reused while the volumes are unchanged, and rebuilt once they change
+        index_path = os.path.join(self.output_path, htrc.volumes.reader.INDEX_FILENAME)
+        index_mtime = os.stat(index_path).st_mtime_ns
+        with htrc.volumes.WorksetReader(self.output_path, pack=True) as reader:
+            self.assertEqual(len(reader), 4)
+        self.assertEqual(os.stat(index_path).st_mtime_ns, index_mtime)
+
+        # rewriting a page does not change the modification time of its volume's directory
+        with open(os.path.join(self.output_path, self.test_vols[2], '00000002.txt'), 'w') as page_file:
+            page_file.write('Running header\r\nRewritten\x0cpage\n2\n')
+        shutil.rmtree(os.path.join(self.output_path, self.test_vols[0]))
+        for pack in (True, False):
+            with htrc.volumes.WorksetReader(self.output_path, pack=pack) as reader:
+                self.assertNotIn(self.test_vols[0], reader)
+                self.assertEqual(reader.page(self.test_vols[2], 0).text_lines[1],
+                                 'Text of page 1 of {}'.format(self.test_vols[2]))
+                # pages are split into lines like the pages of a Data API response
+                self.assertEqual(reader.page(self.test_vols[2], 1).text_lines,
+                                 ['Running header', 'Rewritten\x0cpage', '2'])
+
+        self.assertEqual(sorted(htrc.workset.path_to_volumes(self.output_path)),
+                         sorted(self.test_vols[1:3] + ['a.1.txt', 'volume-rights.txt']))
+
+    @patch('htrc.volumes.get_volumes')
+    def test_iter_volumes(self, volumes_mock):
+        def get_volumes(config, ids, *args, stream=None, **kwargs):
+            if self.test_vols[0] in ids:
+                raise htrc.volumes.DataApiError("Unable to get volumes.", 500)
+            return stream(make_zip(ids, num_pages=8))
+
+        volumes_mock.side_effect = get_volumes
+
+        for remove_headers_footers in (False, True):
+            failed = []
+            volumes = dict(htrc.volumes.iter_volumes(self.test_vols, data_api_config=self.data_api_config,
+                                                     parallelism=1, batch_size=2,
+                                                     transfer=htrc.volumes.TransferOptions(concurrency=2),
+                                                     retry_policy=htrc.volumes.RetryPolicy(backoff=0),
+                                                     remove_headers_footers=remove_headers_footers, failed=failed))
+
+            self.assertEqual(sorted(volumes), sorted(self.test_vols[1:]))
+            self.assertEqual(failed, self.test_vols[:1])
+            vol_pages = volumes[self.test_vols[1]]
+            self.assertEqual(len(vol_pages), 8)
+            self.assertEqual(vol_pages[2].text_lines,
+                             ['Running header', 'Text of page 3 of {}'.format(self.test_vols[1]), '3'])
+            if remove_headers_footers:
+                # the same structure is found as when parsing the pages in this process
+                expected = parse_page_structure([htrc.models.HtrcPage(page.text_lines) for page in vol_pages])
+                self.assertIsInstance(vol_pages[2], htrc.models.HtrcStructuredPage)
+                self.assertEqual([(page.header, page.body, page.footer) for page in vol_pages],
+                                 [(page.header, page.body, page.footer) for page in expected])
+                self.assertTrue(vol_pages[2].has_header)
+
+        # nothing was written to disk
+        self.assertEqual(os.listdir(self.output_path), [])
+
+        # stopping early releases the download threads and worker processes
+        volumes = htrc.volumes.iter_volumes(self.test_vols[1:], data_api_config=self.data_api_config, parallelism=1,
+                                            batch_size=1, remove_headers_footers=True)
+        next(volumes)
+        volumes.close()
+
+        with self.assertRaises(ValueError):
+            htrc.volumes.TransferOptions(hf_max_pending=0)
+
+    def test_iter_zip_members(self):
+        members = [('vol/', b''), ('vol/00000001.txt', b'page 1\n' * 100), ('vol/00000002.txt', b'')]
+        for compression in (ZIP_STORED, ZIP_DEFLATED):
+            for stream in (BytesIO(), NonSeekableStream()):
+                with ZipFile(stream, 'w', compression) as vols_zip:
+                    for name, data in members:
+                        vols_zip.writestr(name, data)
+
+                # read in small chunks, so that headers and members straddle chunk boundaries
+                self.assertEqual(list(htrc.volumes.iter_zip_members(BytesIO(stream.getvalue()), chunk_size=7)),
+                                 members)
+
+        with self.assertRaises(htrc.volumes.ZipStreamError):
+            list(htrc.volumes.iter_zip_members(BytesIO(make_zip(self.test_vols).getvalue()[:200])))
+
+    def test_extract_stream(self):
+        volumes = []
+        batch = htrc.volumes.zipstream.extract_stream(make_zip(self.test_vols[:2]), self.output_path,
+                                                      on_volume=lambda *vol_data: volumes.append(vol_data))
+
+        self.assertEqual(batch.volume_paths, [volume_id + '/' for volume_id in self.test_vols[:2]])
+        self.assertEqual([vol_path for vol_path, _, _ in volumes], batch.volume_paths)
+        self.assertEqual(volumes[1][1], ['{}/{:08d}.txt'.format(self.test_vols[1], page) for page in (1, 2, 3)])
+        self.assertEqual(volumes[1][2][0], 'Running header\nText of page 1 of {}\n1\n'.format(
+            self.test_vols[1]).encode('utf-8'))
+        self.assertEqual(os.listdir(self.output_path), [])
+
+        batch = htrc.volumes.zipstream.extract_stream(make_zip(self.test_vols[:2]), self.output_path)
+        self.assertEqual(sorted(os.listdir(os.path.join(self.output_path, self.test_vols[0]))),
+                         ['00000001.txt', '00000002.txt', '00000003.txt'])
+
+        evil = BytesIO()
+        with ZipFile(evil, 'w') as vols_zip:
+            vols_zip.writestr('../evil.txt', b'')
+        with self.assertRaises(htrc.volumes.ZipStreamError):
+            htrc.volumes.zipstream.extract_stream(BytesIO(evil.getvalue()), self.output_path)
+
+    @patch('htrc.volumes.get_volumes')
+    def test_download_volumes_stream_extract(self, volumes_mock):
+        volumes_mock.side_effect = mock_get_volumes()
+
+        for remove_headers_footers in (False, True):
+            output_paths = []
+            for stream_extract in (False, True):
+                output_paths.append(os.path.join(self.output_path, str(remove_headers_footers), str(stream_extract)))
+                htrc.volumes.download_volumes(self.test_vols, output_paths[-1], data_api_config=self.data_api_config,
+                                              parallelism=1, batch_size=2,
+                                              remove_headers_footers=remove_headers_footers,
+                                              transfer=htrc.volumes.TransferOptions(stream_extract=stream_extract),
+                                              batching=htrc.volumes.BatchOptions(adaptive=True))
+
+            # the extracted volumes are the same as when the responses are extracted once complete
+            for volume_id in self.test_vols:
+                self.assertEqual(sorted(os.listdir(os.path.join(output_paths[1], volume_id))),
+                                 sorted(os.listdir(os.path.join(output_paths[0], volume_id))))
+                with open(os.path.join(output_paths[0], volume_id, '00000002.txt')) as page_file, \
+                        open(os.path.join(output_paths[1], volume_id, '00000002.txt')) as streamed_page_file:
+                    self.assertEqual(streamed_page_file.read(), page_file.read())
+            self.assertEqual(htrc.volumes.DownloadJournal(output_paths[1], resume=True).remaining(self.test_vols),
+                             [])
+
+        with self.assertRaises(ValueError):
+            htrc.volumes.TransferOptions(use_asyncio=True, stream_extract=True)
+
+    @patch('htrc.volumes.get_volumes')
+    def test_download_volumes_stream_extract_failure(self, volumes_mock):
+        class FailingStream(BytesIO):
+            # the connection is reset once half of the response has been read
+            def read(self, size=-1):
+                limit = len(self.getvalue()) // 2 - self.tell()
+                if limit <= 0:
+                    raise ConnectionResetError("Connection reset by peer")
+                return super().read(limit if size < 0 else min(size, limit))
+
+        def get_volumes(config, ids, *args, stream=None, **kwargs):
+            if self.test_vols[0] in ids or len(responses) == 0:
+                responses.append(FailingStream(make_zip(ids).getvalue()))
+            else:
+                responses.append(make_zip(ids))
+            return stream(responses[-1])
+
+        volumes_mock.side_effect = get_volumes
+
+        for remove_headers_footers in (False, True):
+            responses = []
+            output_path = os.path.join(self.output_path, str(remove_headers_footers))
+            htrc.volumes.download_volumes(self.test_vols, output_path, data_api_config=self.data_api_config,
+                                          parallelism=1, batch_size=5, remove_headers_footers=remove_headers_footers,
+                                          hf_report='workset',
+                                          transfer=htrc.volumes.TransferOptions(stream_extract=True),
+                                          retry_policy=htrc.volumes.RetryPolicy(max_attempts=2, backoff=0))
+
+            # the volume which cannot be downloaded is not left half extracted, and the volumes of the failed
+            # attempts are removed then extracted again
+            self.assertFalse(os.path.exists(os.path.join(output_path, self.test_vols[0])))
+            for volume_id in self.test_vols[1:]:
+                self.assertEqual(sorted(os.listdir(os.path.join(output_path, volume_id))),
+                                 ['00000001.txt', '00000002.txt', '00000003.txt'])
+            if remove_headers_footers:
+                # the pages of each volume are reported once, from the attempt which succeeded
+                with open(os.path.join(output_path, 'removed_hf.csv')) as report_file:
+                    rows = list(csv.reader(report_file))[1:]
+                self.assertEqual(len(rows), len(set(map(tuple, rows))))
+                self.assertEqual({row[0] for row in rows}, set(self.test_vols[1:]))
+            self.assertEqual(htrc.volumes.DownloadJournal(output_path, resume=True).remaining(self.test_vols),
+                             [self.test_vols[0]])
+
+    def test_transfer(self):
+        payload = bytes(range(256)) * 10
+        out = BytesIO()
+
+        num_bytes = htrc.volumes._transfer(MockResponse(payload), out, buffer_size=100, progress_interval=0)
+
+        self.assertEqual(num_bytes, len(payload))
+        self.assertEqual(out.getvalue(), payload)
+
+    def test_prefetch(self):
+        fetched = list(htrc.volumes._prefetch(lambda i: BytesIO(bytes([i])), range(5), 2))
+
+        self.assertEqual([i for i, _ in fetched], list(range(5)))
+        self.assertEqual([data.getvalue() for _, data in fetched], [bytes([i]) for i in range(5)])
+
+    def test_prefetch_concurrent(self):
+        lock = threading.Lock()
+        running = []
+        max_running = []
+
+        def fetch(i):
+            with lock:
+                running.append(i)
+                max_running.append(len(running))
+            time.sleep(0.05 * (3 - i % 3))
+            with lock:
+                running.remove(i)
+            return BytesIO(bytes([i]))
+
+        fetched = [i for i, _ in htrc.volumes._prefetch(fetch, range(6), 0, concurrency=3)]
+
+        self.assertEqual(sorted(fetched), list(range(6)))
+        self.assertNotEqual(fetched, list(range(6)))  # handed out in completion order
+        self.assertEqual(max(max_running), 3)
+
+    def test_prefetch_max_pending_bytes(self):
+        started = []
+
+        def fetch(i):
+            started.append(i)
+            return BytesIO(b'x' * 10)
+
+        for i, data in htrc.volumes._prefetch(fetch, range(20), 10, max_pending_bytes=10,
+                                              sizeof=lambda data: len(data.getvalue())):
+            time.sleep(0.01)
+            # each result reaches the cap, so only the next one is retrieved while one is being consumed
+            self.assertLessEqual(len(started), i + 2)
+
+    def test_prefetch_error(self):
+        def fetch(i):
+            if i == 3:
+                raise EnvironmentError("Unable to get volumes.")
+            return BytesIO()
+
+        fetched = []
         with self.assertRaises(EnvironmentError):
-            htrc.volumes.get_pages(data_api_config, self.test_vols)
+            for i, data in htrc.volumes._prefetch(fetch, range(5), 2):
+                fetched.append(i)
+
+        self.assertEqual(fetched, [0, 1, 2])
+
+    def test_prefetch_closes_unconsumed(self):
+        fetched = []
+
+        def fetch(i):
+            fetched.append(BytesIO())
+            return fetched[-1]
+
+        for i, data in htrc.volumes._prefetch(fetch, range(5), 2):
+            break
+
+        self.assertFalse(fetched[0].closed)
+        self.assertTrue(all(data.closed for data in fetched[1:]))
 
     def test_get_volumes_and_pages_empty(self):
-        data_api_config = htrc.config.HtrcDataApiConfig(
-            token='1234',
-            host='data-host',
-            port=443,
-            epr='/',
-            cert='/home/client-certs/client.pem',
-            key='/home/client-certs/client.pem'
-        )
 
         with self.assertRaises(ValueError):
-            htrc.volumes.get_volumes(data_api_config, [])
+            htrc.volumes.get_volumes(self.data_api_config, [])
 
         with self.assertRaises(ValueError):
-            htrc.volumes.get_pages(data_api_config, [])
+            htrc.volumes.get_pages(self.data_api_config, [])
 
     @patch('htrc.volumes.ZipFile')
     @patch('htrc.volumes.get_volumes')
@@ -119,23 +1088,14 @@ class TestVolumes(unittest.TestCase):
         response_mock = Mock(status=200)
         https_mock.return_value.getresponse.return_value = response_mock
         oauth2_mock.return_value = 'a1b2c3d4e5'
-        volumes_mock.return_value = b''
-
-        data_api_config = htrc.config.HtrcDataApiConfig(
-            token='1234',
-            host='data-host',
-            port=443,
-            epr='/',
-            cert='/home/client-certs/client.pem',
-            key='/home/client-certs/client.pem'
-        )
+        volumes_mock.side_effect = lambda *args, **kwargs: BytesIO()
 
-        htrc.volumes.download_volumes(self.test_vols, self.output_path, data_api_config=data_api_config)
+        htrc.volumes.download_volumes(self.test_vols, self.output_path, data_api_config=self.data_api_config)
 
         # test directory creation
         import shutil
         shutil.rmtree(self.output_path)
-        htrc.volumes.download_volumes(self.test_vols, self.output_path, data_api_config=data_api_config)
+        htrc.volumes.download_volumes(self.test_vols, self.output_path, data_api_config=self.data_api_config)
 
     # TODO: Fix this test for case where config file exists, but creds not set
     """
@@ -0,0 +1,280 @@
+from __future__ import print_function
+from future import standard_library
+standard_library.install_aliases()
+
+import sys
+if sys.version_info.major == 2:
+    from mock import Mock, patch, PropertyMock
+elif sys.version_info.major == 3:
+    from unittest.mock import Mock, patch, PropertyMock
+
+import asyncio
+import http.client
+from io import BytesIO
+import os
+import shutil
+from tempfile import mkdtemp
+from urllib.parse import parse_qs
+from zipfile import ZipFile, ZipInfo
+import unittest2 as unittest
+
+import htrc.config
+import htrc.volumes
+import htrc.volumes.aio
+
+
+def make_zip(volume_ids):
+    data = BytesIO()
+    with ZipFile(data, 'w') as vols_zip:
+        # a fixed date, so that the archives built for the same volumes are identical
+        for volume_id in volume_ids:
+            vols_zip.writestr(ZipInfo(volume_id + '/', (2020, 1, 1, 0, 0, 0)), b'')
+            vols_zip.writestr(ZipInfo(volume_id + '/00000001.txt', (2020, 1, 1, 0, 0, 0)),
+                              'Text of {}\n'.format(volume_id))
+    return data.getvalue()
+
+
+class StandInDataApi:
+    """
+    A local stand-in for the Data API, answering `/volumes` and `/pages` requests
+    over plain HTTP/1.1 with keep-alive. The first `truncate` responses are cut
+    short by closing the connection halfway through their body.
+    """
+
+    def __init__(self, chunked=False, delay=0, truncate=0):
+        self.chunked = chunked
+        self.delay = delay
+        self.truncate = truncate
+        self.requests = []
+        self.num_connections = 0
+        self.open_connections = 0
+        self.max_open_connections = 0
+        self._handlers = set()
+        self._loop_thread = htrc.volumes.aio.EventLoopThread()
+
+    def __enter__(self):
+        self._loop_thread.__enter__()
+        self._server = self._loop_thread.run(asyncio.start_server(self._handle, '127.0.0.1', 0))
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    def __exit__(self, *exc_info):
+        self._server.close()
+        self._loop_thread.run(self._shutdown())
+        self._loop_thread.__exit__(*exc_info)
+
+    async def _shutdown(self):
+        await self._server.wait_closed()
+        for handler in self._handlers:
+            handler.cancel()
+        await asyncio.gather(*self._handlers, return_exceptions=True)
+
+    async def _handle(self, reader, writer):
+        self._handlers.add(asyncio.current_task())
+        self.num_connections += 1
+        self.open_connections += 1
+        self.max_open_connections = max(self.max_open_connections, self.open_connections)
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                _, path, _ = request_line.decode('latin-1').split(' ')
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line == b'\r\n':
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                form = parse_qs((await reader.readexactly(int(headers['content-length']))).decode('utf-8'))
+                self.requests.append((path, headers, form))
+
+                ids = form.get('volumeIDs', form.get('pageIDs', ['']))[0].split('|')
+                if path not in ('/volumes', '/pages') or headers.get('authorization') != 'Bearer 1234':
+                    body, status = b'Bad request', b'500 Internal Server Error'
+                else:
+                    body, status = make_zip(ids), b'200 OK'
+
+                await asyncio.sleep(self.delay)
+                if self.truncate:
+                    self.truncate -= 1
+                    if self.chunked:
+                        writer.write(b'HTTP/1.1 ' + status + b'\r\nTransfer-Encoding: chunked\r\n\r\n' +
+                                     '{:x}\r\n'.format(len(body)).encode('ascii') + body[:len(body) // 2])
+                    else:
+                        writer.write(b'HTTP/1.1 ' + status + b'\r\nContent-Length: ' +
+                                     str(len(body)).encode('ascii') + b'\r\n\r\n' + body[:len(body) // 2])
+                    await writer.drain()
+                    break
+                if self.chunked:
+                    writer.write(b'HTTP/1.1 ' + status + b'\r\nTransfer-Encoding: chunked\r\n\r\n')
+                    for start in range(0, len(body), 100):
+                        chunk = body[start:start + 100]
+                        writer.write('{:x}\r\n'.format(len(chunk)).encode('ascii') + chunk + b'\r\n')
+                        await writer.drain()
+                    writer.write(b'0\r\n\r\n')
+                else:
+                    writer.write(b'HTTP/1.1 ' + status + b'\r\nContent-Length: ' +
+                                 str(len(body)).encode('ascii') + b'\r\n\r\n' + body)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        finally:
+            self.open_connections -= 1
+            writer.close()
+
+
+class TestVolumesAio(unittest.TestCase):
+    def setUp(self):
+        self.test_vols = ['mdp.39015050817181', 'mdp.39015055436151',
+            'mdp.39015056169157', 'mdp.39015050161697', 'mdp.39015042791874']
+
+        self.output_path = mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.output_path)
+
+    def data_api_config(self, server):
+        return htrc.config.HtrcDataApiConfig(
+            token='1234',
+            host='127.0.0.1',
+            port=server.port,
+            epr='/',
+            cert='/home/client-certs/client.pem',
+            key='/home/client-certs/client.pem'
+        )
+
+    def test_get_volumes_and_pages(self):
+        async def run(data_api_config):
+            async with htrc.volumes.aio.AsyncDataApiClient(data_api_config, ssl_context=False) as client:
+                volumes = await htrc.volumes.aio.get_volumes(data_api_config, self.test_vols, concat=True,
+                                                             client=client)
+                pages = await htrc.volumes.aio.get_pages(data_api_config, self.test_vols, client=client)
+            return volumes, pages
+
+        with StandInDataApi() as server:
+            volumes, pages = asyncio.run(run(self.data_api_config(server)))
+
+        self.assertEqual(volumes, make_zip(self.test_vols))
+        self.assertEqual(pages, make_zip(self.test_vols))
+        self.assertEqual([path for path, _, _ in server.requests], ['/volumes', '/pages'])
+        self.assertEqual(server.requests[0][2]['concat'], ['true'])
+        self.assertEqual(server.num_connections, 1)  # the connection was kept alive
+
+    def test_get_volumes_chunked_spooled(self):
+        async def run(data_api_config, **kwargs):
+            async with htrc.volumes.aio.AsyncDataApiClient(data_api_config, ssl_context=False) as client:
+                return await htrc.volumes.aio.get_volumes(data_api_config, self.test_vols, buffer_size=64,
+                                                          client=client, **kwargs)
+
+        with StandInDataApi(chunked=True) as server:
+            with asyncio.run(run(self.data_api_config(server), spool_max_size=10)) as data:
+                self.assertEqual(data.read(), make_zip(self.test_vols))
+
+            with asyncio.run(run(self.data_api_config(server), named_spool=True)) as data, \
+                    open(data.name, 'rb') as data_file:
+                self.assertEqual(data_file.read(), make_zip(self.test_vols))
+
+    def test_get_volumes_error(self):
+        async def run(data_api_config):
+            async with htrc.volumes.aio.AsyncDataApiClient(data_api_config, ssl_context=False) as client:
+                return await htrc.volumes.aio.get_volumes(data_api_config, self.test_vols, client=client)
+
+        with StandInDataApi() as server:
+            data_api_config = self.data_api_config(server)
+            data_api_config.token = 'expired'
+            with self.assertRaises(htrc.volumes.DataApiError) as cm:
+                asyncio.run(run(data_api_config))
+
+        self.assertEqual(cm.exception.status, 500)
+
+        with self.assertRaises(ValueError):
+            asyncio.run(htrc.volumes.aio.get_volumes(data_api_config, []))
+
+    def test_get_volumes_truncated(self):
+        async def run(data_api_config):
+            async with htrc.volumes.aio.AsyncDataApiClient(data_api_config, ssl_context=False) as client:
+                return await htrc.volumes.aio.get_volumes(data_api_config, self.test_vols, client=client)
+
+        # truncated responses fail like those of the synchronous client, and are retried the same way
+        for chunked in (False, True):
+            with StandInDataApi(chunked=chunked, truncate=1) as server:
+                with self.assertRaises(http.client.IncompleteRead) as cm:
+                    asyncio.run(run(self.data_api_config(server)))
+            self.assertTrue(htrc.volumes.RetryPolicy().is_retryable(cm.exception))
+
+    def test_timeout(self):
+        async def run(data_api_config):
+            async with htrc.volumes.aio.AsyncDataApiClient(data_api_config, max_connections=1, ssl_context=False,
+                                                           timeout=0.05) as client:
+                with self.assertRaises(TimeoutError):
+                    await htrc.volumes.aio.get_volumes(data_api_config, self.test_vols, client=client)
+                # the stalled connection was closed and gave up its slot
+                self.assertEqual(client._idle_connections, [])
+                self.assertFalse(client._semaphore.locked())
+
+        with StandInDataApi(delay=1) as server:
+            asyncio.run(run(self.data_api_config(server)))
+
+    def test_concurrent_requests(self):
+        async def run(data_api_config):
+            async with htrc.volumes.aio.AsyncDataApiClient(data_api_config, max_connections=3,
+                                                           ssl_context=False) as client:
+                return await asyncio.gather(*(htrc.volumes.aio.get_volumes(data_api_config, [volume_id],
+                                                                           client=client)
+                                              for volume_id in self.test_vols * 2))
+
+        with StandInDataApi(delay=0.05) as server:
+            results = asyncio.run(run(self.data_api_config(server)))
+
+        self.assertEqual(results, [make_zip([volume_id]) for volume_id in self.test_vols * 2])
+        self.assertEqual(server.max_open_connections, 3)
+
+    def test_cancel(self):
+        async def run(data_api_config):
+            client = htrc.volumes.aio.AsyncDataApiClient(data_api_config, ssl_context=False)
+            task = asyncio.ensure_future(htrc.volumes.aio.get_volumes(data_api_config, self.test_vols,
+                                                                      client=client))
+            await asyncio.sleep(0.05)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+            # the interrupted connection is not reused
+            self.assertEqual(client._idle_connections, [])
+            await client.close()
+
+        with StandInDataApi(delay=1) as server:
+            asyncio.run(run(self.data_api_config(server)))
+
+    @patch.object(htrc.volumes.aio.AsyncDataApiClient, 'ssl_context', new_callable=PropertyMock)
+    def test_download_volumes(self, ssl_context_mock):
+        ssl_context_mock.return_value = None
+
+        for spool_max_size in (htrc.volumes.DEFAULT_SPOOL_MAX_SIZE, None):
+            output_path = os.path.join(self.output_path, str(spool_max_size))
+            with StandInDataApi() as server:
+                htrc.volumes.download_volumes(self.test_vols, output_path,
+                                              data_api_config=self.data_api_config(server), parallelism=1,
+                                              batch_size=2,
+                                              transfer=htrc.volumes.TransferOptions(concurrency=2, use_asyncio=True,
+                                                                                    spool_max_size=spool_max_size))
+
+            self.assertEqual(len(server.requests), 3)
+            for volume_id in self.test_vols:
+                self.assertEqual(os.listdir(os.path.join(output_path, volume_id)), ['00000001.txt'])
+
+    @patch.object(htrc.volumes.aio.AsyncDataApiClient, 'ssl_context', new_callable=PropertyMock)
+    def test_download_volumes_retry_truncated(self, ssl_context_mock):
+        ssl_context_mock.return_value = None
+
+        with StandInDataApi(truncate=1) as server:
+            htrc.volumes.download_volumes(self.test_vols, self.output_path,
+                                          data_api_config=self.data_api_config(server), parallelism=1,
+                                          retry_policy=htrc.volumes.RetryPolicy(backoff=0),
+                                          transfer=htrc.volumes.TransferOptions(use_asyncio=True))
+
+        self.assertEqual(len(server.requests), 2)
+        self.assertFalse(os.path.exists(os.path.join(self.output_path, 'volumes_failed.txt')))
+        for volume_id in self.test_vols:
+            self.assertEqual(os.listdir(os.path.join(self.output_path, volume_id)), ['00000001.txt'])
@@ -0,0 +1,100 @@
+"""
+Measures the run time and peak memory of `htrc.runningheaders.parse_page_structure`
+on synthetic volumes with noisy running headers and page number footers.
+
+    python utils/benchmark_runningheaders.py --pages 1000 3000 --window-size 6
+"""
+from __future__ import print_function
+
+from argparse import ArgumentParser
+import random
+import time
+import tracemalloc
+
+from htrc.hf_utils import BACKEND
+from htrc.models import HtrcPage
+from htrc.runningheaders import parse_page_structure
+
+LETTERS = 'abcdefghijklmnopqrstuvwxyz'
+
+
+def _noisy(text, rng, p=0.08):
+    # simulates OCR errors by dropping, replacing and inserting letters
+    out = []
+    for c in text:
+        r = rng.random()
+        if r < p / 3:
+            continue
+        elif r < 2 * p / 3:
+            out.append(rng.choice(LETTERS))
+        elif r < p:
+            out.extend([c, rng.choice(LETTERS + ' ')])
+        else:
+            out.append(c)
+
+    return ''.join(out)
+
+
+def generate_volume(num_pages, lines_per_page=35, seed=0):
+    """
+    Returns the text lines of the pages of a volume, whose running headers
+    change every 20 pages and alternate with the page number on either side.
+    """
+    rng = random.Random(seed)
+    words = [''.join(rng.choice(LETTERS) for _ in range(rng.randint(2, 10))) for _ in range(5000)]
+    titles = [' '.join(rng.choice(words) for _ in range(rng.randint(3, 6))).upper()
+              for _ in range(max(1, num_pages // 20))]
+    volume = []
+    for page in range(num_pages):
+        title = titles[page * len(titles) // num_pages]
+        header = '{} {}'.format(page + 1, title) if page % 2 else '{} {}'.format(title, page + 1)
+        lines = [_noisy(header, rng)]
+        lines.extend(' '.join(rng.choice(words) for _ in range(rng.randint(6, 12)))
+                     for _ in range(rng.randint(lines_per_page - 5, lines_per_page + 5)))
+        lines.append(_noisy(str(page + 1), rng, 0.02))
+        volume.append(lines)
+
+    return volume
+
+
+def measure(volume, repeat=3, **kwargs):
+    """
+    Returns the best run time of `parse_page_structure` on `volume` out of
+    `repeat` runs, and its peak memory use (traced in a separate run).
+    """
+    timings = []
+    for _ in range(repeat):
+        pages = [HtrcPage(list(lines)) for lines in volume]
+        start = time.perf_counter()
+        parse_page_structure(pages, **kwargs)
+        timings.append(time.perf_counter() - start)
+
+    pages = [HtrcPage(list(lines)) for lines in volume]
+    tracemalloc.start()
+    try:
+        parse_page_structure(pages, **kwargs)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return min(timings), peak
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--pages", type=int, nargs='+', default=[1000, 3000], help="Numbers of pages of the volumes")
+    parser.add_argument("--lines", type=int, default=35, help="Average number of lines of a page")
+    parser.add_argument("-w", "--window-size", type=int, default=6)
+    parser.add_argument("--candidates", choices=['window', 'lsh'], default='window')
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    print("backend: {}, window size: {}, candidates: {}".format(BACKEND, args.window_size, args.candidates))
+    for num_pages in args.pages:
+        volume = generate_volume(num_pages, args.lines)
+        seconds, peak = measure(volume, args.repeat, window_size=args.window_size, candidates=args.candidates)
+        print("{:>6,} pages: {:8.3f} s, peak memory {:8.1f} MiB".format(num_pages, seconds, peak / 2 ** 20))
+
+
+if __name__ == '__main__':
+    main()